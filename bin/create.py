@@ -17,8 +17,6 @@ TODO:
 - Make sure two different users running on the machine can't create files that
   interfere with each other.  (i.e. one can't read the files created by the
   other)
-- Check that the *last* file in the archive, TIN/checksum, exists before
-  starting the main program
 - Don't change the working directory at startup; rather provide an environment
   variable to do it
 
@@ -26,6 +24,8 @@ TODO:
 FEATURES
 
 - TIN_VERBOSE=1 shows debug information at runtime
+- TIN_GC_MAX_BYTES=N removes least recently used extract dirs after an
+  extraction, until they fit in N bytes.  See tin_gc.py.
 - TIN_LIST=1 lists the contents of the file
 - TODO: Do you need TIN_CAT to cat a specific file?  LIke the checksum?
 
@@ -39,7 +39,8 @@ NOTES
 
 - build info (timestamp, hostname, current directory, etc.) is the
   responsibility of a separate process.  Put it in TIN/build-info
-- This script depends on md5sum (could just busybox it)
+- TIN/checksum has the same format as md5sum output.  The digests are computed
+  while files are read into the archive, so each file is read once.
 
 Reasons to uncompress everything:
 
@@ -48,26 +49,160 @@ Reasons to uncompress everything:
   uncompressed.
 - It's faster and simpler just to uncompress everything.  Requires less
   modification of the underlying code.
+
+But with --kind zip --lazy, only the files that are opened by path, and the
+packages they're in, are extracted, and Python imports the rest from the
+archive with zipimport.  That
+starts faster and uses less of /tmp when most of the archive is .py files.
 """
 
 __author__ = 'Andy Chu'
 
 
 import cStringIO
+import hashlib
 import optparse
 import os
 import md5
+import Queue
+import shutil
+import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
 import time
 import zipfile
+import zlib
+
+import gzip_members
+import treespec
+import worker_pool
 
 
 class Error(Exception):
   pass
 
 
+# Shell functions shared by both preludes, substituted for _EXTRACT_FUNCS_.
+# Each prelude defines extract_payload DIR.
+#
+# When many processes start the same .tin at once, only one extracts it.  It
+# extracts into a private dir, checks that TIN/checksum (the last member)
+# arrived, and renames the dir into place, so $extract_dir is either missing
+# or complete.  The others wait on a mkdir lock, which is broken if the
+# process holding it has died.
+#
+# Each run touches the dir, so its mtime is the last use.  After an
+# extraction, if $TIN_GC_MAX_BYTES is set, least recently used dirs are
+# removed until they fit; see tin_gc.py.
+_EXTRACT_FUNCS = """\
+# Print the physical paths of the dirs that running .tin programs were started
+# from.  main() makes $tmp physical too, so they can be compared.
+in_use_dirs() {
+  local dir
+  cat /proc/[0-9]*/environ 2>/dev/null | tr '\\0' '\\n' |
+    sed -n 's/^TIN_EXTRACT_DIR=//p' | while read -r dir; do
+      (cd "$dir" 2>/dev/null && pwd -P) || true
+    done
+}
+
+gc_extract_dirs() {
+  local max_kb=$((TIN_GC_MAX_BYTES / 1024))
+  local in_use=$(in_use_dirs)
+  local dirs=$(ls -dtr "$tmp"/tin-* | grep -E '/tin-(lazy-)?[0-9a-f]+$')
+  local total=$(du -sk $dirs | awk '{ s += $1 } END { print s + 0 }')
+  local dir kb
+  for dir in $dirs; do  # oldest first
+    test $total -gt $max_kb || break
+    test "$dir" != "$extract_dir" || continue
+    echo "$in_use" | grep -qxF "$dir" && continue
+    mkdir "$dir.lock" 2>/dev/null || continue
+    echo $$ > "$dir.lock/pid"
+    # A .tin may have started from it since the first read.
+    if in_use_dirs | grep -qxF "$dir"; then
+      rm -rf "$dir.lock"
+      continue
+    fi
+    kb=$(du -sk "$dir" | cut -f 1)
+    if mv "$dir" "$dir.gc.$$"; then
+      log "removing $dir ($kb KiB)"
+      total=$((total - kb))
+    fi
+    rm -rf "$dir.lock" "$dir.gc.$$"
+  done
+}
+
+extract_into_place() {
+  local tmp_dir=$extract_dir.tmp.$$
+  rm -rf "$tmp_dir"
+  mkdir -p "$tmp_dir"
+  log "extracting into $tmp_dir"
+  extract_payload "$tmp_dir"
+  test -f "$tmp_dir/TIN/checksum" || die "Failed to extract $0"
+  # Never remove a dir that has TIN/checksum, since programs may be running
+  # from it.  If another process got there first, use its dir.
+  if test -f "$extract_dir/TIN/checksum"; then
+    rm -rf "$tmp_dir"
+  else
+    # A dir without it is left over from an old prelude that extracted in
+    # place.
+    if test -d "$extract_dir"; then
+      mv "$extract_dir" "$extract_dir.gc.$$" && rm -rf "$extract_dir.gc.$$"
+    fi
+    mv "$tmp_dir" "$extract_dir"
+    # If another dir appeared in the meantime, mv put ours inside it.
+    rm -rf "$extract_dir/${tmp_dir##*/}"
+  fi
+  if test -n "$TIN_GC_MAX_BYTES"; then
+    gc_extract_dirs || true
+  fi
+}
+
+ensure_extracted() {
+  local lock=$extract_dir.lock
+  local tries=0
+  while ! test -f "$extract_dir/TIN/checksum"; do
+    if mkdir "$lock" 2>/dev/null; then
+      echo $$ > "$lock/pid"
+      trap 'rm -rf "$lock" "$extract_dir.tmp.$$"' EXIT
+      # Another process may have finished between the test and the mkdir.
+      test -f "$extract_dir/TIN/checksum" || extract_into_place
+      rm -rf "$lock"
+      trap - EXIT
+      break
+    fi
+    local pid=$(cat "$lock/pid" 2>/dev/null)
+    if test -n "$pid" && ! kill -0 "$pid" 2>/dev/null; then
+      # One waiter at a time breaks a stale lock, and checks the pid again
+      # first.  Otherwise a waiter that read the pid before another one broke
+      # the lock and took it would remove the new, live lock.
+      if mkdir "$lock.break" 2>/dev/null; then
+        echo $$ > "$lock.break/pid"
+        if test "$(cat "$lock/pid" 2>/dev/null)" = "$pid"; then
+          log "removed stale lock $lock"
+          rm -rf "$lock"
+        fi
+        rm -rf "$lock.break"
+      else
+        # The breaker only runs the few commands above, so this only happens
+        # if it was killed.
+        local breaker=$(cat "$lock.break/pid" 2>/dev/null)
+        if test -n "$breaker" && ! kill -0 "$breaker" 2>/dev/null; then
+          rm -rf "$lock.break"
+        fi
+      fi
+      continue
+    fi
+    tries=$((tries + 1))
+    test $tries -lt 3000 || die "Timed out waiting for $lock"
+    log "waiting for another process to extract $extract_dir"
+    sleep 0.1 2>/dev/null || sleep 1
+  done
+  touch "$extract_dir" 2>/dev/null || true
+}
+"""
+
 # NOTE: Some boilerplate is duplicated from the .zip prelude below.
 
 _TAR_PRELUDE = """\
@@ -76,6 +211,11 @@ _TAR_PRELUDE = """\
 main_module='_MAIN_MODULE_'
 checksum='_CHECKSUM_'
 set_pythonpath='_SET_PYTHONPATH_'
+# 1-based byte offset of the .tar.gz payload, for tail -c.
+payload_offset='_PAYLOAD_OFFSET_'
+# File offset of the gzip member holding TIN/toc, or 0 without --index.  See
+# tin_archive.py.
+toc_offset='_TOC_OFFSET_'
 
 log() {
   if test -n "$TIN_VERBOSE"; then
@@ -88,32 +228,30 @@ die() {
   exit 6  # exit code 1 is saved for the program
 }
 
+extract_payload() {
+  # Skip the prelude by its byte offset, then pipe the payload to tar, which
+  # reads from stdin and writes to the dir.
+  tail -c +$payload_offset "$0" | tar xzf - -C "$1"
+}
+
+_EXTRACT_FUNCS_
 main() {
   # This is used for listing the contents of a .tin file, for examining
   # contents, etc.
   if test -n "$TIN_UNTAR"; then
-    sed -e '1,/^exit$/d' "$0"
+    tail -c +$payload_offset "$0"
     exit 0
   fi
 
   log argv: "$@"
-  local tmp=${TMP:-/tmp}
+  # Physical, so TIN_EXTRACT_DIR is spelled the same way by every .tin.
+  local tmp
+  tmp=$(cd "${TMP:-/tmp}" && pwd -P)
   local extract_dir=$tmp/tin-$checksum
 
   local extra_flags='_EXTRA_FLAGS_'
 
-  if test -d "$extract_dir"; then
-    log "$extract_dir exists"
-  else
-    log "extracting into $extract_dir"
-    mkdir -p $extract_dir
-    # Filter the payload in this file using sed, then pipe it to tar, which
-    # reads from stdin and writes to $extract_dir.
-    sed -e '1,/^exit$/d' "$0" | tar xzf - -C "$extract_dir"
-
-    # TODO: test for the last file, which should be the manifest, here;
-    # otherwise cleanup
-  fi
+  ensure_extracted
 
   # We need to set PYTHONPATH for the executable (e.g. Poly) to run.  But if
   # that executable is spawning Python subprocesses, we don't want them to use
@@ -144,7 +282,8 @@ main() {
 
 main "$@"
 
-# sed command above looks for this line.
+# Don't let the shell read the payload.  The payload starts right after this
+# line.
 exit
 """
 
@@ -157,6 +296,7 @@ _SHELL_PRELUDE = """\
 main_module='_MAIN_MODULE_'
 checksum='_CHECKSUM_'
 set_pythonpath='_SET_PYTHONPATH_'
+lazy='_LAZY_'
 
 log() {
   if test -n "$TIN_VERBOSE"; then
@@ -169,29 +309,56 @@ die() {
   exit 6  # exit code 1 is saved for the program
 }
 
+extract_payload() {
+  which unzip >/dev/null || die "Please install 'unzip' to run .tin files."
+  # unzip may exit 1 on leading bytes in old archives.  extract_into_place
+  # checks that the files arrived.
+  if test "$lazy" = 1; then
+    # Only the members listed in TIN/materialize.  unzip treats its arguments
+    # as wildcards, so escape those characters.
+    unzip -qq -p "$0" TIN/materialize | sed 's/[][*?\\\\]/\\\\&/g' |
+      tr '\\n' '\\0' | xargs -0 unzip -qq -d "$1" "$0" || true
+  else
+    unzip -qq -d "$1" "$0" || true
+  fi
+}
+
+_EXTRACT_FUNCS_
 main() {
   log argv: "$@"
-  local tmp=${TMP:-/tmp}
+  # Physical, so TIN_EXTRACT_DIR is spelled the same way by every .tin.
+  local tmp
+  tmp=$(cd "${TMP:-/tmp}" && pwd -P)
   local extract_dir=$tmp/tin-$checksum
+  # A lazy dir has only some of the files, so it's never shared with a full
+  # one.
+  if test "$lazy" = 1; then
+    extract_dir=$tmp/tin-lazy-$checksum
+  fi
 
   local extra_flags='_EXTRA_FLAGS_'
 
-  if test -d "$extract_dir"; then
-    log "$extract_dir exists"
-  else
-    # This exits 1 because 'unzip' doesn't like leading bytes
-    log "Unzipping to $extract_dir"
-    which unzip >/dev/null || die "Please install 'unzip' to run .tin files."
-    unzip -qq -d "$extract_dir" $0
-    # TODO: test for the last file, which should be the manifest, here;
-    # otherwise cleanup
-  fi
+  ensure_extracted
 
   # We need to set PYTHONPATH for the executable (e.g. Poly) to run.  But if
   # that executable is spawning Python subprocesses, we don't want them to use
   # this PYTHONPATH.  So if it does this, it should set PYTHONPATH to
   # TIN_OLD_PYTHONPATH.
-  if test "$set_pythonpath" = 1; then
+  if test "$lazy" = 1; then
+    # Modules that weren't extracted are imported from the archive.  The main
+    # module's dir in the archive stands in for sys.path[0].
+    local archive=$(cd "$(dirname "$0")" && pwd)/$(basename "$0")
+    local zip_path=$archive
+    case $main_module in
+      */*) zip_path=$archive/${main_module%/*} ;;
+    esac
+    export TIN_OLD_PYTHONPATH=$PYTHONPATH
+    if test "$set_pythonpath" = 1; then
+      export PYTHONPATH=$extract_dir:$archive:$zip_path
+    else
+      export PYTHONPATH=$zip_path${PYTHONPATH:+:$PYTHONPATH}
+    fi
+  elif test "$set_pythonpath" = 1; then
     export TIN_OLD_PYTHONPATH=$PYTHONPATH
     export PYTHONPATH=$extract_dir
   fi
@@ -221,28 +388,547 @@ def log(msg, *args):
   print >>sys.stderr, msg
 
 
-def WritePrelude(zip_filename, prelude):
-  f = open(zip_filename, 'rb')
-  zip_contents = f.read()
-  f.close()
+# The checksum isn't known until the payload has been written, so the prelude
+# is written with this placeholder, which is overwritten at the end.  It's the
+# width of an md5 hex digest.
+CHECKSUM_PLACEHOLDER = '0' * 32
+
+# Likewise for the offset of TIN/toc.  It reads as 0, i.e. no index.
+TOC_PLACEHOLDER = '0' * 12
+
+
+def _FillPayloadOffset(prelude):
+  """Replace _PAYLOAD_OFFSET_ with the 1-based offset of the end of prelude.
+
+  The number is part of the prelude, so its number of digits changes the
+  offset.  Iterate until it's consistent.  The first pass shrinks the prelude,
+  since _PAYLOAD_OFFSET_ is longer than the number, and after that the number
+  of digits settles, so this terminates.
+  """
+  offset = len(prelude) + 1
+  while True:
+    filled = prelude.replace('_PAYLOAD_OFFSET_', str(offset))
+    if len(filled) + 1 == offset:
+      return filled
+    offset = len(filled) + 1
+
 
-  f = open(zip_filename, 'wb')
+def MakePrelude(template, main_module, extra_flags, set_pythonpath,
+                lazy=False):
+  """Fill in a prelude template, except for the checksum placeholder.
+
+  The prelude must be written at the start of the file, since it contains the
+  offset of the payload after it.  Replacing the placeholder doesn't change its
+  length.
+  """
+  prelude = template.replace(
+      '_EXTRACT_FUNCS_\n', _EXTRACT_FUNCS).replace(
+      '_MAIN_MODULE_', main_module).replace(
+      '_CHECKSUM_', CHECKSUM_PLACEHOLDER).replace(
+      '_TOC_OFFSET_', TOC_PLACEHOLDER).replace(
+      '_EXTRA_FLAGS_', ' '.join(extra_flags)).replace(
+      '_SET_PYTHONPATH_', '1' if set_pythonpath else '0').replace(
+      '_LAZY_', '1' if lazy else '0')
+  return _FillPayloadOffset(prelude)
+
+
+def PlaceholderOffset(prelude, var_name, placeholder):
+  """Returns the offset of a placeholder value in the prelude, or None."""
+  assignment = "%s='" % var_name
+  i = prelude.find(assignment + placeholder)
+  if i == -1:
+    return None
+  return i + len(assignment)
+
+
+def WritePrelude(f, prelude):
+  """Write the prelude at the current position.
+
+  Returns:
+    The file offset of the checksum placeholder.
+  """
+  offset = f.tell() + PlaceholderOffset(prelude, 'checksum',
+                                        CHECKSUM_PLACEHOLDER)
   f.write(prelude)
-  f.write(zip_contents)
-  f.close()
+  return offset
+
+
+def PatchPlaceholder(f, offset, value, placeholder):
+  if len(value) != len(placeholder):
+    raise AssertionError(value)
+  f.seek(offset)
+  f.write(value)
+  f.seek(0, os.SEEK_END)
+
+
+def PatchChecksum(f, offset, checksum):
+  PatchPlaceholder(f, offset, checksum, CHECKSUM_PLACEHOLDER)
+
+
+HASHES = ('md5', 'sha1', 'sha256', 'sha512', 'crc32')
+
+
+class _Crc32(object):
+  """The hashlib interface for zlib.crc32.  Fast, but not collision-resistant."""
+
+  def __init__(self):
+    self.value = 0
+
+  def update(self, data):
+    self.value = zlib.crc32(data, self.value)
+
+  def hexdigest(self):
+    return '%08x' % (self.value & 0xffffffff)
+
+
+def NewHash(hash_name):
+  if hash_name == 'crc32':
+    return _Crc32()
+  return hashlib.new(hash_name)
+
+
+# TIN/checksum doesn't say which hash it used, but the digest length does.
+_HASH_BY_LENGTH = {
+    8: 'crc32', 32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+def HashForDigest(digest):
+  """Returns the name of the hash that made a hex digest, or None."""
+  return _HASH_BY_LENGTH.get(len(digest))
+
+
+class HashingFile(object):
+  """A file opened for reading, which hashes the bytes as they're read.
+
+  With a thread pool, the hashing happens on a worker, overlapping with
+  whatever the reader does with the bytes (e.g. compression).  hashlib and zlib
+  release the GIL on large buffers.
+  """
+
+  def __init__(self, path, hash_name, pool=None):
+    self.f = open(path, 'rb')
+    self.h = NewHash(hash_name)
+    if pool:
+      # Bounded, so a slow hash doesn't buffer a whole file.
+      self.chunks = Queue.Queue(16)
+      self.job = pool.Submit(self._Drain)
+    else:
+      self.chunks = None
+
+  def _Drain(self):
+    while True:
+      chunk = self.chunks.get()
+      if chunk is None:
+        return self.h.hexdigest()
+      self.h.update(chunk)
+
+  def read(self, n=-1):
+    data = self.f.read(n)
+    if self.chunks:
+      if data:
+        self.chunks.put(data)
+    else:
+      self.h.update(data)
+    return data
+
+  def close(self):
+    self.f.close()
+    if self.chunks:
+      self.chunks.put(None)
+
+  def HexDigest(self):
+    """Call after close()."""
+    if self.chunks:
+      return self.job.Wait()
+    return self.h.hexdigest()
+
+
+def _ChecksumLine(digest, filename):
+  # Escape like md5sum, so 'md5sum -c' can read it.
+  if '\\' in filename or '\n' in filename:
+    filename = filename.replace('\\', '\\\\').replace('\n', '\\n')
+    return '\\%s  %s\n' % (digest, filename)
+  return '%s  %s\n' % (digest, filename)
+
+
+class StreamHasher(object):
+  """Collects the digests of files as they're read into an archive.
+
+  Usage:
+    hasher = StreamHasher('md5', jobs=2)
+    f = hasher.Open(path)
+    ... read all of f ...
+    f.close()
+    checksum, contents = hasher.Finish()
+  """
+
+  def __init__(self, hash_name='md5', jobs=0):
+    self.hash_name = hash_name
+    self.pool = worker_pool.WorkerPool(jobs) if jobs else None
+    self.files = []  # (path, HashingFile) in input order
+    self.digests = None  # set by Finish(), in input order
+
+  def Open(self, path):
+    f = HashingFile(path, self.hash_name, self.pool)
+    self.files.append((path, f))
+    return f
+
+  def Finish(self):
+    """Returns (checksum, contents of TIN/checksum).
+
+    The contents are a line of '<digest>  <path>' for each file, like md5sum
+    output.  The checksum is the md5 of the contents, regardless of the hash
+    used for each file, so the extract dir name has the same form.
+    """
+    try:
+      self.digests = [f.HexDigest() for _, f in self.files]
+      out = ''.join(_ChecksumLine(digest, path)
+                    for (path, _), digest in zip(self.files, self.digests))
+    finally:
+      if self.pool:
+        self.pool.Join(raise_errors=False)
+    return md5.new(out).hexdigest(), out
+
+
+def _HashFully(hasher, path):
+  """Returns the HashingFile, after reading all of it."""
+  f = hasher.Open(path)
+  try:
+    while f.read(1 << 20):
+      pass
+  finally:
+    f.close()
+  return f
+
+
+def Checksum(input_files, hash_name='md5'):
+  """Take the md5 a file containing the digest of each individual file."""
+  hasher = StreamHasher(hash_name)
+  for path in input_files:
+    _HashFully(hasher, path)
+  return hasher.Finish()
+
+
+def AddToTar(t, hasher, filename, archive_name):
+  """Add a file to a tar, hashing its contents on the way in."""
+  tarinfo = t.gettarinfo(filename, arcname=archive_name)
+  if tarinfo.isreg():
+    f = hasher.Open(filename)
+    try:
+      t.addfile(tarinfo, f)
+    finally:
+      f.close()
+  else:
+    # A symlink is stored as a link, but md5sum hashed its target.
+    t.add(filename, arcname=archive_name)
+    _HashFully(hasher, filename)
+
+
+def AddToTarCached(t, writer, hasher, cache, filename, archive_name,
+                   level=None):
+  """Add a file to a tar as its own gzip member.
+
+  If a file with the same contents and tar header was compressed before, the
+  member is copied from the cache instead.  The file is read once to hash it,
+  and on a miss, again to compress it.
+
+  Args:
+    t: TarFile writing to writer
+    writer: GzipMemberWriter
+    cache: MemberCache
+    level: zlib level for the member, or None for the writer's
+  """
+  if level is None:
+    level = writer.level
+  tarinfo = t.gettarinfo(filename, arcname=archive_name)
+  if not tarinfo.isreg():
+    writer.Begin(level=level)
+    AddToTar(t, hasher, filename, archive_name)
+    writer.End()
+    return
+
+  digest = _HashFully(hasher, filename).HexDigest()
+  header = tarinfo.tobuf(t.format, t.encoding, t.errors)
+  key = gzip_members.CacheKey(header, hasher.hash_name, digest, str(level))
+  num_blocks = (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+
+  cached = cache.Open(key)
+  if cached:
+    with cached:
+      writer.CopyMember(cached)
+    # TarFile only uses the offset to pad the end of the archive.
+    t.offset += len(header) + num_blocks * tarfile.BLOCKSIZE
+    cache.RecordHit(tarinfo.size)
+    return
+
+  start_time = time.time()
+  entry = cache.Create(key)
+  # Hash again, so a file that changed since the first read can't be cached
+  # under the old key.
+  f = HashingFile(filename, hasher.hash_name)
+  try:
+    writer.Begin(tee=entry, level=level)
+    t.addfile(tarinfo, f)
+    writer.End()
+  except:
+    entry.Abort()
+    raise
+  finally:
+    f.close()
+  if f.HexDigest() != digest:
+    entry.Abort()
+    raise Error('%s changed while it was being archived' % filename)
+  entry.Commit()
+  cache.RecordMiss(tarinfo.size, time.time() - start_time)
+
+
+TOC_NAME = 'TIN/toc'
+
+
+def TocLine(offset, length, size, digest, archive_name):
+  """A line of TIN/toc.
+
+  Fields are separated by tabs: the file offset and length of the file's gzip
+  member, its uncompressed size, its digest in TIN/checksum, and its name,
+  escaped so it has no tabs or newlines.
+  """
+  return '%d\t%d\t%d\t%s\t%s\n' % (offset, length, size, digest,
+                                   archive_name.encode('string_escape'))
+
+
+def AddToZip(z, hasher, filename, archive_name, compress_type=None):
+  """Add a file to a zip, and hash its contents.
+
+  Python 2's ZipFile.write() opens the file itself, so the hasher reads it
+  separately, before write() does.  That's 2 reads, but memory stays constant
+  for large files.  Like the rest of create.py, this assumes the inputs don't
+  change while the archive is built.
+
+  Returns:
+    The ZipInfo, which has the compressed size.
+  """
+  _HashFully(hasher, filename)
+  z.write(filename, archive_name, compress_type)
+  return z.infolist()[-1]
+
+
+# Formats that are already compressed.  Deflating them again costs build time
+# and decompression time at startup, and saves next to nothing.
+COMPRESSED_EXTS = frozenset([
+    '.7z', '.bz2', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.lz4', '.mp3',
+    '.mp4', '.png', '.tgz', '.webp', '.whl', '.woff', '.woff2', '.xz', '.zip',
+    '.zst',
+])
+
+# Files smaller than this aren't sampled; they're compressed at the default
+# level.
+SAMPLE_MIN = 4096
+SAMPLE_SIZE = 1 << 16
+# If level 1 doesn't get a sample below this fraction of its size, the file is
+# stored.
+STORE_RATIO = 0.9
+
+POLICIES = ('uniform', 'auto')
+
+
+def ChooseLevel(filename, archive_name, level, policy='uniform'):
+  """Returns the zlib level for a file: 0 to store it, or level.
+
+  With the 'auto' policy, files with the extension of a compressed format are
+  stored, and so are files whose first 64 KiB barely compress.
+  """
+  if policy == 'uniform':
+    return level
+  if os.path.splitext(archive_name)[1].lower() in COMPRESSED_EXTS:
+    return 0
+  try:
+    with open(filename, 'rb') as f:
+      sample = f.read(SAMPLE_SIZE)
+  except IOError:
+    return level  # archiving it reports the error
+  if len(sample) < SAMPLE_MIN:
+    return level
+  if len(zlib.compress(sample, 1)) > len(sample) * STORE_RATIO:
+    return 0
+  return level
+
 
-  os.chmod(zip_filename, 0755)
+def CodecName(level):
+  return 'store' if level == 0 else 'deflate-%d' % level
 
 
-def Checksum(input_files):
-  """Take the md5 a file containing the md5 of each individual file."""
-  argv = ['md5sum'] + input_files
-  p = subprocess.Popen(argv, stdout=subprocess.PIPE)
-  out = p.stdout.read()
-  exit_code = p.wait()
-  assert exit_code == 0, exit_code
-  checksum = md5.new(out)
-  return checksum.hexdigest(), out
+class CodecReport(object):
+  """Bytes and time spent on each codec, for --report."""
+
+  def __init__(self):
+    self.rows = {}  # codec -> [files, bytes in, bytes out, seconds]
+
+  def Record(self, codec, bytes_in, bytes_out, seconds, num_files=1):
+    row = self.rows.setdefault(codec, [0, 0, 0, 0.0])
+    row[0] += num_files
+    row[1] += bytes_in
+    row[2] += bytes_out
+    row[3] += seconds
+
+  def Format(self):
+    lines = ['%-12s %6s %12s %12s %6s %8s' % (
+        'codec', 'files', 'bytes in', 'bytes out', 'ratio', 'seconds')]
+    for codec in sorted(self.rows):
+      files, bytes_in, bytes_out, sec = self.rows[codec]
+      ratio = float(bytes_out) / bytes_in if bytes_in else 1.0
+      lines.append('%-12s %6d %12d %12d %6.2f %8.3f' % (
+          codec, files, bytes_in, bytes_out, ratio, sec))
+    return '\n'.join(lines)
+
+
+# zipimport can load these from the archive.
+IMPORTABLE_EXTS = ('.py', '.pyc', '.pyo')
+
+MATERIALIZE_NAME = 'TIN/materialize'
+
+
+def _IsUnder(d, roots):
+  while d:
+    if d in roots:
+      return True
+    d = os.path.dirname(d)
+  return False
+
+
+def MaterializedNames(entries):
+  """Returns the archive names that --lazy extracts to disk, in entry order.
+
+  Executables, native extensions, and data files are opened by path, so they're
+  extracted.  Python modules are imported from the archive, except:
+
+  - Modules in the same dir as a data file or native extension, since code
+    usually finds those relative to its own __file__.
+  - The whole top-level package that holds such a dir.  A package can't be
+    split between the archive and the disk, since its __path__ is in one place.
+  """
+  package_dirs = set()
+  for _, _, archive_name in entries:
+    base, ext = os.path.splitext(os.path.basename(archive_name))
+    if base == '__init__' and ext in IMPORTABLE_EXTS:
+      package_dirs.add(os.path.dirname(archive_name))
+
+  disk_dirs = set()  # dirs whose modules are extracted
+  disk_packages = set()  # top-level packages that are extracted entirely
+  for file_type, _, archive_name in entries:
+    if (file_type == EXECUTABLE_FILE or
+        os.path.splitext(archive_name)[1] in IMPORTABLE_EXTS):
+      continue
+    d = os.path.dirname(archive_name)
+    disk_dirs.add(d)
+    top = None
+    while d:
+      if d in package_dirs:
+        top = d
+      d = os.path.dirname(d)
+    if top is not None:
+      disk_packages.add(top)
+
+  names = []
+  for file_type, _, archive_name in entries:
+    d = os.path.dirname(archive_name)
+    if (file_type == EXECUTABLE_FILE or
+        os.path.splitext(archive_name)[1] not in IMPORTABLE_EXTS or
+        d in disk_dirs or _IsUnder(d, disk_packages)):
+      names.append(archive_name)
+  return names
+
+
+# Run by the target interpreter, with -O flags, to compile modules.  Reads
+# NUL-terminated (source, name in tracebacks, mtime, output) fields on stdin.
+# The mtime is passed in because it has to match the one the extracted source
+# will have.
+_COMPILE_SCRIPT = """\
+import imp, marshal, struct, sys
+fields = sys.stdin.read().split('\\0')[:-1]
+for i in xrange(0, len(fields), 4):
+  src, dfile, mtime, out = fields[i:i+4]
+  with open(src, 'U') as f:
+    source = f.read()
+  try:
+    code = compile(source + '\\n', dfile, 'exec')
+  except SyntaxError, e:
+    print >>sys.stderr, '%s: %s' % (src, e)
+    sys.exit(1)
+  with open(out, 'wb') as f:
+    f.write(imp.get_magic() + struct.pack('<I', int(mtime)))
+    marshal.dump(code, f)
+"""
+
+
+def _SourceMtime(st_mtime, kind):
+  """Returns the mtime that an extracted file will have.
+
+  A zip stores local time to 2 seconds, and unzip restores that.
+  """
+  if kind == 'zip':
+    t = time.localtime(st_mtime)
+    return int(time.mktime(t[0:5] + (t[5] // 2 * 2, 0, 0, -1)))
+  return int(st_mtime)
+
+
+def _CheckPython2(python):
+  """_COMPILE_SCRIPT and the 8 byte .pyc header only work on Python 2."""
+  argv = [python, '-c',
+          'import sys; sys.stdout.write(str(sys.version_info[0]))']
+  try:
+    p = subprocess.Popen(argv, stdout=subprocess.PIPE)
+  except OSError, e:
+    raise Error("Couldn't run %s: %s" % (python, e))
+  major = p.communicate()[0].strip()
+  if p.returncode != 0 or major != '2':
+    raise Error('--compile needs a Python 2 interpreter, but %s is Python %s'
+                % (python, major or '(unknown)'))
+
+
+def CompileModules(entries, out_dir, kind, python=sys.executable, optimize=0,
+                   keep_source=True):
+  """Byte-compile the Python modules in entries.
+
+  Executables aren't compiled, since they're run as scripts.
+
+  Args:
+    out_dir: where to write the bytecode files
+    optimize: 1 or 2 for python -O or -OO, which write .pyo files
+
+  Returns:
+    A new list of entries, with each bytecode file after its source, or
+    instead of it if keep_source is False.
+  """
+  ext = '.pyc' if optimize == 0 else '.pyo'
+  new_entries = []
+  fields = []
+  for i, (file_type, filename, archive_name) in enumerate(entries):
+    if file_type == EXECUTABLE_FILE or not archive_name.endswith('.py'):
+      new_entries.append((file_type, filename, archive_name))
+      continue
+    st_mtime = os.stat(filename).st_mtime
+    out = os.path.join(out_dir, '%d%s' % (i, ext))
+    fields.extend([filename, archive_name, str(_SourceMtime(st_mtime, kind)),
+                   out])
+    if keep_source:
+      new_entries.append((file_type, filename, archive_name))
+    new_entries.append((DATA_FILE, out, archive_name[:-3] + ext))
+  if not fields:
+    return new_entries
+
+  _CheckPython2(python)
+  argv = [python] + ['-O'] * optimize + ['-c', _COMPILE_SCRIPT]
+  p = subprocess.Popen(argv, stdin=subprocess.PIPE)
+  p.communicate(''.join(f + '\0' for f in fields))
+  if p.returncode != 0:
+    raise Error('Failed to compile modules with %s' % python)
+
+  # The bytecode gets the source's mtime, so its tar header is the same from
+  # build to build, and --cache-dir can reuse it.
+  for i in xrange(0, len(fields), 4):
+    st = os.stat(fields[i])
+    os.utime(fields[i+3], (st.st_atime, st.st_mtime))
+  return new_entries
 
 
 def CreateOptionsParser():
@@ -270,6 +956,78 @@ def CreateOptionsParser():
       '--kind', dest='kind', choices=['tar', 'zip'], default='tar',
       help='What kind of executable to output.')
 
+  parser.add_option(
+      '-0', '--null', dest='null', action='store_true', default=False,
+      help='Read NUL-delimited type/source/dest fields instead of lines, so '
+           'paths may contain spaces.  See treespec.py.')
+
+  parser.add_option(
+      '--treespec', dest='treespec', type='str', default=None,
+      help='Read a treespec compiled with treespec.py instead of stdin')
+
+  parser.add_option(
+      '--hash', dest='hash', choices=HASHES, default='md5',
+      help='Hash for each file in TIN/checksum: %s.  crc32 is fastest, but '
+           "isn't collision-resistant." % ', '.join(HASHES))
+
+  parser.add_option(
+      '--hash-jobs', dest='hash_jobs', type='int', default=0,
+      help='Hash on this many threads, overlapping with compression.  0 '
+           'hashes on the main thread.')
+
+  parser.add_option(
+      '--cache-dir', dest='cache_dir', type='str', default=None,
+      help='Compress each file as its own gzip member, and reuse members of '
+           'unchanged files from this dir.  Only for --kind tar.')
+
+  parser.add_option(
+      '--level', dest='level', type='int', default=9,
+      help='zlib level for compressed files, 1 to 9 (default 9).  A zip '
+           "always uses zlib's default level.")
+
+  parser.add_option(
+      '--compress-policy', dest='compress_policy', choices=POLICIES,
+      default='uniform',
+      help="'uniform' compresses every file at --level.  'auto' stores "
+           'files that are already compressed, judged by extension or by '
+           'compressing a sample.  For --kind tar, auto compresses each file '
+           'as its own gzip member.')
+
+  parser.add_option(
+      '--report', dest='report', action='store_true', default=False,
+      help='Log a table of files, bytes in and out, and time for each codec')
+
+  parser.add_option(
+      '--index', dest='index', action='store_true', default=False,
+      help='Compress each file as its own gzip member, and add a table of '
+           'contents, TIN/toc, so tin_archive.py can read single files '
+           'without decompressing the rest.  Only for --kind tar.')
+
+  parser.add_option(
+      '--compile', dest='compile', action='store_true', default=False,
+      help='Byte-compile Python modules, other than executables, and add the '
+           'bytecode, so programs start without compiling them.')
+
+  parser.add_option(
+      '--optimize', dest='optimize', type='int', default=0,
+      help='With --compile, compile as python -O (1) or -OO (2) does, into '
+           '.pyo files.  The program must run with the same flag.')
+
+  parser.add_option(
+      '--no-source', dest='no_source', action='store_true', default=False,
+      help='With --compile, leave out the source of compiled modules.')
+
+  parser.add_option(
+      '--python', dest='python', type='str', default=sys.executable,
+      help='Python 2 interpreter that --compile uses.  Bytecode only works '
+           'with the same 2.x version.  (default %default)')
+
+  parser.add_option(
+      '--lazy', dest='lazy', action='store_true', default=False,
+      help='Only extract executables, native extensions, data files, and the '
+           'packages that hold them at startup, and import other Python '
+           'modules from the archive.  Only for --kind zip.')
+
   # TODO: Implement this
   #parser.add_option(
   #    '-e', '--env', dest='env', type='str', default='',
@@ -280,8 +1038,8 @@ def CreateOptionsParser():
   return parser
 
 
-DATA_FILE = 0
-EXECUTABLE_FILE = 1
+DATA_FILE = treespec.DATA_FILE
+EXECUTABLE_FILE = treespec.EXECUTABLE_FILE
 
 def ParseLines(lines):
   """
@@ -309,15 +1067,59 @@ def ParseLines(lines):
       yield DATA_FILE, parts[0], parts[0]
 
 
-def main(argv):
-  """Returns an exit code."""
+def ReadEntries(options, stdin):
+  """Yields (file type, filename, archive name) from the input."""
+  if options.null and options.treespec:
+    raise Error("-0 and --treespec can't be used together")
+  try:
+    if options.treespec:
+      spec = treespec.Treespec(options.treespec)
+      try:
+        # Input order, so the archive has the same order as the text form.
+        for entry in spec:
+          yield entry
+      finally:
+        spec.close()
+    elif options.null:
+      for entry in treespec.ParseNul(stdin):
+        yield entry
+    else:
+      for entry in ParseLines(stdin):
+        yield entry
+  except treespec.Error, e:
+    raise Error(e.args[0])
+
+
+def main(argv, stdin=None):
+  """Returns an exit code.
+
+  Args:
+    stdin: file to read the treespec from, instead of sys.stdin
+  """
   (options, argv) = CreateOptionsParser().parse_args(argv)
   extra_flags = argv[1:]
+  if options.hash_jobs < 0:
+    raise Error('--hash-jobs must be at least 0')
+  if options.cache_dir and options.kind != 'tar':
+    raise Error('--cache-dir only works with --kind tar')
+  if options.index and options.kind != 'tar':
+    raise Error('--index only works with --kind tar; a zip has its own index')
+  if options.index and options.no_prelude:
+    raise Error('--index needs the prelude, which has the offset of TIN/toc')
+  if options.lazy and (options.kind != 'zip' or options.no_prelude):
+    raise Error('--lazy only works with --kind zip and a prelude')
+  if not 1 <= options.level <= 9:
+    raise Error('--level must be between 1 and 9')
+  if options.optimize not in (0, 1, 2):
+    raise Error('--optimize must be 0, 1, or 2')
+  if (options.optimize or options.no_source) and not options.compile:
+    raise Error('--optimize and --no-source require --compile')
 
   # Make a first pass to find the main module
   entries = []
   main_modules = []
-  for file_type, _, archive_name in ParseLines(sys.stdin):
+  stdin = stdin or sys.stdin
+  for file_type, _, archive_name in ReadEntries(options, stdin):
     if file_type == EXECUTABLE_FILE:
       main_modules.append(archive_name)
     entries.append((file_type, _, archive_name))
@@ -340,79 +1142,182 @@ def main(argv):
   if not out_filename:
     raise Error('--output required')
 
-  if options.kind == 'zip':
-    # Write input files to a .zip
-    input_files = []
-    z = zipfile.ZipFile(out_filename, 'w', zipfile.ZIP_DEFLATED)
-    for file_type, filename, archive_name in entries:
-      log('%s -> %s', filename, archive_name)
-      z.write(filename, archive_name)
-      input_files.append(filename)
-
-    checksum, checksum_file_contents = Checksum(input_files)
-    checksum_name = 'TIN/checksum'
-    z.writestr(checksum_name, checksum_file_contents)
-    log('(computed checksum) -> %s', checksum_name)
-
-    z.close()
-
-    if options.set_pythonpath:
-      set_pythonpath = '1'
-    else:
-      set_pythonpath = '0'
-    prelude = _SHELL_PRELUDE.replace(
-        '_MAIN_MODULE_', main_module).replace(
-        '_CHECKSUM_', checksum).replace(
-        '_EXTRA_FLAGS_', ' '.join(extra_flags)).replace(
-        '_SET_PYTHONPATH_', set_pythonpath)
-    WritePrelude(out_filename, prelude)
-    log('Wrote %s with extra args %s', out_filename, extra_flags)
-
+  if options.no_prelude:
+    prelude = None
   else:
+    if options.kind == 'zip':
+      template = _SHELL_PRELUDE
+    else:
+      template = _TAR_PRELUDE
+    prelude = MakePrelude(template, main_module, extra_flags,
+                          options.set_pythonpath, lazy=options.lazy)
+
+  compile_dir = None
+  if options.compile:
+    compile_dir = tempfile.mkdtemp(prefix='tin-compile-')
+    try:
+      entries = CompileModules(entries, compile_dir, options.kind,
+                               python=options.python,
+                               optimize=options.optimize,
+                               keep_source=not options.no_source)
+    except:
+      shutil.rmtree(compile_dir)
+      raise
+
+  # Write to a temp file, so a failed build doesn't leave an archive with the
+  # placeholder checksum.
+  tmp_filename = out_filename + '.tmp'
+  f = open(tmp_filename, 'wb')
+  try:
+    checksum_offset = WritePrelude(f, prelude) if prelude else None
 
-    # gzip decompression is used in the prelude.
-    t = tarfile.open(out_filename, mode='w:gz')
-
-    input_files = []
-    for file_type, filename, archive_name in entries:
-      log('%s -> %s', filename, archive_name)
-      t.add(filename, arcname=archive_name)
-      input_files.append(filename)
-
-    checksum, checksum_file_contents = Checksum(input_files)
+    # The payload is written right after the prelude.
+    hasher = StreamHasher(options.hash, jobs=options.hash_jobs)
     checksum_name = 'TIN/checksum'
+    report = CodecReport()
+    if options.kind == 'zip':
+      z = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+      for file_type, filename, archive_name in entries:
+        log('%s -> %s', filename, archive_name)
+        level = ChooseLevel(filename, archive_name, options.level,
+                            options.compress_policy)
+        start_time = time.time()
+        if level == 0:
+          zinfo = AddToZip(z, hasher, filename, archive_name,
+                           compress_type=zipfile.ZIP_STORED)
+        else:
+          zinfo = AddToZip(z, hasher, filename, archive_name)
+        report.Record('store' if level == 0 else 'deflate', zinfo.file_size,
+                      zinfo.compress_size, time.time() - start_time)
+
+      if options.lazy:
+        # The checksum is last, since it marks a complete extraction.
+        names = MaterializedNames(entries) + [MATERIALIZE_NAME, checksum_name]
+        z.writestr(MATERIALIZE_NAME, ''.join(n + '\n' for n in names))
+        log('(%d of %d files to extract) -> %s', len(names) - 2, len(entries),
+            MATERIALIZE_NAME)
+
+      checksum, checksum_file_contents = hasher.Finish()
+      z.writestr(checksum_name, checksum_file_contents)
+      z.close()
 
-    c = cStringIO.StringIO(checksum_file_contents)
-
-    tarinfo = tarfile.TarInfo(checksum_name)
-    # TODO: user attributes?  do they matter?  We could use a temp file instead,
-    # it might be easier.
-    #
-    # The stamping might need to happen at a later step, for caching.
-    tarinfo.size = len(checksum_file_contents)
-    tarinfo.mtime = time.time()  # if not set, GNU tar gives a warning.
-    t.addfile(tarinfo, c)
-
-    t.close()
-
-    log('(computed checksum) -> %s', checksum_name)
-
-    if options.no_prelude:
-      log('Wrote tar %s', out_filename)
     else:
-      if options.set_pythonpath:
-        set_pythonpath = '1'
+      # gzip decompression is used in the prelude.
+      # A level for each file needs a gzip member for each file.
+      per_member = bool(options.cache_dir or options.index or
+                        options.compress_policy != 'uniform')
+      cache = None
+      payload_start = f.tell()
+      start_time = time.time()
+      if per_member:
+        if options.cache_dir:
+          cache = gzip_members.MemberCache(options.cache_dir)
+        writer = gzip_members.GzipMemberWriter(f, level=options.level)
+        t = tarfile.open(mode='w', fileobj=writer)
       else:
-        set_pythonpath = '0'
-      prelude = _TAR_PRELUDE.replace(
-          '_MAIN_MODULE_', main_module).replace(
-          '_CHECKSUM_', checksum).replace(
-          '_EXTRA_FLAGS_', ' '.join(extra_flags)).replace(
-          '_SET_PYTHONPATH_', set_pythonpath)
-
-      WritePrelude(out_filename, prelude)
-      log('Wrote self-extracting tar %s with extra args %s',
-          out_filename, extra_flags)
+        # Pass the name, which goes in the gzip header, rather than the temp
+        # name.
+        t = tarfile.open(out_filename, mode='w:gz', fileobj=f,
+                         compresslevel=options.level)
+
+      members = []  # (offset, length, size) of each file's gzip member
+      total_size = 0
+      for file_type, filename, archive_name in entries:
+        log('%s -> %s', filename, archive_name)
+        level = ChooseLevel(filename, archive_name, options.level,
+                            options.compress_policy)
+        start = f.tell()
+        member_start_time = time.time()
+        if cache:
+          AddToTarCached(t, writer, hasher, cache, filename, archive_name,
+                         level=level)
+        elif per_member:
+          writer.Begin(level=level)
+          AddToTar(t, hasher, filename, archive_name)
+          writer.End()
+        else:
+          AddToTar(t, hasher, filename, archive_name)
+
+        st = os.lstat(filename)
+        size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+        total_size += size
+        if per_member:
+          report.Record(CodecName(level), size, f.tell() - start,
+                        time.time() - member_start_time)
+        if options.index:
+          members.append((start, f.tell() - start, size))
+
+      checksum, checksum_file_contents = hasher.Finish()
+
+      if options.index:
+        toc_offset = f.tell()
+        toc = ''.join(
+            TocLine(offset, length, size, digest, archive_name)
+            for (offset, length, size), digest, (_, _, archive_name)
+            in zip(members, hasher.digests, entries))
+        tarinfo = tarfile.TarInfo(TOC_NAME)
+        tarinfo.size = len(toc)
+        tarinfo.mtime = time.time()
+        writer.Begin()
+        t.addfile(tarinfo, cStringIO.StringIO(toc))
+        writer.End()
+        log('(%d entries) -> %s', len(members), TOC_NAME)
+        PatchPlaceholder(
+            f, PlaceholderOffset(prelude, 'toc_offset', TOC_PLACEHOLDER),
+            '%0*d' % (len(TOC_PLACEHOLDER), toc_offset), TOC_PLACEHOLDER)
+
+      c = cStringIO.StringIO(checksum_file_contents)
+
+      tarinfo = tarfile.TarInfo(checksum_name)
+      # TODO: user attributes?  do they matter?  We could use a temp file
+      # instead, it might be easier.
+      #
+      # The stamping might need to happen at a later step, for caching.
+      tarinfo.size = len(checksum_file_contents)
+      tarinfo.mtime = time.time()  # if not set, GNU tar gives a warning.
+      if per_member:
+        # The checksum and the end of the archive are never cached.
+        writer.Begin()
+      t.addfile(tarinfo, c)
+
+      t.close()
+      if per_member:
+        writer.End()
+      else:
+        # One stream, so the files can't be told apart.  This includes the
+        # checksum.
+        report.Record(CodecName(options.level), total_size,
+                      f.tell() - payload_start, time.time() - start_time,
+                      num_files=len(entries))
+      if cache:
+        log('%s', cache.Report())
+        cache.Save()
+
+    log('(computed checksum) -> %s', checksum_name)
+    if options.report:
+      log('%s', report.Format())
+    if checksum_offset is not None:
+      PatchChecksum(f, checksum_offset, checksum)
+    f.close()
+  except:
+    f.close()
+    os.unlink(tmp_filename)
+    raise
+  finally:
+    if compile_dir:
+      shutil.rmtree(compile_dir)
+
+  if prelude:
+    os.chmod(tmp_filename, 0755)
+  os.rename(tmp_filename, out_filename)
+
+  if not prelude:
+    log('Wrote %s %s', options.kind, out_filename)
+  elif options.kind == 'zip':
+    log('Wrote %s with extra args %s', out_filename, extra_flags)
+  else:
+    log('Wrote self-extracting tar %s with extra args %s',
+        out_filename, extra_flags)
 
   return 0
 
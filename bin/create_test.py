@@ -6,11 +6,52 @@ create_test.py: Tests for create.py
 __author__ = 'Andy Chu'
 
 
+import cStringIO
+import os
+import shutil
+import struct
+import subprocess
 import sys
+import tarfile
+import tempfile
 import unittest
+import zipfile
 
 import create  # module under test
 
+# create.__file__ may be the .pyc
+CREATE_PY = os.path.splitext(create.__file__)[0] + '.py'
+
+
+def MakeArchive(tmp, name, files, flags):
+  """Write files under tmp/src and archive them as tmp/name.
+
+  Shared by the tests of the tools that read archives.
+
+  Args:
+    files: list of (archive name, contents).  The first one is the executable.
+    flags: more flags for create.py
+
+  Returns:
+    The path of the archive.
+  """
+  spec = []
+  for archive_name, contents in files:
+    path = os.path.join(tmp, 'src', archive_name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    # Only rewrite changed files, so the others keep their mtimes, which are in
+    # their tar headers.
+    if not os.path.exists(path) or open(path).read() != contents:
+      with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, 0644 if spec else 0755)
+    spec.append('%s\0%s\0%s\0' % ('f' if spec else 'x', path, archive_name))
+  out = os.path.join(tmp, name)
+  create.main(['create', '-0', '-o', out] + flags,
+              stdin=cStringIO.StringIO(''.join(spec)))
+  return out
+
 
 class TinTest(unittest.TestCase):
   def setUp(self):
@@ -22,6 +63,440 @@ class TinTest(unittest.TestCase):
   def testChecksum(self):
     print create.Checksum([sys.argv[0]])
 
+  def testChecksumMatchesMd5sum(self):
+    path = sys.argv[0]
+    p = subprocess.Popen(['md5sum', path], stdout=subprocess.PIPE)
+    expected = p.communicate()[0]
+    checksum, contents = create.Checksum([path])
+    self.assertEqual(expected, contents)
+    self.assertEqual(32, len(checksum))
+
+  def testStreamHasher(self):
+    for hash_name in create.HASHES:
+      for jobs in (0, 2):
+        hasher = create.StreamHasher(hash_name, jobs=jobs)
+        for path in [sys.argv[0], CREATE_PY]:
+          f = hasher.Open(path)
+          while f.read(100):
+            pass
+          f.close()
+        _, contents = hasher.Finish()
+        _, expected = create.Checksum([sys.argv[0], CREATE_PY],
+                                      hash_name=hash_name)
+        self.assertEqual(expected, contents)
+        print hash_name, jobs, contents.splitlines()[0]
+
+  def testAddToZip(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      big = os.path.join(tmp, 'big')
+      with open(big, 'w') as f:
+        f.write(''.join('%d\n' % (i * i) for i in xrange(100000)))
+      out = os.path.join(tmp, 'out.zip')
+      z = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+      hasher = create.StreamHasher('md5')
+      deflated = create.AddToZip(z, hasher, big, 'big')
+      stored = create.AddToZip(z, hasher, CREATE_PY, 'create.py',
+                               compress_type=zipfile.ZIP_STORED)
+      z.close()
+      _, contents = hasher.Finish()
+      _, expected = create.Checksum([big, CREATE_PY])
+      self.assertEqual(expected, contents)
+
+      self.assertTrue(deflated.compress_size < deflated.file_size)
+      self.assertEqual(stored.file_size, stored.compress_size)
+      z = zipfile.ZipFile(out)
+      self.assertEqual(None, z.testzip())
+      self.assertEqual(open(big).read(), z.read('big'))
+      self.assertEqual(open(CREATE_PY).read(), z.read('create.py'))
+      z.close()
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCreateTar(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      out = os.path.join(tmp, 'out.tar.gz')
+      stdin = cStringIO.StringIO(
+          'x %s main.py\nf %s lib.py\n' % (sys.argv[0], CREATE_PY))
+      create.main(['create', '--no-prelude', '--hash-jobs', '2', '-o', out],
+                  stdin=stdin)
+
+      t = tarfile.open(out)
+      self.assertEqual(['main.py', 'lib.py', 'TIN/checksum'], t.getnames())
+      _, expected = create.Checksum([sys.argv[0], CREATE_PY])
+      self.assertEqual(expected, t.extractfile('TIN/checksum').read())
+      with open(sys.argv[0]) as f:
+        self.assertEqual(f.read(), t.extractfile('main.py').read())
+    finally:
+      shutil.rmtree(tmp)
+
+  def testExecutable(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      script = os.path.join(tmp, 'hello.sh')
+      with open(script, 'w') as f:
+        f.write('#!/bin/sh\necho hello "$@"\n')
+      os.chmod(script, 0755)
+
+      for kind in ('tar', 'zip'):
+        out = os.path.join(tmp, 'hello-%s.tin' % kind)
+        create.main(['create', '--kind', kind, '-o', out, '--', '--flag'],
+                    stdin=cStringIO.StringIO('x %s hello.sh\n' % script))
+        self.assertFalse(os.path.exists(out + '.tmp'))
+
+        with open(out) as f:
+          contents = f.read()
+        self.assertFalse(create.CHECKSUM_PLACEHOLDER in contents)
+
+        env = dict(os.environ, TMP=tmp)
+        p = subprocess.Popen([out, 'world'], stdout=subprocess.PIPE, env=env)
+        self.assertEqual('hello --flag world\n', p.communicate()[0])
+        self.assertEqual(0, p.returncode)
+
+        if kind == 'tar':
+          env['TIN_UNTAR'] = '1'
+          p = subprocess.Popen([out], stdout=subprocess.PIPE, env=env)
+          payload = p.communicate()[0]
+          self.assertEqual(contents[-len(payload):], payload)
+          t = tarfile.open(fileobj=cStringIO.StringIO(payload))
+          self.assertEqual(['hello.sh', 'TIN/checksum'], t.getnames())
+
+          # tin.sh reads the offset without running the archive.
+          tin_sh = os.path.join(os.path.dirname(CREATE_PY), 'tin.sh')
+          p = subprocess.Popen(['bash', tin_sh, 'cat', out, 'hello.sh'],
+                               stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, 'w'))
+          self.assertEqual('#!/bin/sh\necho hello "$@"\n', p.communicate()[0])
+    finally:
+      shutil.rmtree(tmp)
+
+  def _RunConcurrently(self, out, run_tmp):
+    env = dict(os.environ, TMP=run_tmp, TIN_VERBOSE='1')
+    procs = [
+        subprocess.Popen([out], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, env=env)
+        for _ in xrange(8)]
+    all_stderr = []
+    for p in procs:
+      stdout, stderr = p.communicate()
+      self.assertEqual('hello\n', stdout)
+      self.assertEqual(0, p.returncode)
+      all_stderr.append(stderr)
+    all_stderr = ''.join(all_stderr)
+    self.assertEqual(1, all_stderr.count('extracting into'), all_stderr)
+
+    # Only the final dir is left; no private dirs or locks.
+    names = os.listdir(run_tmp)
+    self.assertEqual(1, len(names), names)
+    self.assertTrue(names[0].startswith('tin-'), names)
+    self.assertTrue(
+        os.path.isfile(os.path.join(run_tmp, names[0], 'TIN/checksum')))
+    return all_stderr
+
+  def testConcurrentExtract(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      script = os.path.join(tmp, 'hello.sh')
+      with open(script, 'w') as f:
+        f.write('#!/bin/sh\necho hello\n')
+      os.chmod(script, 0755)
+
+      for kind in ('tar', 'zip'):
+        out = os.path.join(tmp, 'hello-%s.tin' % kind)
+        create.main(['create', '--kind', kind, '-o', out],
+                    stdin=cStringIO.StringIO('x %s hello.sh\n' % script))
+
+        # The runs share a TMP, so they race to extract the same dir.
+        run_tmp = os.path.join(tmp, 'run-%s' % kind)
+        os.mkdir(run_tmp)
+        self._RunConcurrently(out, run_tmp)
+        extract_dir = os.path.join(run_tmp, os.listdir(run_tmp)[0])
+
+        # A lock left by a process that died is broken by exactly one of the
+        # waiters.
+        shutil.rmtree(extract_dir)
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        os.mkdir(extract_dir + '.lock')
+        with open(os.path.join(extract_dir + '.lock', 'pid'), 'w') as f:
+          f.write('%d\n' % dead.pid)
+        stderr = self._RunConcurrently(out, run_tmp)
+        self.assertTrue('removed stale lock' in stderr, stderr)
+    finally:
+      shutil.rmtree(tmp)
+
+  def testPreludeGc(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      run_tmp = os.path.join(tmp, 'run')
+      for name in ('tin-0123', 'tin-4567', 'tin-89ab.lock'):
+        os.makedirs(os.path.join(run_tmp, name))
+      # tin-4567 is in use by a running process, which spelled the path
+      # through a symlink.
+      os.symlink(run_tmp, os.path.join(tmp, 'link'))
+      in_use = os.path.join(tmp, 'link', 'tin-4567')
+      sleeper = subprocess.Popen(['sleep', '10'],
+                                 env=dict(os.environ, TIN_EXTRACT_DIR=in_use))
+      try:
+        extracted = []
+        for kind in ('tar', 'zip'):
+          # Different contents, so a different extract dir.
+          script = os.path.join(tmp, 'hello-%s.sh' % kind)
+          with open(script, 'w') as f:
+            f.write('#!/bin/sh\necho hello %s\n' % kind)
+          os.chmod(script, 0755)
+
+          out = os.path.join(tmp, 'hello-%s.tin' % kind)
+          create.main(['create', '--kind', kind, '-o', out],
+                      stdin=cStringIO.StringIO('x %s hello.sh\n' % script))
+
+          before = set(os.listdir(run_tmp))
+          env = dict(os.environ, TMP=run_tmp + '/', TIN_GC_MAX_BYTES='1')
+          p = subprocess.Popen([out], stdout=subprocess.PIPE, env=env)
+          self.assertEqual('hello %s\n' % kind, p.communicate()[0])
+          self.assertEqual(0, p.returncode)
+          extracted.append(sorted(set(os.listdir(run_tmp)) - before))
+      finally:
+        sleeper.kill()
+        sleeper.wait()
+
+      # The zip run removed the older dirs, except the one in use.  The lock
+      # and the dir it extracted were kept.
+      self.assertEqual(1, len(extracted[1]), extracted)
+      self.assertEqual(
+          sorted(['tin-4567', 'tin-89ab.lock', extracted[1][0]]),
+          sorted(os.listdir(run_tmp)))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCompile(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      os.mkdir(src)
+      with open(os.path.join(src, 'main.py'), 'w') as f:
+        f.write('#!%s\nimport lib\nprint lib.Greet()\n' % sys.executable)
+      os.chmod(os.path.join(src, 'main.py'), 0755)
+      with open(os.path.join(src, 'lib.py'), 'w') as f:
+        f.write('def Greet():\n  return "hello"\n')
+      spec = 'x %s/main.py main.py\n%s/lib.py lib.py\n' % (src, src)
+
+      for kind in ('tar', 'zip'):
+        for flags in ([], ['--no-source']):
+          out = os.path.join(tmp, 'main-%s%s.tin' % (kind, ''.join(flags)))
+          create.main(['create', '--kind', kind, '--compile', '-o', out] +
+                      flags, stdin=cStringIO.StringIO(spec))
+
+          run_tmp = os.path.join(tmp, 'run-%s%s' % (kind, ''.join(flags)))
+          os.mkdir(run_tmp)
+          env = dict(os.environ, TMP=run_tmp)
+          p = subprocess.Popen([out], stdout=subprocess.PIPE, env=env)
+          self.assertEqual('hello\n', p.communicate()[0])
+          self.assertEqual(0, p.returncode)
+
+          extract_dir = os.path.join(run_tmp, os.listdir(run_tmp)[0])
+          names = sorted(os.listdir(extract_dir))
+          if flags:
+            self.assertEqual(['TIN', 'lib.pyc', 'main.py'], names)
+            continue
+          self.assertEqual(['TIN', 'lib.py', 'lib.pyc', 'main.py'], names)
+          # The bytecode is only used if it has the extracted source's mtime.
+          with open(os.path.join(extract_dir, 'lib.pyc'), 'rb') as f:
+            header = f.read(8)
+          mtime = os.stat(os.path.join(extract_dir, 'lib.py')).st_mtime
+          self.assertEqual(int(mtime), struct.unpack('<I', header[4:])[0])
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCompileNeedsPython2(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      # Stands in for python3: prints its major version for any -c script.
+      python3 = os.path.join(tmp, 'python3')
+      with open(python3, 'w') as f:
+        f.write('#!/bin/sh\necho 3\n')
+      os.chmod(python3, 0755)
+      lib = os.path.join(tmp, 'lib.py')
+      open(lib, 'w').close()
+      entries = [(create.DATA_FILE, lib, 'lib.py')]
+      self.assertRaises(create.Error, create.CompileModules, entries, tmp,
+                        'tar', python=python3)
+      self.assertRaises(create.Error, create.CompileModules, entries, tmp,
+                        'tar', python=os.path.join(tmp, 'nope'))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCompressPolicy(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      files = {
+          'random.bin': os.urandom(20000),
+          'image.png': 'not really a png ' * 1000,
+          'text.txt': 'compressible ' * 1000,
+          'small.dat': os.urandom(100),
+      }
+      for name, contents in files.iteritems():
+        with open(os.path.join(tmp, name), 'w') as f:
+          f.write(contents)
+
+      def Level(name, policy):
+        return create.ChooseLevel(os.path.join(tmp, name), name, 9, policy)
+
+      self.assertEqual(9, Level('random.bin', 'uniform'))
+      self.assertEqual(0, Level('random.bin', 'auto'))
+      self.assertEqual(0, Level('image.png', 'auto'))
+      self.assertEqual(9, Level('text.txt', 'auto'))
+      self.assertEqual(9, Level('small.dat', 'auto'))  # not sampled
+
+      spec = ''.join('%s/%s %s\n' % (tmp, name, name) for name in sorted(files))
+      for kind in ('tar', 'zip'):
+        out = os.path.join(tmp, 'out-%s' % kind)
+        create.main(['create', '--no-prelude', '--kind', kind, '--report',
+                     '--compress-policy', 'auto', '--level', '6', '-o', out],
+                    stdin=cStringIO.StringIO(spec))
+
+        if kind == 'tar':
+          t = tarfile.open(out)
+          for name, contents in files.iteritems():
+            self.assertEqual(contents, t.extractfile(name).read())
+        else:
+          z = zipfile.ZipFile(out)
+          for name, contents in files.iteritems():
+            self.assertEqual(contents, z.read(name))
+          stored = sorted(i.filename for i in z.infolist()
+                          if i.compress_type == zipfile.ZIP_STORED)
+          self.assertEqual(['image.png', 'random.bin'], stored)
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCodecReport(self):
+    report = create.CodecReport()
+    report.Record('store', 100, 110, 0.5)
+    report.Record('deflate-9', 1000, 100, 1.0)
+    report.Record('deflate-9', 1000, 300, 1.0)
+    lines = report.Format().splitlines()
+    self.assertEqual(3, len(lines))
+    self.assertEqual(['deflate-9', '2', '2000', '400', '0.20', '2.000'],
+                     lines[1].split())
+
+  def testMaterializedNames(self):
+    entries = [
+        (create.EXECUTABLE_FILE, '', 'bin/main.py'),
+        (create.DATA_FILE, '', 'bin/util.py'),
+        (create.DATA_FILE, '', 'lib/util.py'),
+        (create.DATA_FILE, '', 'lib/util.pyc'),
+        (create.DATA_FILE, '', 'lib/data.txt'),
+        (create.DATA_FILE, '', 'native/__init__.py'),
+        (create.DATA_FILE, '', 'native/_speedups.so'),
+        # pkg/res has data, so all of pkg is extracted.
+        (create.DATA_FILE, '', 'pkg/__init__.py'),
+        (create.DATA_FILE, '', 'pkg/sub/__init__.py'),
+        (create.DATA_FILE, '', 'pkg/sub/res/logo.txt'),
+        (create.DATA_FILE, '', 'pure/__init__.py'),
+        (create.EXECUTABLE_FILE, '', 'bin/helper'),
+    ]
+    self.assertEqual(
+        ['bin/main.py', 'lib/util.py', 'lib/util.pyc', 'lib/data.txt',
+         'native/__init__.py', 'native/_speedups.so', 'pkg/__init__.py',
+         'pkg/sub/__init__.py', 'pkg/sub/res/logo.txt', 'bin/helper'],
+        create.MaterializedNames(entries))
+
+  def testLazyZip(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      os.mkdir(src)
+      files = {
+          'main.py': (
+              '#!%s\n'
+              'import lib, pkg.names\n'
+              'print lib.Greet(pkg.names.Get())\n' % sys.executable),
+          'lib.py': 'def Greet(name):\n  return "hello " + name\n',
+          'pkg/__init__.py': '',
+          # Opens a file relative to __file__, so it has to be on disk.
+          'pkg/names.py': (
+              'import os\n'
+              'def Get():\n'
+              '  path = os.path.join(os.path.dirname(__file__), "data.txt")\n'
+              '  return open(path).read().strip()\n'),
+          'pkg/data.txt': 'world\n',
+      }
+      os.mkdir(os.path.join(src, 'pkg'))
+      spec = []
+      for name, contents in sorted(files.iteritems()):
+        with open(os.path.join(src, name), 'w') as f:
+          f.write(contents)
+        spec.append('%s %s/%s %s\n' % ('x' if name == 'main.py' else 'f',
+                                        src, name, name))
+      os.chmod(os.path.join(src, 'main.py'), 0755)
+
+      out = os.path.join(tmp, 'main.tin')
+      create.main(['create', '--kind', 'zip', '--lazy', '-o', out],
+                  stdin=cStringIO.StringIO(''.join(spec)))
+
+      run_tmp = os.path.join(tmp, 'run')
+      os.mkdir(run_tmp)
+      env = dict(os.environ, TMP=run_tmp)
+      for _ in xrange(2):
+        p = subprocess.Popen([out], stdout=subprocess.PIPE, env=env)
+        self.assertEqual('hello world\n', p.communicate()[0])
+        self.assertEqual(0, p.returncode)
+
+      names = os.listdir(run_tmp)
+      self.assertEqual(1, len(names), names)
+      self.assertTrue(names[0].startswith('tin-lazy-'), names)
+      extract_dir = os.path.join(run_tmp, names[0])
+      # lib.py was imported from the archive.
+      self.assertEqual(['TIN', 'main.py', 'pkg'],
+                       sorted(os.listdir(extract_dir)))
+      self.assertEqual(['__init__.py', 'data.txt', 'names.py'],
+                       sorted(os.listdir(os.path.join(extract_dir, 'pkg'))))
+      self.assertEqual(['checksum', 'materialize'],
+                       sorted(os.listdir(os.path.join(extract_dir, 'TIN'))))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCacheDir(self):
+    tmp = tempfile.mkdtemp(prefix='create_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      os.mkdir(src)
+      for name in ('a.py', 'b.py'):
+        with open(os.path.join(src, name), 'w') as f:
+          f.write('# %s\n' % name * 100)
+      os.symlink('a.py', os.path.join(src, 'link.py'))
+      spec = ''.join('f %s/%s %s\n' % (src, name, name)
+                     for name in ('a.py', 'b.py', 'link.py'))
+      cache_dir = os.path.join(tmp, 'cache')
+
+      contents = []
+      for i in xrange(3):
+        if i == 2:
+          with open(os.path.join(src, 'b.py'), 'a') as f:
+            f.write('# changed\n')
+        out = os.path.join(tmp, 'out%d.tar.gz' % i)
+        create.main(['create', '--no-prelude', '--cache-dir', cache_dir,
+                     '-o', out], stdin=cStringIO.StringIO(spec))
+
+        t = tarfile.open(out)
+        self.assertEqual(['a.py', 'b.py', 'link.py', 'TIN/checksum'],
+                         t.getnames())
+        self.assertEqual('a.py', t.getmember('link.py').linkname)
+        contents.append(t.extractfile('b.py').read())
+        _, expected = create.Checksum(
+            [os.path.join(src, name) for name in ('a.py', 'b.py', 'link.py')])
+        self.assertEqual(expected, t.extractfile('TIN/checksum').read())
+
+        # GNU tar reads the concatenated members too.
+        self.assertEqual(0, subprocess.call(['tar', 'tzf', out],
+                                            stdout=open(os.devnull, 'w')))
+
+      self.assertEqual(contents[0], contents[1])
+      self.assertTrue(contents[2].endswith('# changed\n'))
+    finally:
+      shutil.rmtree(tmp)
+
   def testParseLines(self):
     print list(create.ParseLines([
       '/tmp/foo foo',
@@ -30,6 +505,14 @@ class TinTest(unittest.TestCase):
       'x /tmp/bin bin',
       ]))
 
+  def testReadEntries(self):
+    options, _ = create.CreateOptionsParser().parse_args(['-0'])
+    stdin = cStringIO.StringIO('x\0/tmp/my bin\0bin\0f\0/tmp/a\0a b\0')
+    self.assertEqual(
+        [(create.EXECUTABLE_FILE, '/tmp/my bin', 'bin'),
+         (create.DATA_FILE, '/tmp/a', 'a b')],
+        list(create.ReadEntries(options, stdin)))
+
 
 if __name__ == '__main__':
   unittest.main()
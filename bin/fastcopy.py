@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+"""
+fastcopy.py
+
+Copy file contents without pumping every byte through Python buffers, where
+the kernel lets us.  Methods, in the order 'auto' tries them:
+
+  reflink    FICLONE ioctl: share extents on a copy-on-write filesystem (btrfs,
+             xfs).  O(1) in the file size.
+  kernel     copy_file_range(), then sendfile(): the kernel copies the bytes.
+  userspace  read() / write() loop, like shutil.copy.
+
+Python 2 has no os.sendfile or os.copy_file_range, so they're called through
+ctypes.  If libc doesn't have them, the method is just unavailable.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import stat
+
+
+class Error(Exception):
+  pass
+
+
+METHODS = ('auto', 'reflink', 'kernel', 'userspace')
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# The largest chunk we ask the kernel for in one call.  copy_file_range and
+# sendfile may copy less; we loop until they return 0.
+_KERNEL_CHUNK = 1 << 30
+_USERSPACE_CHUNK = 1 << 20
+
+# errno values that mean "this method doesn't work for these two files", as
+# opposed to a real I/O error.
+_UNSUPPORTED = frozenset([
+    errno.ENOSYS, errno.EINVAL, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EBADF, errno.EPERM])
+
+
+def _LoadLibc():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  except OSError:
+    return None, None
+
+  copy_file_range = getattr(libc, 'copy_file_range', None)
+  if copy_file_range:
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint]
+
+  sendfile = getattr(libc, 'sendfile', None)
+  if sendfile:
+    sendfile.restype = ctypes.c_ssize_t
+    sendfile.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+
+  return copy_file_range, sendfile
+
+
+_copy_file_range, _sendfile = _LoadLibc()
+
+
+class _Unsupported(Exception):
+  """Raised when a method can't be used; the caller falls back."""
+
+
+def _Reflink(src_fd, dst_fd):
+  try:
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+  except IOError, e:
+    if e.errno in _UNSUPPORTED:
+      raise _Unsupported(e)
+    raise
+
+
+def _KernelLoop(func, make_args):
+  """Call copy_file_range or sendfile until EOF.
+
+  The file offsets of both fds advance, so if the first call fails, the next
+  method picks up at the same position.
+  """
+  first = True
+  while True:
+    n = func(*make_args())
+    if n < 0:
+      err = ctypes.get_errno()
+      # Only fall back if nothing has been copied yet.  Otherwise report the
+      # real error.
+      if first and err in _UNSUPPORTED:
+        raise _Unsupported(os.strerror(err))
+      raise OSError(err, os.strerror(err))
+    if n == 0:
+      return
+    first = False
+
+
+def _Kernel(src_fd, dst_fd):
+  if _copy_file_range:
+    try:
+      _KernelLoop(_copy_file_range,
+                  lambda: (src_fd, None, dst_fd, None, _KERNEL_CHUNK, 0))
+      return
+    except _Unsupported:
+      pass  # e.g. EXDEV on kernels before 5.3
+  if _sendfile:
+    _KernelLoop(_sendfile, lambda: (dst_fd, src_fd, None, _KERNEL_CHUNK))
+    return
+  raise _Unsupported('no copy_file_range or sendfile in libc')
+
+
+def _Userspace(src_fd, dst_fd):
+  while True:
+    chunk = os.read(src_fd, _USERSPACE_CHUNK)
+    if not chunk:
+      break
+    while chunk:
+      n = os.write(dst_fd, chunk)
+      chunk = chunk[n:]
+
+
+_FUNCS = {
+    'reflink': _Reflink,
+    'kernel': _Kernel,
+    'userspace': _Userspace,
+}
+
+
+def CopyFd(src_fd, dst_fd, method='auto'):
+  """Copy the contents of one open file to another.
+
+  Args:
+    src_fd: opened for reading, positioned at the start
+    dst_fd: opened for writing, empty
+    method: one of METHODS
+
+  Returns:
+    The name of the method that did the copy.
+
+  Raises:
+    Error if an explicitly requested method isn't supported.
+  """
+  if method == 'auto':
+    for name in ('reflink', 'kernel'):
+      try:
+        _FUNCS[name](src_fd, dst_fd)
+        return name
+      except _Unsupported:
+        pass
+    _Userspace(src_fd, dst_fd)
+    return 'userspace'
+
+  try:
+    _FUNCS[method](src_fd, dst_fd)
+  except _Unsupported, e:
+    raise Error('--copy-method=%s not supported here: %s' % (method, e))
+  return method
+
+
+def CopyFile(source, dest, method='auto', open_func=os.open):
+  """Like shutil.copy(): copy contents and permission bits, but not mtime.
+
+  Args:
+    open_func: called like os.open() to open both files.
+
+  Returns:
+    (name of the method that did the copy, number of bytes)
+  """
+  src_fd = open_func(source, os.O_RDONLY)
+  try:
+    src_st = os.fstat(src_fd)
+    mode = stat.S_IMODE(src_st.st_mode)
+    # Don't pass O_TRUNC until we know dest isn't the same file.
+    dst_fd = open_func(dest, os.O_WRONLY | os.O_CREAT, mode)
+    try:
+      dst_st = os.fstat(dst_fd)
+      if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+        raise Error('%r and %r are the same file' % (source, dest))
+      os.ftruncate(dst_fd, 0)
+      used = CopyFd(src_fd, dst_fd, method)
+      os.fchmod(dst_fd, mode)
+    finally:
+      os.close(dst_fd)
+  finally:
+    os.close(src_fd)
+  return used, src_st.st_size
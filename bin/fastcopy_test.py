@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+"""
+fastcopy_test.py: Tests for fastcopy.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import fastcopy  # module under test
+
+
+class FastCopyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='fastcopy_test')
+    self.src = os.path.join(self.tmp, 'src')
+    with open(self.src, 'w') as f:
+      f.write('hello\n' * 100000)
+    os.chmod(self.src, 0750)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Check(self, dest):
+    with open(dest) as f:
+      self.assertEqual('hello\n' * 100000, f.read())
+    self.assertEqual(0750, stat.S_IMODE(os.stat(dest).st_mode))
+
+  def testMethods(self):
+    for method in ('auto', 'kernel', 'userspace'):
+      dest = os.path.join(self.tmp, method)
+      used, num_bytes = fastcopy.CopyFile(self.src, dest, method)
+      print method, '->', used
+      self.assertEqual(600000, num_bytes)
+      self._Check(dest)
+
+  def testOverwrite(self):
+    dest = os.path.join(self.tmp, 'dest')
+    with open(dest, 'w') as f:
+      f.write('x' * 10000000)
+    fastcopy.CopyFile(self.src, dest)
+    self._Check(dest)
+
+  def testSameFile(self):
+    self.assertRaises(fastcopy.Error, fastcopy.CopyFile, self.src, self.src)
+    self._Check(self.src)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python2
+"""
+gzip_members.py
+
+Build gzip files out of independent members, and cache compressed members by
+content.
+
+A gzip file may be a concatenation of complete members, and gunzip, 'tar xzf',
+and Python's gzip module read it as one stream.  If each file in a tar is
+compressed as its own member (tar header, data, and padding), then a member can
+be copied from an old build into a new one without recompressing it.
+
+  GzipMemberWriter  a write-only file object, where Begin() / End() delimit
+                    members
+  MemberCache       compressed members on disk, keyed by a hash of whatever
+                    determines their bytes
+"""
+
+__author__ = 'Andy Chu'
+
+
+import hashlib
+import os
+import shutil
+import zlib
+
+
+class GzipMemberWriter(object):
+  """Compresses everything written between Begin() and End() as one member.
+
+  Usage:
+    w = GzipMemberWriter(open('out.tar.gz', 'wb'))
+    w.Begin()
+    w.write(...)
+    w.End()
+    w.CopyMember(open('cached-member.gz'))
+  """
+
+  def __init__(self, fileobj, level=9):
+    self.fileobj = fileobj
+    self.level = level
+    self.compressor = None
+    self.tee = None
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def Begin(self, tee=None, level=None):
+    """Start a member.
+
+    Args:
+      tee: optional file object that also gets the compressed bytes of this
+        member, e.g. a cache entry
+      level: zlib level for this member, overriding the writer's.  0 stores
+        the bytes in uncompressed deflate blocks, which is still valid gzip.
+    """
+    if self.compressor:
+      raise AssertionError('Member already started')
+    if level is None:
+      level = self.level
+    # wbits = 16 + MAX_WBITS means a gzip header and trailer.  The header has
+    # no name or timestamp, so the same input always gives the same bytes.
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                       16 + zlib.MAX_WBITS)
+    self.tee = tee
+
+  def _Out(self, data):
+    if data:
+      self.fileobj.write(data)
+      self.bytes_out += len(data)
+      if self.tee:
+        self.tee.write(data)
+
+  def write(self, data):
+    if not self.compressor:
+      raise AssertionError('write() outside of a member')
+    self.bytes_in += len(data)
+    self._Out(self.compressor.compress(data))
+
+  def flush(self):
+    pass  # only End() can flush a member
+
+  def tell(self):
+    # TarFile asks for the position when it's opened.
+    return self.bytes_in
+
+  def End(self):
+    self._Out(self.compressor.flush())
+    self.compressor = None
+    self.tee = None
+
+  def CopyMember(self, f):
+    """Copy an already compressed member from a file object."""
+    if self.compressor:
+      raise AssertionError('Member in progress')
+    start = self.fileobj.tell()
+    shutil.copyfileobj(f, self.fileobj, 1 << 20)
+    self.bytes_out += self.fileobj.tell() - start
+
+
+def CacheKey(*parts):
+  """Returns a hex key for the byte strings that determine a member."""
+  h = hashlib.sha1()
+  for part in parts:
+    h.update('%d:' % len(part))  # so ('ab', 'c') != ('a', 'bc')
+    h.update(part)
+  return h.hexdigest()
+
+
+class _PendingEntry(object):
+  """A cache entry being written.  Call Commit() or Abort()."""
+
+  def __init__(self, path):
+    self.path = path
+    self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    self.f = open(self.tmp_path, 'wb')
+
+  def write(self, data):
+    self.f.write(data)
+
+  def Commit(self):
+    self.f.close()
+    os.rename(self.tmp_path, self.path)
+
+  def Abort(self):
+    self.f.close()
+    os.unlink(self.tmp_path)
+
+
+class MemberCache(object):
+  """Compressed members in a directory, keyed by CacheKey().
+
+  Also keeps the total bytes and seconds spent compressing misses across runs,
+  in a file named 'rate', to estimate the time that hits saved.
+  """
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    self.num_hits = 0
+    self.num_misses = 0
+    self.hit_bytes = 0  # uncompressed
+    self.miss_bytes = 0
+    self.miss_sec = 0.0
+
+  def _Path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key[2:] + '.gz')
+
+  def Open(self, key):
+    """Returns an open file for the member, or None if it isn't cached."""
+    try:
+      return open(self._Path(key), 'rb')
+    except IOError:
+      return None
+
+  def Create(self, key):
+    path = self._Path(key)
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+      try:
+        os.mkdir(dir_path)
+      except OSError:
+        pass  # another build made it
+    return _PendingEntry(path)
+
+  def RecordHit(self, num_bytes):
+    self.num_hits += 1
+    self.hit_bytes += num_bytes
+
+  def RecordMiss(self, num_bytes, seconds):
+    self.num_misses += 1
+    self.miss_bytes += num_bytes
+    self.miss_sec += seconds
+
+  def _RatePath(self):
+    return os.path.join(self.cache_dir, 'rate')
+
+  def _LoadRate(self):
+    """Returns (bytes, seconds) compressed in all previous runs."""
+    try:
+      with open(self._RatePath()) as f:
+        num_bytes, sec = f.read().split()
+      return int(num_bytes), float(sec)
+    except (IOError, ValueError):
+      return 0, 0.0
+
+  def Save(self):
+    """Add this run's compression rate to the totals."""
+    if not self.num_misses:
+      return
+    num_bytes, sec = self._LoadRate()
+    path = self._RatePath()
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+      f.write('%d %r\n' % (num_bytes + self.miss_bytes, sec + self.miss_sec))
+    os.rename(tmp, path)
+
+  def Report(self):
+    """Returns a one-line summary of hits and estimated time saved."""
+    total = self.num_hits + self.num_misses
+    rate = 100.0 * self.num_hits / total if total else 0.0
+    num_bytes, sec = self._LoadRate()
+    num_bytes += self.miss_bytes
+    sec += self.miss_sec
+    if num_bytes:
+      saved = '%.2f seconds' % (self.hit_bytes * sec / num_bytes)
+    else:
+      saved = 'unknown'
+    return ('cache: %d of %d members hit (%.1f%%), %d bytes not recompressed, '
+            'est. time saved: %s' % (self.num_hits, total, rate,
+                                     self.hit_bytes, saved))
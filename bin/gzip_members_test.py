@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+"""
+gzip_members_test.py: Tests for gzip_members.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import gzip_members  # module under test
+
+
+class GzipMembersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='gzip_members_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testWriter(self):
+    out = cStringIO.StringIO()
+    w = gzip_members.GzipMemberWriter(out)
+    member = cStringIO.StringIO()
+    w.Begin(tee=member)
+    w.write('hello ' * 100)
+    w.End()
+    w.Begin()
+    w.write('world')
+    w.End()
+    w.CopyMember(cStringIO.StringIO(member.getvalue()))
+    self.assertEqual(len(out.getvalue()), w.bytes_out)
+
+    g = gzip.GzipFile(fileobj=cStringIO.StringIO(out.getvalue()))
+    self.assertEqual('hello ' * 100 + 'world' + 'hello ' * 100, g.read())
+
+    self.assertRaises(AssertionError, w.write, 'x')
+
+  def testMemberLevel(self):
+    out = cStringIO.StringIO()
+    w = gzip_members.GzipMemberWriter(out)
+    w.Begin(level=0)
+    w.write('a' * 10000)
+    w.End()
+    stored = w.bytes_out
+    self.assertTrue(stored > 10000, stored)
+    w.Begin()
+    w.write('a' * 10000)
+    w.End()
+    self.assertTrue(w.bytes_out - stored < 100, w.bytes_out - stored)
+
+    g = gzip.GzipFile(fileobj=cStringIO.StringIO(out.getvalue()))
+    self.assertEqual('a' * 20000, g.read())
+
+  def testCacheKey(self):
+    self.assertNotEqual(gzip_members.CacheKey('ab', 'c'),
+                        gzip_members.CacheKey('a', 'bc'))
+    self.assertEqual(40, len(gzip_members.CacheKey('a')))
+
+  def testCache(self):
+    cache = gzip_members.MemberCache(os.path.join(self.tmp, 'cache'))
+    key = gzip_members.CacheKey('foo')
+    self.assertEqual(None, cache.Open(key))
+
+    entry = cache.Create(key)
+    entry.write('abc')
+    entry.Abort()
+    self.assertEqual(None, cache.Open(key))
+
+    entry = cache.Create(key)
+    entry.write('abc')
+    entry.Commit()
+    self.assertEqual('abc', cache.Open(key).read())
+
+    cache.RecordMiss(1000, 2.0)
+    cache.RecordHit(500)
+    print cache.Report()
+    cache.Save()
+
+    cache = gzip_members.MemberCache(os.path.join(self.tmp, 'cache'))
+    cache.RecordHit(2000)
+    report = cache.Report()
+    print report
+    self.assertTrue('1 of 1 members hit (100.0%)' in report, report)
+    self.assertTrue('4.00 seconds' in report, report)
+
+
+if __name__ == '__main__':
+  unittest.main()
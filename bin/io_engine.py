@@ -0,0 +1,261 @@
+#!/usr/bin/env python2
+"""
+io_engine.py
+
+The file system operations that 'multi' actions perform, behind a common
+interface, so the way they're done can be swapped out.
+
+  PathEngine   Plain os.* calls on full paths.  The kernel walks every
+               component of the path on every call.
+  DirFdEngine  Keeps an LRU cache of open directory fds, and calls the *at()
+               variants (mkdirat, symlinkat, renameat, openat) with just the
+               last path component.  Deep trees don't pay for repeated path
+               walks.
+
+Python 2 has no dir_fd= arguments, so the *at() functions are called through
+ctypes.  lstat() and readlink() are still path-based in both engines.
+
+All methods raise OSError with the errno set, like the os module, so callers
+can check for ENOENT, EEXIST, etc.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import collections
+import ctypes
+import ctypes.util
+import os
+import threading
+
+import fastcopy
+
+
+class Error(Exception):
+  pass
+
+
+ENGINES = ('path', 'dirfd')
+
+
+class PathEngine(object):
+  """File system operations on full paths."""
+
+  def lstat(self, path):
+    return os.lstat(path)
+
+  def readlink(self, path):
+    return os.readlink(path)
+
+  def mkdir(self, path, mode=0777):
+    os.mkdir(path, mode)
+
+  def symlink(self, target, path):
+    os.symlink(target, path)
+
+  def rename(self, source, dest):
+    os.rename(source, dest)
+
+  def unlink(self, path):
+    os.unlink(path)
+
+  def open(self, path, flags, mode=0777):
+    """Like os.open(); returns an fd."""
+    return os.open(path, flags, mode)
+
+  def touch(self, path):
+    """Create an empty file, or truncate an existing one."""
+    os.close(self.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666))
+
+  def copy_file(self, source, dest, method='auto'):
+    """Returns (fastcopy method used, number of bytes)."""
+    return fastcopy.CopyFile(source, dest, method, open_func=self.open)
+
+  def close(self):
+    pass
+
+
+AT_FDCWD = -100
+
+
+def _LoadLibc():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  except OSError:
+    return None
+
+  c_int, c_char_p, c_uint = ctypes.c_int, ctypes.c_char_p, ctypes.c_uint
+  signatures = {
+      'openat': [c_int, c_char_p, c_int, c_uint],
+      'mkdirat': [c_int, c_char_p, c_uint],
+      'symlinkat': [c_char_p, c_int, c_char_p],
+      'renameat': [c_int, c_char_p, c_int, c_char_p],
+      'unlinkat': [c_int, c_char_p, c_int],
+  }
+  for name, argtypes in signatures.iteritems():
+    func = getattr(libc, name, None)
+    if func is None:
+      return None
+    func.argtypes = argtypes
+    func.restype = c_int
+  return libc
+
+
+_libc = _LoadLibc()
+
+
+def _Check(result, path):
+  if result < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), path)
+  return result
+
+
+class _FdEntry(object):
+  """An open directory fd and the number of threads using it."""
+
+  def __init__(self, fd):
+    self.fd = fd
+    self.users = 0
+    self.cached = True  # False after _Invalidate()
+
+
+_CWD_ENTRY = _FdEntry(AT_FDCWD)
+
+
+class DirFdEngine(PathEngine):
+  """File system operations relative to cached directory fds.
+
+  Thread-safe.  A cached fd that's in use by another thread is never closed;
+  if they're all in use, the cache temporarily grows past max_fds.
+  """
+
+  def __init__(self, max_fds=128):
+    if _libc is None:
+      raise Error("This libc doesn't have openat() and friends")
+    self.max_fds = max_fds
+    # normalized dir path -> _FdEntry
+    self.cache = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.num_opens = 0  # number of dir fds we had to open
+
+  def _Acquire(self, dir_path):
+    """Returns an _FdEntry for dir_path.  Must be followed by _Release()."""
+    if not dir_path:
+      return _CWD_ENTRY
+    with self.lock:
+      entry = self.cache.pop(dir_path, None)
+      if entry is None:
+        fd = _Check(_libc.openat(AT_FDCWD, dir_path,
+                                 os.O_RDONLY | os.O_DIRECTORY, 0), dir_path)
+        self.num_opens += 1
+        entry = _FdEntry(fd)
+        self._Evict()
+      entry.users += 1
+      self.cache[dir_path] = entry  # most recently used is last
+      return entry
+
+  def _Release(self, entry):
+    if entry is _CWD_ENTRY:
+      return
+    with self.lock:
+      entry.users -= 1
+      # It was invalidated while we were using it, so we close it.
+      if entry.users == 0 and not entry.cached:
+        os.close(entry.fd)
+
+  def _Evict(self):
+    """Close least recently used fds that aren't in use.  Holds the lock."""
+    excess = len(self.cache) + 1 - self.max_fds
+    if excess <= 0:
+      return
+    for dir_path, entry in self.cache.items():
+      if entry.users == 0:
+        del self.cache[dir_path]
+        os.close(entry.fd)
+        excess -= 1
+        if excess == 0:
+          break
+
+  def _Invalidate(self, path):
+    """Forget fds for path and everything under it, e.g. after a rename.
+
+    The fds stay valid, but they now refer to a different path.
+    """
+    path = os.path.normpath(path)
+    prefix = path + os.sep
+    with self.lock:
+      for dir_path in self.cache.keys():
+        if dir_path == path or dir_path.startswith(prefix):
+          entry = self.cache.pop(dir_path)
+          entry.cached = False
+          if entry.users == 0:
+            os.close(entry.fd)
+          # Otherwise _Release() closes it.
+
+  def _Split(self, path):
+    dir_path, name = os.path.split(os.path.normpath(path))
+    return dir_path, name
+
+  def mkdir(self, path, mode=0777):
+    dir_path, name = self._Split(path)
+    entry = self._Acquire(dir_path)
+    try:
+      _Check(_libc.mkdirat(entry.fd, name, mode), path)
+    finally:
+      self._Release(entry)
+
+  def symlink(self, target, path):
+    dir_path, name = self._Split(path)
+    entry = self._Acquire(dir_path)
+    try:
+      _Check(_libc.symlinkat(target, entry.fd, name), path)
+    finally:
+      self._Release(entry)
+
+  def rename(self, source, dest):
+    src_dir, src_name = self._Split(source)
+    dest_dir, dest_name = self._Split(dest)
+    src_entry = self._Acquire(src_dir)
+    try:
+      dest_entry = self._Acquire(dest_dir)
+      try:
+        _Check(_libc.renameat(src_entry.fd, src_name, dest_entry.fd,
+                              dest_name), source)
+      finally:
+        self._Release(dest_entry)
+    finally:
+      self._Release(src_entry)
+    self._Invalidate(source)
+    self._Invalidate(dest)  # if it replaced an empty dir
+
+  def unlink(self, path):
+    dir_path, name = self._Split(path)
+    entry = self._Acquire(dir_path)
+    try:
+      _Check(_libc.unlinkat(entry.fd, name, 0), path)
+    finally:
+      self._Release(entry)
+
+  def open(self, path, flags, mode=0777):
+    dir_path, name = self._Split(path)
+    entry = self._Acquire(dir_path)
+    try:
+      return _Check(_libc.openat(entry.fd, name, flags, mode), path)
+    finally:
+      self._Release(entry)
+
+  def close(self):
+    with self.lock:
+      for entry in self.cache.itervalues():
+        os.close(entry.fd)
+      self.cache.clear()
+
+
+def MakeEngine(name):
+  if name == 'path':
+    return PathEngine()
+  elif name == 'dirfd':
+    return DirFdEngine()
+  else:
+    raise AssertionError(name)
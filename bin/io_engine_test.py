@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+"""
+io_engine_test.py: Tests for io_engine.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import io_engine  # module under test
+
+
+class DirFdEngineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='io_engine_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Path(self, rel):
+    return os.path.join(self.tmp, rel)
+
+  def testOperations(self):
+    e = io_engine.DirFdEngine(max_fds=2)
+    e.mkdir(self._Path('a'))
+    e.mkdir(self._Path('a/b'))
+    e.touch(self._Path('a/b/file'))
+    e.symlink('file', self._Path('a/b/link'))
+    e.rename(self._Path('a/b/link'), self._Path('a/link2'))
+    e.copy_file(__file__, self._Path('a/copy'))
+    e.unlink(self._Path('a/b/file'))
+    e.close()
+
+    self.assertEqual(['b', 'copy', 'link2'],
+                     sorted(os.listdir(self._Path('a'))))
+    self.assertEqual([], os.listdir(self._Path('a/b')))
+    self.assertEqual('file', os.readlink(self._Path('a/link2')))
+
+  def testErrno(self):
+    e = io_engine.DirFdEngine()
+    try:
+      e.mkdir(self._Path('no/such/dir'))
+    except OSError, err:
+      self.assertEqual(errno.ENOENT, err.errno)
+    else:
+      self.fail('Expected OSError')
+
+    e.mkdir(self._Path('d'))
+    try:
+      e.mkdir(self._Path('d'))
+    except OSError, err:
+      self.assertEqual(errno.EEXIST, err.errno)
+    else:
+      self.fail('Expected OSError')
+
+  def testRenameInvalidates(self):
+    e = io_engine.DirFdEngine()
+    e.mkdir(self._Path('old'))
+    e.touch(self._Path('old/f1'))  # caches an fd for old/
+    e.rename(self._Path('old'), self._Path('new'))
+    e.mkdir(self._Path('old'))
+    e.touch(self._Path('old/f2'))  # must not land in new/
+    self.assertEqual(['f1'], os.listdir(self._Path('new')))
+    self.assertEqual(['f2'], os.listdir(self._Path('old')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -55,13 +55,29 @@ derefrencing it and copying contents.
 
 
 import errno
+import json
 import optparse
 import os
 import shutil
+import signal
+import socket
 import subprocess
 import stat
 import sys
 import tarfile
+import threading
+import time
+import traceback
+
+import fastcopy
+import io_engine
+import multi_client
+import op_stats
+import pgzip
+import stat_cache
+import stream_pairs
+import treespec
+import worker_pool
 
 
 class Error(Exception):
@@ -79,34 +95,186 @@ def RemoveDupes(pairs):
   return sorted(set(pairs), key=lambda p: p[1])
 
 
-def MultiTar(pairs, dest):
+def StreamPairs(pairs, ordered=False, sort_buffer=100000):
+  """Like RemoveDupes(), but yields pairs while the input is still being read.
+
+  Memory doesn't grow with the number of pairs as with RemoveDupes().  Only the
+  first pair for each destination is kept.
+
+  Args:
+    ordered: If true, sort by destination, spilling to temp files once there
+      are more than sort_buffer pairs.  Nothing is yielded until the input is
+      exhausted.
+  """
+  counter = stream_pairs.DupeCounter()
+  if ordered:
+    it = stream_pairs.ExternalSort(pairs, max_lines=sort_buffer,
+                                   counter=counter)
+  else:
+    it = stream_pairs.StreamDedupe(pairs, counter=counter)
+  for pair in it:
+    yield pair
+  if counter.num_dupes:
+    log('skipped %d duplicate destinations', counter.num_dupes)
+
+
+def MultiTar(pairs, dest, jobs=1, level=9, stats=None):
   """
   TODO: Does this handle symlinks and directories correctly?  Or does it
   dereference symlinks (which you don't want in general)?
+
+  Args:
+    jobs: If more than 1, compress blocks of the tar stream on this many
+      threads.  The output is a multi-member gzip file.
+    level: gzip compression level, 1-9
+    stats: optional OpStats to record each member in
   """
   # gzip compression.
-  t = tarfile.open(dest, mode='w:gz')
+  if jobs > 1:
+    gz = pgzip.ParallelGzipWriter(open(dest, 'wb'), level=level, jobs=jobs)
+    t = tarfile.open(mode='w|', fileobj=gz)
+  else:
+    gz = None
+    t = tarfile.open(dest, mode='w:gz', compresslevel=level)
 
   input_files = []
   for filename, archive_name in pairs:
     log('%s -> %s', filename, archive_name)
+    start = time.time()
+    offset = t.offset
     t.add(filename, arcname=archive_name)
+    if stats:
+      stats.Record('tar_add', filename, time.time() - start,
+                   t.offset - offset)
     input_files.append(filename)
   t.close()
+  if gz:
+    gz.close()
+    log('compressed %d bytes to %d on %d threads', gz.bytes_in, gz.bytes_out,
+        jobs)
 
   log('Wrote %s', dest)
   return 0  # exit code
 
 
-def MultiMv(pairs, dest_base):
-  """Move sets of any kind of file (including directories and devices.)"""
-  maker = DirMaker()
+def _CopyFileForMove(source, dest, engine, copy_method):
+  engine.copy_file(source, dest, copy_method)
+  shutil.copystat(source, dest)  # mv preserves mtimes
+
+
+def _CopyForMove(source, dest, engine, pool, copy_method, jobs, dirs):
+  """Copy a file, symlink, or directory tree, preserving modes and mtimes.
+
+  File contents are copied on the pool.
+
+  Args:
+    jobs: list to append file copy jobs to
+    dirs: list to append (source, dest) dirs to.  Their mtimes have to be set
+      after their contents are copied.
+  """
+  st = engine.lstat(source)
+  mode = st.st_mode
+  if stat.S_ISLNK(mode):
+    _MakeLink(engine.readlink(source), dest, True, engine)
+  elif stat.S_ISREG(mode):
+    jobs.append(pool.Submit(_CopyFileForMove, source, dest, engine,
+                            copy_method))
+  elif stat.S_ISDIR(mode):
+    try:
+      engine.mkdir(dest, stat.S_IMODE(mode))
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    dirs.append((source, dest))
+    for name in sorted(os.listdir(source)):
+      _CopyForMove(os.path.join(source, name), os.path.join(dest, name),
+                   engine, pool, copy_method, jobs, dirs)
+  else:
+    raise Error("Can only move files, dirs, and symlinks across devices: %r"
+                % source)
+
+
+def MoveAcrossDevices(pairs, engine, jobs=1, copy_method='auto'):
+  """Move pairs that rename() can't, because they're on different devices.
+
+  Everything is copied first, with file contents copied in parallel.  Then the
+  sources of the pairs that were copied successfully are removed in a batch.
 
+  Returns:
+    (number moved, number of errors)
+  """
+  pool = worker_pool.WorkerPool(jobs)
+  copies = []  # (source, dest, jobs, dirs)
   num_errors = 0
+  for source, dest in pairs:
+    copy_jobs = []
+    dirs = []
+    try:
+      _CopyForMove(source, dest, engine, pool, copy_method, copy_jobs, dirs)
+    except (IOError, OSError, Error), e:
+      log('Error copying %s -> %s: %s', source, dest, e)
+      num_errors += 1
+      continue
+    copies.append((source, dest, copy_jobs, dirs))
+
+  to_remove = []
+  for source, dest, copy_jobs, dirs in copies:
+    try:
+      for job in copy_jobs:
+        job.Wait()
+      # Children first, since copying into a dir changes its mtime.
+      for src_dir, dest_dir in reversed(dirs):
+        shutil.copystat(src_dir, dest_dir)
+    except (IOError, OSError, fastcopy.Error), e:
+      log('Error copying %s -> %s: %s', source, dest, e)
+      num_errors += 1
+    else:
+      to_remove.append((source, bool(dirs)))
+  pool.Join(raise_errors=False)  # errors were logged above
+
   num_ok = 0
+  for source, is_dir in to_remove:
+    try:
+      if is_dir:
+        shutil.rmtree(source)
+      else:
+        engine.unlink(source)
+    except OSError, e:
+      log('Error removing %s after copying it: %s', source, e)
+      num_errors += 1
+    else:
+      num_ok += 1
+  return num_ok, num_errors
 
-  input_files = []
-  i = 0
+
+def MultiMv(pairs, dest_base, plan_dirs=False, jobs=1, engine=None,
+            copy_method='auto'):
+  """Move sets of any kind of file (including directories and devices.)
+
+  Pairs on the same device are renamed.  Pairs that cross devices are
+  copied (with -j, in parallel) and then removed.
+  """
+  engine = engine or io_engine.PathEngine()
+  maker = DirMaker(engine=engine)
+  if plan_dirs:
+    MakePlannedDirs(maker, dest_base, [d for _, d in pairs], jobs=jobs)
+
+  num_errors = 0
+  num_ok = 0
+
+  # Device of each source and dest dir.  A file is almost always on the same
+  # device as its dir, so this takes one stat() per dir rather than per file.
+  dir_devices = {}
+
+  def _Device(path):
+    d = os.path.dirname(path)
+    dev = dir_devices.get(d)
+    if dev is None:
+      dev = os.stat(d or os.curdir).st_dev
+      dir_devices[d] = dev
+    return dev
+
+  cross_device = []
   for source, rel_dest in pairs:
     log('%s -> %s', source, rel_dest)
     source = os.path.abspath(source)
@@ -114,18 +282,31 @@ def MultiMv(pairs, dest_base):
     maker.mkdir(os.path.dirname(dest))
 
     try:
-      os.rename(source, dest)
+      if _Device(source) != _Device(dest):
+        cross_device.append((source, dest))
+        continue
+      engine.rename(source, dest)
     except OSError, e:
       # NOTE: This matches the behavior of GNU 'mv'.  If the file doesn't
       # exist, it prints an error and moves on, but exits with failure.
       if e.errno == errno.ENOENT:
         log('Error moving %s -> %s: %s', source, dest, e)
         num_errors += 1
+      elif e.errno == errno.EXDEV:
+        # e.g. a bind mount of the same file system
+        cross_device.append((source, dest))
       else:
         raise Error('Error moving %s -> %s: %s' % (source, dest, e))
     else:
       num_ok += 1
 
+  if cross_device:
+    log('copying %d items across devices', len(cross_device))
+    n_ok, n_errors = MoveAcrossDevices(cross_device, engine, jobs=jobs,
+                                       copy_method=copy_method)
+    num_ok += n_ok
+    num_errors += n_errors
+
   if num_errors:
     log('moved %d items; %d errors', num_ok, num_errors)
     return 1  # failure
@@ -160,7 +341,8 @@ def RelativePath(left, right):
   return '/'.join(rel_parts)
 
 
-def MultiLn(pairs, dest_base, force=True, relative=False):
+def MultiLn(pairs, dest_base, force=True, relative=False, plan_dirs=False,
+            jobs=1, engine=None):
   """Create links to sets of any kind of file (including devices.)
 
   Args:
@@ -169,52 +351,50 @@ def MultiLn(pairs, dest_base, force=True, relative=False):
        AppBuild files produce duplicate entries, e.g.
        polyweb/app_root/examples/container/AppBuild.
     relative: whether to maek relative symlinks
+    plan_dirs: whether to make all parent dirs up front
+    jobs: number of threads for making dirs
+    engine: an io_engine instance
   """
-  maker = DirMaker()
-
-  input_files = []
-  i = 0
+  engine = engine or io_engine.PathEngine()
+  maker = DirMaker(engine=engine)
+  if plan_dirs:
+    MakePlannedDirs(maker, dest_base, [d for _, d in pairs], jobs=jobs)
+
+  builder = LinkBuilder(engine, force=force, relative=relative)
+  # os.path.abspath() calls getcwd() every time.
+  cwd = os.getcwd()
   for source, rel_dest in pairs:
     # TODO: what if input contains ../../ ?
-    source = os.path.abspath(source)
+    source = JoinPath(cwd, source)
     dest = JoinPath(dest_base, rel_dest)
     maker.mkdir(os.path.dirname(dest))
-    #log('%s => %s', source, dest)
-
-    # TODO: handle --relative
-    # Algorithm:
-    #
-    # Turn both into absolute paths?  Using cwd?
-    # Then find common prefix
-    # Then calculate distance from common prefix to RHS (number of ../../../)
-    # prepend that to the relative part
-
-    if relative:
-      # source is absolute.  dest must be made absolute, since dest_base may
-      # have been relative.
-      dest = os.path.abspath(dest)
-      rel_source = RelativePath(source, dest)
-      _MakeLink(rel_source, dest, force=force)
-      log('%s -> %s', rel_source, dest)
-    else:
-      _MakeLink(source, dest, force=force)
-      log('%s -> %s', source, dest)
-    i += 1
 
-  log('linked %d files', i)
+    # source is absolute.  dest must be made absolute too, since dest_base
+    # may have been relative.
+    dest = JoinPath(cwd, dest)
+    target = builder.Link(source, dest)
+    log('%s -> %s', target, dest)
+
+  elapsed = time.time() - builder.start_time
+  log('linked %d files (%d by rename) in %.2f seconds (%.1f links/s)',
+      builder.num_links, builder.num_renamed, elapsed,
+      builder.num_links / elapsed if elapsed else 0.0)
   return 0  # exit code
 
 
-def MultiTouch(files, dest_base, force=True):
-  maker = DirMaker()
+def MultiTouch(files, dest_base, force=True, plan_dirs=False, jobs=1,
+               engine=None):
+  engine = engine or io_engine.PathEngine()
+  maker = DirMaker(engine=engine)
+  if plan_dirs:
+    MakePlannedDirs(maker, dest_base, files, jobs=jobs)
   for filename in files:
     path = JoinPath(dest_base, filename)
     log('%s', path)
     maker.mkdir(os.path.dirname(path))
     try:
-      with open(path, 'w') as f:
-        pass
-    except IOError, e:
+      engine.touch(path)
+    except (IOError, OSError), e:
       # e.g. if the file is already a directory
       log('fatal: %s', e)
       return 1
@@ -235,22 +415,109 @@ def JoinPath(base, rel):
   return os.path.normpath(os.path.join(base, rel))
 
 
-def _MakeLink(target, dest, force):
+def _MakeLink(target, dest, force, engine):
   # link to the same place as the source
   try:
-    os.symlink(target, dest)
+    engine.symlink(target, dest)
   except OSError, e:
-    print target, dest
     if e.errno == errno.EEXIST:
       if force:
-        os.remove(dest)
-        os.symlink(target, dest)
+        _ReplaceLink(target, dest, engine)
       else:
         raise Error("Can't overwrite symlink %s" % dest)
     else:
       raise
 
 
+def _ReplaceLink(target, dest, engine):
+  """Replace dest with a symlink atomically.
+
+  Unlike remove() then symlink(), there's no window where dest doesn't exist.
+  """
+  tmp = '%s.multi-tmp-%d' % (dest, os.getpid())
+  try:
+    engine.symlink(target, tmp)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+    engine.unlink(tmp)  # left over from a run that was killed
+    engine.symlink(target, tmp)
+  try:
+    engine.rename(tmp, dest)
+  except OSError:
+    engine.unlink(tmp)
+    raise
+
+
+class LinkBuilder(object):
+  """Makes many symlinks, e.g. for a symlink farm.
+
+  - With relative=True, the relative path between each pair of (source dir,
+    dest dir) is computed once, rather than per link.
+  - Existing links are replaced atomically.  Once one link has had to be
+    replaced, we assume we're rebuilding an existing farm and replace the next
+    one without trying symlink() first.
+  """
+
+  def __init__(self, engine, force=True, relative=False):
+    self.engine = engine
+    self.force = force
+    self.relative = relative
+    self.rel_dirs = {}  # (source dir, dest dir) -> relative prefix
+    self.replacing = False
+    self.num_links = 0
+    self.num_renamed = 0
+    self.start_time = time.time()
+
+  def _RelativeTarget(self, source, dest):
+    src_dir, name = os.path.split(source)
+    dest_dir = os.path.dirname(dest)
+    key = (src_dir, dest_dir)
+    prefix = self.rel_dirs.get(key)
+    if prefix is None:
+      # Use dummy basenames that can't match, and strip the source one off.
+      prefix = RelativePath(os.path.join(src_dir, 'S'),
+                            os.path.join(dest_dir, 'D'))[:-1]
+      self.rel_dirs[key] = prefix
+    return prefix + name
+
+  def Link(self, source, dest):
+    """Make dest a symlink to source.
+
+    Args:
+      source, dest: absolute, normalized paths
+
+    Returns:
+      The link target.
+    """
+    if self.relative:
+      target = self._RelativeTarget(source, dest)
+    else:
+      target = source
+
+    if source == dest:
+      # e.g. an absolute path alone on a line.  Replacing it would destroy it.
+      raise Error("Can't make %s a link to itself" % dest)
+
+    if self.replacing:
+      # Don't check whether dest exists; the rename() replaces it either way.
+      _ReplaceLink(target, dest, self.engine)
+      self.num_renamed += 1
+    else:
+      try:
+        self.engine.symlink(target, dest)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+        if not self.force:
+          raise Error("Can't overwrite symlink %s" % dest)
+        _ReplaceLink(target, dest, self.engine)
+        self.num_renamed += 1
+        self.replacing = True
+    self.num_links += 1
+    return target
+
+
 class CopyHandler(object):
   """Copy a tree of files, dirs, symlinks.
 
@@ -259,21 +526,123 @@ class CopyHandler(object):
          --dereference means to follow symlinks
   """
 
-  def __init__(self, dest_base, force=False):
+  def __init__(self, dest_base, force=False, jobs=1, copy_method='auto',
+               verbose=False, update=False, checksum=False, cache_path=None,
+               engine=None):
+    """
+    Args:
+      update: Skip files whose destination is already up to date.
+      checksum: With update, compare contents when the sizes match but
+        timestamps don't.
+      cache_path: With update, a StatCache file from previous runs.
+      engine: an io_engine instance
+    """
     self.dest_base = dest_base
-    self.maker = DirMaker()
+    self.engine = engine or io_engine.PathEngine()
+    self.maker = DirMaker(engine=self.engine)
     self.force = force
+    self.copy_method = copy_method
+    self.verbose = verbose
+    self.method_counts = {}  # fastcopy method name -> number of files
+    self.num_copied = 0
+    self.num_skipped = 0
+    self.bytes_copied = 0
+    self.lock = threading.Lock()  # protects the counters
+
+    self.update = update
+    self.checksum = checksum
+    if update:
+      self.cache = stat_cache.StatCache(cache_path)
+    else:
+      self.cache = None
+    # With -j, file contents are copied on worker threads.  Directories and
+    # symlinks are still made on the main thread, in input order, so a file's
+    # parent always exists before its copy is queued.
+    if jobs > 1:
+      self.pool = worker_pool.WorkerPool(jobs)
+    else:
+      self.pool = None
 
-  def OnFile(self, source, rel_dest):
+  def OnFile(self, source, rel_dest, st):
+    """
+    Args:
+      st: lstat() result for source
+    """
     # TODO: may not want to allow dest to be an absolute path.  This violates
     # an invariant.
 
     dest = JoinPath(self.dest_base, rel_dest)
     self.maker.mkdir(os.path.dirname(dest))
 
+    if self.pool:
+      # Even the up-to-date check is done on a worker, since --checksum reads
+      # both files.
+      self.pool.Submit(self._Copy, source, dest, st)
+    else:
+      self._Copy(source, dest, st)
+
+  def _UpToDate(self, source, dest, src_st, dest_st):
+    """Returns (up to date, digest of source or None)."""
+    digest = None
+    entry = self.cache.Lookup(source)
+    if entry:
+      if entry.SourceMatches(src_st):
+        if entry.DestMatches(dest, dest_st):
+          return True, entry.digest
+        digest = entry.digest  # source unchanged, so don't hash it again
+      elif entry.DestMatches(dest, dest_st) and not self.checksum:
+        # dest is what we copied last time, and the source changed since.
+        return False, None
+
+    if src_st.st_size != dest_st.st_size:
+      return False, digest
+
+    if self.checksum:
+      if digest is None:
+        digest = stat_cache.FileDigest(source)
+      return digest == stat_cache.FileDigest(dest), digest
+
+    # We don't copy mtimes, so a destination that's newer than the source is
+    # assumed to be a copy of it.  This is what 'cp --update' does.
+    return dest_st.st_mtime >= src_st.st_mtime, digest
+
+  def _Copy(self, source, dest, src_st):
+    """Returns True if the file was copied, False if it was up to date."""
+    if self.update:
+      source = os.path.abspath(source)
+      try:
+        dest_st = self.engine.lstat(dest)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        digest = None
+      else:
+        up_to_date, digest = self._UpToDate(source, dest, src_st, dest_st)
+        if up_to_date:
+          if self.verbose:
+            log('%s is up to date', dest)
+          self.cache.Record(source, dest, src_st, dest_st, digest)
+          with self.lock:
+            self.num_skipped += 1
+          return False
+
     # NOTE: Permission bits are copied, but not stuff like mod time, which is
     # what we want.
-    shutil.copy(source, dest)
+    try:
+      method, _ = self.engine.copy_file(source, dest, self.copy_method)
+    except fastcopy.Error, e:
+      raise Error(e.args[0])
+    if self.verbose:
+      log('%s -> %s (%s)', source, dest, method)
+
+    if self.update:
+      self.cache.Record(source, dest, src_st, self.engine.lstat(dest),
+                        digest)
+    with self.lock:
+      self.method_counts[method] = self.method_counts.get(method, 0) + 1
+      self.num_copied += 1
+      self.bytes_copied += src_st.st_size
+    return True
 
   def OnDir(self, source, rel_dest):
     # make the dir
@@ -281,12 +650,22 @@ class CopyHandler(object):
     self.maker.mkdir(dest)
 
   def OnLink(self, source, rel_dest):
-    target = os.readlink(source)
+    target = self.engine.readlink(source)
     dest = JoinPath(self.dest_base, rel_dest)
     self.maker.mkdir(os.path.dirname(dest))
 
     # Make the same symlink.
-    _MakeLink(target, dest, self.force)
+    _MakeLink(target, dest, self.force, self.engine)
+
+  def Flush(self):
+    """Wait for any copies still running on worker threads."""
+    try:
+      if self.pool:
+        self.pool.Join()
+    finally:
+      # Save what we copied so far, even if there was an error.
+      if self.cache:
+        self.cache.Save()
 
 
 def Dispatch(pairs, handler):
@@ -296,15 +675,17 @@ def Dispatch(pairs, handler):
   num_dirs = 0
   num_links = 0
 
+  start_time = time.time()
   for (source, dest) in pairs:
     # lstat so we don't dereference symlinks.
-    mode = os.lstat(source).st_mode
+    st = handler.engine.lstat(source)
+    mode = st.st_mode
     # NOTE: test for link has to come first.
     if stat.S_ISLNK(mode):
       handler.OnLink(source, dest)
       num_links += 1
     elif stat.S_ISREG(mode):
-      handler.OnFile(source, dest)
+      handler.OnFile(source, dest, st)
       num_files += 1
     elif stat.S_ISDIR(mode):
       handler.OnDir(source, dest)
@@ -312,10 +693,23 @@ def Dispatch(pairs, handler):
     else:
       raise Error("Can only handle files, dirs, and symlinks: %r" % source)
 
+  try:
+    handler.Flush()
+  except (IOError, OSError), e:
+    raise Error('Error copying: %s' % e)
+  elapsed = time.time() - start_time
+
   # TODO: put the action there
   log('processed %d files, %d dirs, %d links', num_files, num_dirs, num_links)
-  # TODO: fix
-  log('num mkdir syscalls: %d', handler.maker.num_mkdir)
+  log('copied %d files, skipped %d up to date', handler.num_copied,
+      handler.num_skipped)
+  num_bytes = handler.bytes_copied
+  log('%d bytes in %.2f seconds (%.1f MB/s, %.1f files/s)', num_bytes,
+      elapsed, num_bytes / elapsed / 1e6 if elapsed else 0.0,
+      handler.num_copied / elapsed if elapsed else 0.0)
+  for method, n in sorted(handler.method_counts.iteritems()):
+    log('copy method %s: %d files', method, n)
+  # mkdir() calls, like every other syscall, are counted by --stats-json.
 
 
 class DirMaker(object):
@@ -324,8 +718,9 @@ class DirMaker(object):
   doesn't have the dumb behavior of raising an error when the rightmost dir
   already exists.
   """
-  def __init__(self, dest='.'):
+  def __init__(self, dest='.', engine=None):
     self.dest = dest
+    self.engine = engine or io_engine.PathEngine()
     self.made = {}  # cache of dirs we already made
     self.num_mkdir = 0  # assuming os.mkdir() is one syscall
 
@@ -350,19 +745,147 @@ class DirMaker(object):
 
     try:
       self.num_mkdir += 1
-      os.mkdir(path)
+      self.engine.mkdir(path)
     except OSError, e:
       #print e
       if e.errno == errno.ENOENT:   # parent doesn't exist
         # recurse: this ensures the parent exists
         self.mkdir(os.path.dirname(path))
         self.num_mkdir += 1
-        os.mkdir(path)
+        self.engine.mkdir(path)
       elif e.errno == errno.EEXIST:  # already exists
         pass
       else:
         raise  # permission errors, etc.
 
+  def _MakeDirs(self, dirs, existed):
+    """mkdir() each of dirs in order.  Their parents must already exist.
+
+    Returns:
+      The number of mkdir() calls.
+    """
+    for path in dirs:
+      try:
+        self.engine.mkdir(path)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+        existed.add(path)
+    return len(dirs)
+
+  def Plan(self, dirs, jobs=1):
+    """Create all dirs up front.  After this, mkdir() on them is free.
+
+    Args:
+      dirs: From PlanDirs(): sorted, so parents come before children, and
+        the parent of each top-level dir already exists.
+      jobs: If more than 1, create independent subtrees on threads.
+
+    Returns:
+      The set of dirs that already existed.
+    """
+    # Group dirs by the top-level dir of their subtree.  The groups don't
+    # depend on each other.
+    dir_set = set(dirs)
+    groups = []
+    group_of = {}
+    for path in dirs:
+      parent = os.path.dirname(path)
+      if parent in dir_set:
+        group = group_of[parent]
+      else:
+        group = []
+        groups.append(group)
+      group.append(path)
+      group_of[path] = group
+    del group_of
+
+    existed = set()  # set.add() is atomic, so threads can share it
+    if jobs > 1 and len(groups) > 1:
+      pool = worker_pool.WorkerPool(jobs)
+      results = [pool.Submit(self._MakeDirs, g, existed) for g in groups]
+      pool.Join()
+      self.num_mkdir += sum(job.Wait() for job in results)
+    else:
+      for g in groups:
+        self.num_mkdir += self._MakeDirs(g, existed)
+
+    for path in dirs:
+      self.made[path] = True
+    return existed
+
+
+def PlanDirs(leaf_dirs, dest_base):
+  """Compute every directory that must exist for the given leaf dirs.
+
+  Args:
+    leaf_dirs: normalized parent dirs of each destination path
+    dest_base: the destination base dir; if it exists, we don't have to look
+      above it.
+
+  Returns:
+    (dirs, existing): the dirs to make, sorted so that each parent comes
+    before its children, and the set of dirs above them that are assumed to
+    exist.
+  """
+  existing = set(['', os.curdir, os.sep])
+  dest_base = os.path.normpath(dest_base)
+  if os.path.isdir(dest_base):
+    existing.add(dest_base)
+
+  dirs = set()
+  for path in leaf_dirs:
+    while path not in existing and path not in dirs:
+      dirs.add(path)
+      path = os.path.dirname(path)
+  # A parent is a prefix of its children, so it sorts first.
+  return sorted(dirs), existing
+
+
+def LazyMkdirCost(leaf_dirs, existing):
+  """How many mkdir() calls DirMaker.mkdir() would make on these leaf dirs.
+
+  It tries mkdir() on each new dir, and on ENOENT, recurses on the parent and
+  then tries again.  This simulates that without touching the disk.
+
+  Args:
+    existing: set of dirs that exist beforehand.  Modified.
+  """
+  made = set()
+  num_calls = [0]
+
+  def _Mkdir(path):
+    if path in made:
+      return
+    made.add(path)
+    num_calls[0] += 1
+    if path in existing:  # EEXIST
+      return
+    parent = os.path.dirname(path)
+    if parent != path and parent not in existing:  # ENOENT
+      _Mkdir(parent)
+      num_calls[0] += 1
+    existing.add(path)
+
+  for path in leaf_dirs:
+    _Mkdir(path)
+  return num_calls[0]
+
+
+def MakePlannedDirs(maker, dest_base, rel_paths, jobs=1):
+  """Make the parent dirs of all destinations in one top-down pass.
+
+  Since the whole treespec is known, this avoids the failed mkdir() calls that
+  DirMaker.mkdir() uses to discover missing parents.
+  """
+  leaf_dirs = [os.path.dirname(JoinPath(dest_base, p)) for p in rel_paths]
+  dirs, existing = PlanDirs(leaf_dirs, dest_base)
+  existed = maker.Plan(dirs, jobs=jobs)
+
+  lazy_cost = LazyMkdirCost(leaf_dirs, existing | existed)
+  log('planned %d dirs: %d mkdir syscalls, %d saved', len(dirs),
+      maker.num_mkdir, lazy_cost - maker.num_mkdir)
+
 
 def ContentLines(stdin):
   pairs = []
@@ -399,7 +922,9 @@ multi [options] cp DEST
        multi [options] mv DEST
        multi [options] ln DEST
 
-       multi [options] touch DEST\
+       multi [options] touch DEST
+
+       multi serve SOCKET   # run actions sent by multi_client.py\
 """
 # The first 3 take pairs.  The 'touch' takes a file of paths.
 # NOTE: Not advertising 'tar' because we generally don't want to use tar.
@@ -418,6 +943,40 @@ def Options():
   p.add_option(
       '-v', '--verbose', dest='verbose', action='store_true', default=False,
       help='Show verbose log messages')
+  p.add_option(
+      '--stream', dest='stream', action='store_true', default=False,
+      help='Act on each line as it is read, instead of reading, deduping, '
+           'and sorting the whole treespec first.  Memory use stays flat.')
+  p.add_option(
+      '--sort', dest='sort', action='store_true', default=False,
+      help='With --stream, still process pairs in destination order.  '
+           "Always on for 'tar'.")
+  p.add_option(
+      '-0', '--null', dest='null', action='store_true', default=False,
+      help='Read NUL-delimited type/source/dest fields instead of lines, so '
+           'paths may contain spaces.  See treespec.py.')
+  p.add_option(
+      '--treespec', dest='treespec', type='str', default=None, metavar='FILE',
+      help='Read a treespec compiled with treespec.py instead of stdin')
+  p.add_option(
+      '--stats-json', dest='stats_json', type='str', default=None,
+      metavar='FILE',
+      help='Write counts, bytes, and latency histograms for each kind of '
+           'file system operation, and the slowest paths, to FILE')
+  p.add_option(
+      '--io-engine', dest='io_engine', choices=io_engine.ENGINES,
+      default='path',
+      help="How to make file system calls: 'path' uses full paths, 'dirfd' "
+           'uses *at() calls relative to cached directory fds')
+  p.add_option(
+      '--plan-dirs', dest='plan_dirs', action='store_true', default=False,
+      help='Make all destination dirs in one sorted pass before acting on '
+           'any files.  With -j, independent subtrees are made in parallel.')
+  p.add_option(
+      '--sort-buffer', dest='sort_buffer', type='int', default=100000,
+      metavar='N',
+      help='With --stream --sort, the number of pairs to sort in memory '
+           'before spilling to a temp file')
 
   # This is used to control the help output.  The API is a little weird since
   # you pass p and then register with p.
@@ -427,12 +986,170 @@ def Options():
       help='Make symlinks with relative paths where possible (../.. '
            'target syntax)')
 
+  p.add_option_group(g)
+
+  g = optparse.OptionGroup(p, "Flags specific to 'cp'", '')
+  g.add_option(
+      '-j', '--jobs', dest='jobs', type='int', default=1,
+      help="Number of threads to copy file contents with, including 'mv' "
+           "across devices.  Also used by 'tar' for compression, and by "
+           '--plan-dirs with any action.')
+  g.add_option(
+      '--copy-method', dest='copy_method', choices=fastcopy.METHODS,
+      default='auto',
+      help='How to copy file contents: reflink (FICLONE), kernel '
+           '(copy_file_range/sendfile), userspace, or auto to try them in '
+           'that order')
+  g.add_option(
+      '-u', '--update', dest='update', action='store_true', default=False,
+      help="Skip files whose destination has the same size and isn't older "
+           'than the source, or matches what --stat-cache recorded')
+  g.add_option(
+      '--checksum', dest='checksum', action='store_true', default=False,
+      help='With --update, compare contents of files with the same size but '
+           'different timestamps')
+  g.add_option(
+      '--stat-cache', dest='stat_cache', type='str', default=None,
+      metavar='FILE',
+      help='With --update, remember the stat() results and digests of copied '
+           'files in FILE, so the next run can skip them with lstat() alone')
+
+  p.add_option_group(g)
+
+  g = optparse.OptionGroup(p, "Flags specific to 'tar'", '')
+  g.add_option(
+      '--level', dest='level', type='int', default=9,
+      help='gzip compression level, 1 (fastest) to 9 (smallest)')
+
   p.add_option_group(g)
   return p
 
 
-def main(argv):
-  """Returns an exit code."""
+class _FrameWriter(object):
+  """A file object that sends each write() to the client as a frame."""
+
+  def __init__(self, sock, tag):
+    self.sock = sock
+    self.tag = tag
+    self.lock = threading.Lock()  # copy threads log too
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    with self.lock:
+      multi_client.WriteFrame(self.sock, self.tag, data)
+
+  def flush(self):
+    pass
+
+
+def HandleRequest(conn):
+  """Run one request from multi_client.py on a connected socket.
+
+  The action runs in the client's cwd, reading the client's stdin, with stdout
+  and stderr sent back to it.  Returns the exit status, or None if the client
+  sent nothing (e.g. another server checking if this one is alive).
+  """
+  f = conn.makefile('rb')
+  line = f.readline()
+  if not line:
+    return None
+  request = json.loads(line)
+  # JSON strings decode to unicode, but paths are byte strings everywhere else.
+  argv = [arg.encode('utf-8') for arg in request['argv']]
+  cwd = request['cwd'].encode('utf-8')
+
+  saved = sys.stdout, sys.stderr
+  sys.stdout = _FrameWriter(conn, multi_client.STDOUT)
+  sys.stderr = _FrameWriter(conn, multi_client.STDERR)
+  old_cwd = os.getcwd()
+  try:
+    try:
+      os.chdir(cwd)
+      if argv[1:2] == ['serve']:
+        raise Error("Can't run 'serve' in a server")
+      status = main(argv, stdin=f) or 0
+    except Error, e:
+      if e.args:
+        log('%s', e.args[0])
+      status = 1
+    except SystemExit, e:  # optparse exits on --help and bad flags
+      status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+      sys.stderr.write(traceback.format_exc())
+      status = 1
+  finally:
+    os.chdir(old_cwd)
+    sys.stdout, sys.stderr = saved
+
+  multi_client.WriteFrame(conn, multi_client.EXIT, str(status))
+  return status
+
+
+def _Listen(sock_path):
+  if os.path.exists(sock_path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(sock_path)
+    except socket.error:
+      os.unlink(sock_path)  # stale socket from a server that died
+    else:
+      raise Error('A server is already listening on %s' % sock_path)
+    finally:
+      probe.close()
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  listener.bind(sock_path)
+  listener.listen(16)
+  return listener
+
+
+def Serve(sock_path, max_requests=None):
+  """Run requests from multi_client.py, one at a time.
+
+  One at a time because each request changes the process's cwd, stdout, and
+  stderr.  Actions can still use -j.
+
+  Args:
+    max_requests: stop after this many requests (for tests)
+  """
+  listener = _Listen(sock_path)
+  log('Listening on %s', sock_path)
+  num_requests = 0
+  try:
+    while max_requests is None or num_requests < max_requests:
+      conn, _ = listener.accept()
+      try:
+        start_time = time.time()
+        status = HandleRequest(conn)
+        if status is None:
+          continue
+        log('request %d: status %d in %.3f seconds', num_requests, status,
+            time.time() - start_time)
+      except (socket.error, ValueError, KeyError), e:
+        # A client that went away or sent garbage shouldn't stop the server.
+        log('request %d failed: %s', num_requests, e)
+      finally:
+        conn.close()
+      num_requests += 1
+  except KeyboardInterrupt:
+    pass
+  finally:
+    listener.close()
+    os.unlink(sock_path)
+  return 0
+
+
+def _RaiseInterrupt(signum, frame):
+  raise KeyboardInterrupt
+
+
+def main(argv, stdin=None):
+  """Returns an exit code.
+
+  Args:
+    stdin: file to read the treespec from, instead of sys.stdin
+  """
   (opts, argv) = Options().parse_args(argv)
 
   try:
@@ -440,6 +1157,15 @@ def main(argv):
   except IndexError:
     raise Error('Action required')
 
+  if action == 'serve':
+    try:
+      sock_path = argv[2]
+    except IndexError:
+      raise Error('Socket path required')
+    # Background jobs ignore SIGINT, so also clean up on 'kill'.
+    signal.signal(signal.SIGTERM, _RaiseInterrupt)
+    return Serve(sock_path)
+
   # Check before we read from stdin.
   if action not in ('tar', 'cp', 'mv', 'ln', 'touch'):
     raise Error('Invalid action %r' % action)
@@ -452,12 +1178,100 @@ def main(argv):
   # Since there are so few options, we can validate these manually.
   if opts.relative and action != 'ln':
     raise Error("-r / --relative can't be used with %r" % action)
+  if opts.jobs < 1:
+    raise Error('-j / --jobs must be at least 1')
+  if (opts.jobs != 1 and action not in ('cp', 'mv', 'tar') and
+      not opts.plan_dirs):
+    raise Error("-j / --jobs can only be used with 'cp', 'mv', 'tar', or "
+                '--plan-dirs')
+  if not 1 <= opts.level <= 9:
+    raise Error('--level must be between 1 and 9')
+  if opts.level != 9 and action != 'tar':
+    raise Error("--level can't be used with %r" % action)
+  if opts.plan_dirs and (opts.stream or action == 'tar'):
+    raise Error("--plan-dirs can't be used with --stream or 'tar'")
+  if opts.copy_method != 'auto' and action not in ('cp', 'mv'):
+    raise Error("--copy-method can't be used with %r" % action)
+  if opts.update and action != 'cp':
+    raise Error("-u / --update can't be used with %r" % action)
+  if (opts.checksum or opts.stat_cache) and not opts.update:
+    raise Error('--checksum and --stat-cache require --update')
+
+  if opts.sort and not opts.stream:
+    raise Error('--sort requires --stream')
+  if opts.null and opts.treespec:
+    raise Error("-0 and --treespec can't be used together")
+  if opts.stream and (opts.null or opts.treespec):
+    raise Error("--stream can't be used with -0 or --treespec")
+
+  try:
+    engine = io_engine.MakeEngine(opts.io_engine)
+  except io_engine.Error, e:
+    raise Error(e.args[0])
+  if opts.stats_json:
+    stats = op_stats.OpStats()
+    engine = op_stats.StatsEngine(engine, stats)
+  else:
+    stats = None
+
+  try:
+    return RunAction(opts, action, dest_base, engine, stats,
+                     stdin or sys.stdin)
+  finally:
+    engine.close()
+    # Write stats even if the action failed, to see where it got to.
+    if stats:
+      stats.WriteJson(opts.stats_json)
+      log('Wrote stats to %s', opts.stats_json)
+
+
+def _ReadRecords(opts, stdin):
+  """Returns a list of (type, source, dest) for -0 or --treespec, or None."""
+  try:
+    if opts.treespec:
+      spec = treespec.Treespec(opts.treespec)
+      try:
+        # Already sorted by dest and deduped.
+        return list(spec.SortedRecords())
+      finally:
+        spec.close()
+    if opts.null:
+      return list(treespec.ParseNul(stdin))
+  except treespec.Error, e:
+    raise Error(e.args[0])
+  return None
+
+
+def RunAction(opts, action, dest_base, engine, stats, stdin):
+  """Read the treespec on stdin and run an action.  Returns an exit code."""
+  if opts.stream:
+    # Don't use the file iterator, which reads ahead in large blocks.  We want
+    # to start on each line as soon as it arrives.
+    lines = iter(stdin.readline, '')
+  else:
+    lines = stdin
+  records = _ReadRecords(opts, stdin)
 
   if action == 'touch':
-    files = list(ContentLines(sys.stdin))
-    return MultiTouch(files, dest_base, force=True)
+    if records is not None:
+      files = [dest for _, _, dest in records]
+    else:
+      files = ContentLines(lines)
+      if not opts.stream:
+        files = list(files)
+    return MultiTouch(files, dest_base, force=True, plan_dirs=opts.plan_dirs,
+                      jobs=opts.jobs, engine=engine)
+  elif opts.treespec:
+    pairs = [(src, dest) for _, src, dest in records]
+  elif opts.null:
+    pairs = RemoveDupes([(src, dest) for _, src, dest in records])
+  elif opts.stream:
+    # The tar member order should be deterministic.
+    ordered = opts.sort or action == 'tar'
+    pairs = StreamPairs(MakePairs(lines), ordered=ordered,
+                        sort_buffer=opts.sort_buffer)
   else:
-    pairs = list(MakePairs(sys.stdin))
+    pairs = list(MakePairs(lines))
     pairs = RemoveDupes(pairs)
 
   # TODO:
@@ -466,22 +1280,30 @@ def main(argv):
   #   - for --overwrite, --no-dereference, etc.
   # - should there be an --external or --exec flag?  Not sure we really need
   #   it.  What options would we use?
-  extra_argv = argv[4:]
 
   if action == 'tar':
-    return MultiTar(pairs, dest_base)
+    return MultiTar(pairs, dest_base, jobs=opts.jobs, level=opts.level,
+                    stats=stats)
 
   elif action == 'mv':
-    return MultiMv(pairs, dest_base)
+    return MultiMv(pairs, dest_base, plan_dirs=opts.plan_dirs, jobs=opts.jobs,
+                   engine=engine, copy_method=opts.copy_method)
 
   elif action == 'ln':
-    return MultiLn(pairs, dest_base, force=True, relative=opts.relative)
+    return MultiLn(pairs, dest_base, force=True, relative=opts.relative,
+                   plan_dirs=opts.plan_dirs, jobs=opts.jobs, engine=engine)
 
   elif action == 'cp':
     # TODO: parse --force.  cp has it true by default, and has --no-clobber to
     # turn it off.  Hm.  I think maybe mine should be false.
     # Have to test 2 cases: symlinks and files.
-    copy = CopyHandler(dest_base, force=True)
+    copy = CopyHandler(dest_base, force=True, jobs=opts.jobs,
+                       copy_method=opts.copy_method, verbose=opts.verbose,
+                       update=opts.update, checksum=opts.checksum,
+                       cache_path=opts.stat_cache, engine=engine)
+    if opts.plan_dirs:
+      MakePlannedDirs(copy.maker, dest_base, [d for _, d in pairs],
+                      jobs=opts.jobs)
     return Dispatch(pairs, copy)
 
   else:
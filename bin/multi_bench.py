@@ -0,0 +1,372 @@
+#!/usr/bin/env python2
+"""
+multi_bench.py
+
+Benchmark 'multi' actions and ftree.ListTree on synthetic trees, and compare
+against a saved baseline.
+
+Usage:
+  multi_bench.py --out new.json                     # run and save
+  multi_bench.py --out new.json --baseline old.json # also compare
+
+Tree shapes:
+
+  small     many small files, 100 to a dir
+  large     a few large files
+  deep      long chains of nested dirs, with a file at each level
+  symlinks  mostly symlinks to a few files
+
+Each (shape, action) result records files/s, MB/s, and the number of calls of
+each kind of file system operation, counted with op_stats.StatsEngine.  The
+multi actions are run in-process, with their per-file log output discarded.
+Each is run --repeat times and the fastest run is kept, since timings of small
+file operations are noisy.
+
+Exits 1 if any result's files/s dropped by more than --threshold relative to
+the baseline.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import io_engine
+import multi
+import op_stats
+
+
+class Error(Exception):
+  pass
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, 'multi_bench:', msg
+
+
+SHAPES = ('small', 'large', 'deep', 'symlinks')
+ACTIONS = ('cp', 'mv', 'ln', 'touch', 'tar', 'ftree')
+
+# Runs faster than this are dominated by noise, so they're never reported as
+# regressions.
+MIN_SEC = 0.05
+
+# Bumped when results are no longer comparable with older baselines.
+FORMAT_VERSION = 1
+
+
+def _WriteFile(path, size):
+  with open(path, 'wb') as f:
+    # Not compressible to nothing, so tar has some work to do.
+    block = ''.join(chr(i % 251) for i in xrange(min(size, 1 << 16)))
+    remaining = size
+    while remaining:
+      chunk = block[:remaining]
+      f.write(chunk)
+      remaining -= len(chunk)
+
+
+def MakeTree(root, shape, scale=1.0):
+  """Create a synthetic tree under root.
+
+  Returns:
+    A list of relative paths of the files and symlinks in it, in sorted order.
+  """
+  def n(count):
+    return max(1, int(count * scale))
+
+  rel_paths = []
+  if shape == 'small':
+    for i in xrange(n(5000)):
+      rel_paths.append(('d%03d/f%05d' % (i // 100, i), 1024))
+  elif shape == 'large':
+    for i in xrange(n(4)):
+      rel_paths.append(('big%d' % i, 16 << 20))
+  elif shape == 'deep':
+    for branch in xrange(n(20)):
+      parts = ['b%02d' % branch]
+      for depth in xrange(30):
+        parts.append('l%02d' % depth)
+        rel_paths.append(('/'.join(parts) + '/file', 512))
+  elif shape == 'symlinks':
+    for i in xrange(10):
+      rel_paths.append(('target/t%d' % i, 4096))
+  else:
+    raise Error('Invalid shape %r' % shape)
+
+  for rel_path, size in rel_paths:
+    path = os.path.join(root, rel_path)
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+      os.makedirs(dir_path)
+    _WriteFile(path, size)
+  result = [rel_path for rel_path, _ in rel_paths]
+
+  if shape == 'symlinks':
+    for i in xrange(n(5000)):
+      rel_path = 'links/d%02d/l%05d' % (i // 200, i)
+      path = os.path.join(root, rel_path)
+      dir_path = os.path.dirname(path)
+      if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+      os.symlink('../../target/t%d' % (i % 10), path)
+      result.append(rel_path)
+
+  result.sort()
+  return result
+
+
+def _TreeBytes(root, rel_paths):
+  return sum(os.lstat(os.path.join(root, p)).st_size for p in rel_paths)
+
+
+class _Quiet(object):
+  """Discard multi's per-file log lines while an action runs."""
+
+  def __enter__(self):
+    self.saved = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+
+  def __exit__(self, *args):
+    sys.stderr.close()
+    sys.stderr = self.saved
+
+
+def RunAction(action, src, rel_paths, work_dir, jobs=1, engine_name='path'):
+  """Run one action on the tree at src.
+
+  Returns:
+    (seconds, OpStats)
+  """
+  stats = op_stats.OpStats()
+  engine = op_stats.StatsEngine(io_engine.MakeEngine(engine_name), stats)
+  dest = os.path.join(work_dir, 'dest')
+  pairs = [(os.path.join(src, p), p) for p in rel_paths]
+
+  if action == 'mv':
+    # Move a copy, so the source tree survives for the other actions.
+    staging = os.path.join(work_dir, 'staging')
+    shutil.copytree(src, staging, symlinks=True)
+    pairs = [(os.path.join(staging, p), p) for p in rel_paths]
+
+  start = time.time()
+  try:
+    with _Quiet():
+      if action == 'cp':
+        handler = multi.CopyHandler(dest, force=True, jobs=jobs, engine=engine)
+        multi.Dispatch(pairs, handler)
+      elif action == 'mv':
+        status = multi.MultiMv(pairs, dest, jobs=jobs, engine=engine)
+      elif action == 'ln':
+        status = multi.MultiLn(pairs, dest, engine=engine)
+      elif action == 'touch':
+        status = multi.MultiTouch(rel_paths, dest, engine=engine)
+      elif action == 'tar':
+        status = multi.MultiTar(pairs, dest + '.tar.gz', jobs=jobs,
+                                stats=stats)
+      else:
+        raise AssertionError(action)
+  finally:
+    engine.close()
+  elapsed = time.time() - start
+
+  if action != 'cp' and status != 0:
+    raise Error('%s failed with status %d' % (action, status))
+  return elapsed, stats
+
+
+def RunListTree(src):
+  # ftree needs docopt, which isn't always installed.
+  try:
+    import ftree
+  except ImportError, e:
+    return None, str(e)
+  start = time.time()
+  ftree.ListTree(src)
+  return time.time() - start, None
+
+
+def Benchmark(tmp_dir, shapes=SHAPES, actions=ACTIONS, scale=1.0, jobs=1,
+              engine_name='path', repeat=1):
+  """Returns a dict of results, keyed by 'shape/action'."""
+  results = {}
+  for shape in shapes:
+    root = tempfile.mkdtemp(prefix='multi_bench_%s_' % shape, dir=tmp_dir)
+    try:
+      src = os.path.join(root, 'src')
+      rel_paths = MakeTree(src, shape, scale=scale)
+      num_bytes = _TreeBytes(src, rel_paths)
+      log('%s: %d files, %d bytes', shape, len(rel_paths), num_bytes)
+
+      for action in actions:
+        key = '%s/%s' % (shape, action)
+        times = []
+        for _ in xrange(repeat):
+          if action == 'ftree':
+            elapsed, skipped = RunListTree(src)
+            if skipped:
+              break
+            ops = {}
+          else:
+            work_dir = os.path.join(root, action)
+            os.mkdir(work_dir)
+            elapsed, stats = RunAction(action, src, rel_paths, work_dir,
+                                       jobs=jobs, engine_name=engine_name)
+            shutil.rmtree(work_dir)
+            ops = dict((op, c.count) for op, c in stats.ops.iteritems())
+          times.append(elapsed)
+        if not times:
+          log('%s: skipped (%s)', key, skipped)
+          results[key] = {'skipped': skipped}
+          continue
+
+        # Only actions that read file contents are measured in MB/s.
+        moved_bytes = num_bytes if action in ('cp', 'mv', 'tar') else 0
+        elapsed = max(min(times), 1e-6)
+        r = {
+            'files': len(rel_paths),
+            'bytes': moved_bytes,
+            'sec': elapsed,
+            'files_per_sec': len(rel_paths) / elapsed,
+            'mb_per_sec': moved_bytes / elapsed / 1e6,
+            'syscalls': ops,
+        }
+        log('%-16s %8.1f files/s %8.1f MB/s %8d syscalls', key,
+            r['files_per_sec'], r['mb_per_sec'], sum(ops.itervalues()))
+        results[key] = r
+    finally:
+      shutil.rmtree(root)
+  return results
+
+
+def Compare(old, new, threshold):
+  """Compare two sets of results.
+
+  Returns:
+    A list of (key, old files/s, new files/s, ratio, is_regression), sorted by
+    key, for results present and not skipped in both.  Results that took less
+    than MIN_SEC either time are never regressions.
+  """
+  rows = []
+  for key in sorted(set(old) & set(new)):
+    o, n = old[key], new[key]
+    if 'skipped' in o or 'skipped' in n:
+      continue
+    ratio = n['files_per_sec'] / o['files_per_sec']
+    too_fast = min(o['sec'], n['sec']) < MIN_SEC
+    rows.append((key, o['files_per_sec'], n['files_per_sec'], ratio,
+                 ratio < 1.0 - threshold and not too_fast))
+  return rows
+
+
+def Options():
+  """Returns an option parser instance."""
+  p = optparse.OptionParser('multi_bench.py [options]')
+  p.add_option(
+      '--out', dest='out', type='str', default=None, metavar='FILE',
+      help='Write results as JSON to FILE')
+  p.add_option(
+      '--baseline', dest='baseline', type='str', default=None,
+      metavar='FILE',
+      help='Compare against results previously written with --out')
+  p.add_option(
+      '--threshold', dest='threshold', type='float', default=0.2,
+      help='Report a regression when files/s drops by more than this '
+           'fraction (default 0.2)')
+  p.add_option(
+      '--shapes', dest='shapes', type='str', default=','.join(SHAPES),
+      help='Comma-separated tree shapes: %s' % ', '.join(SHAPES))
+  p.add_option(
+      '--actions', dest='actions', type='str', default=','.join(ACTIONS),
+      help='Comma-separated actions: %s' % ', '.join(ACTIONS))
+  p.add_option(
+      '--scale', dest='scale', type='float', default=1.0,
+      help='Multiply the number of files in each tree by this')
+  p.add_option(
+      '--repeat', dest='repeat', type='int', default=3,
+      help='Run each action this many times and keep the fastest')
+  p.add_option(
+      '-j', '--jobs', dest='jobs', type='int', default=1,
+      help='Passed to cp, mv, and tar')
+  p.add_option(
+      '--io-engine', dest='io_engine', type='choice',
+      choices=io_engine.ENGINES, default='path',
+      help='I/O engine for the multi actions: %s' %
+           ', '.join(io_engine.ENGINES))
+  p.add_option(
+      '--tmp-dir', dest='tmp_dir', type='str', default=None,
+      help='Where to create the trees.  The file system matters!')
+  return p
+
+
+def main(argv):
+  """Returns an exit code."""
+  (opts, argv) = Options().parse_args(argv)
+
+  shapes = opts.shapes.split(',')
+  actions = opts.actions.split(',')
+  for shape in shapes:
+    if shape not in SHAPES:
+      raise Error('Invalid shape %r' % shape)
+  for action in actions:
+    if action not in ACTIONS:
+      raise Error('Invalid action %r' % action)
+  if opts.repeat < 1:
+    raise Error('--repeat must be at least 1')
+
+  baseline = None
+  if opts.baseline:
+    with open(opts.baseline) as f:
+      baseline = json.load(f)
+    if baseline.get('version') != FORMAT_VERSION:
+      raise Error('%s has format version %r, expected %d' %
+                  (opts.baseline, baseline.get('version'), FORMAT_VERSION))
+
+  results = Benchmark(opts.tmp_dir, shapes=shapes, actions=actions,
+                      scale=opts.scale, jobs=opts.jobs,
+                      engine_name=opts.io_engine, repeat=opts.repeat)
+  doc = {
+      'version': FORMAT_VERSION,
+      'params': {'scale': opts.scale, 'jobs': opts.jobs,
+                 'io_engine': opts.io_engine},
+      'results': results,
+  }
+  if opts.out:
+    with open(opts.out, 'w') as f:
+      json.dump(doc, f, indent=2, sort_keys=True)
+      f.write('\n')
+    log('Wrote %s', opts.out)
+
+  if baseline is None:
+    return 0
+
+  if baseline.get('params') != doc['params']:
+    log('warning: baseline params %s differ from %s', baseline.get('params'),
+        doc['params'])
+  num_regressions = 0
+  print '%-16s %12s %12s %7s' % ('', 'old files/s', 'new files/s', 'ratio')
+  for key, o, n, ratio, regressed in Compare(baseline['results'], results,
+                                             opts.threshold):
+    print '%-16s %12.1f %12.1f %7.2f%s' % (key, o, n, ratio,
+                                           '  REGRESSION' if regressed else '')
+    num_regressions += regressed
+  if num_regressions:
+    log('%d regressions', num_regressions)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except Error, e:
+    print >>sys.stderr, 'multi_bench:', e.args[0]
+    sys.exit(1)
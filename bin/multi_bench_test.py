@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+"""
+multi_bench_test.py: Tests for multi_bench.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import multi_bench  # module under test
+
+
+class MultiBenchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='multi_bench_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testMakeTree(self):
+    src = os.path.join(self.tmp, 'src')
+    rel_paths = multi_bench.MakeTree(src, 'symlinks', scale=0.01)
+    self.assertEqual(60, len(rel_paths))
+    self.assertEqual(sorted(rel_paths), rel_paths)
+    link = os.path.join(src, 'links/d00/l00001')
+    self.assertEqual('../../target/t1', os.readlink(link))
+    self.assertEqual(4096, os.path.getsize(link))
+
+  def testBenchmark(self):
+    results = multi_bench.Benchmark(self.tmp, shapes=['deep'],
+                                    actions=['cp', 'mv', 'touch'], scale=0.1)
+    print results
+    cp = results['deep/cp']
+    self.assertEqual(60, cp['files'])
+    self.assertEqual(60 * 512, cp['bytes'])
+    self.assertEqual(60, cp['syscalls']['copy'])
+    self.assertEqual(0, results['deep/touch']['bytes'])
+    self.assertEqual([], os.listdir(self.tmp))
+
+  def testCompare(self):
+    old = {
+        'a/cp': {'files_per_sec': 100.0, 'sec': 1.0},
+        'a/ln': {'files_per_sec': 100.0, 'sec': 1.0},
+        'a/mv': {'files_per_sec': 100.0, 'sec': 0.001},
+        'a/ftree': {'skipped': 'no docopt'},
+        'b/cp': {'files_per_sec': 100.0, 'sec': 1.0},
+    }
+    new = {
+        'a/cp': {'files_per_sec': 90.0, 'sec': 1.1},
+        'a/ln': {'files_per_sec': 50.0, 'sec': 2.0},
+        'a/mv': {'files_per_sec': 10.0, 'sec': 0.01},  # too fast to tell
+        'a/ftree': {'files_per_sec': 100.0, 'sec': 1.0},
+    }
+    rows = multi_bench.Compare(old, new, 0.2)
+    self.assertEqual(
+        [('a/cp', False), ('a/ln', True), ('a/mv', False)],
+        [(key, regressed) for key, _, _, _, regressed in rows])
+
+
+if __name__ == '__main__':
+  unittest.main()
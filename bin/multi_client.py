@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+"""
+multi_client.py
+
+Thin client for 'multi serve'.  It takes the same arguments as multi, and
+sends them with its cwd and stdin to a warm multi process over a Unix socket,
+so a build that calls multi many times doesn't pay for interpreter startup and
+imports every time.
+
+Usage:
+  multi serve /tmp/multi.sock &
+  export MULTI_SOCKET=/tmp/multi.sock
+  find . -name '*.py' | multi_client.py cp /tmp/dest
+
+If $MULTI_SOCKET isn't set or nothing is listening on it, the client runs
+multi.py itself, so scripts work either way.
+
+This module is deliberately small and imports nothing heavy; multi.py imports
+it for the protocol.
+
+Protocol:
+  client -> server: one JSON line {"argv": [...], "cwd": "..."}, then the raw
+                    bytes of stdin, then shutdown(SHUT_WR).
+  server -> client: frames of a 1 byte tag, a 4 byte big-endian length, and
+                    data.  Tags are 'o' (stdout), 'e' (stderr), and 'x' (the
+                    exit status as a decimal string, always last).
+"""
+
+__author__ = 'Andy Chu'
+
+
+import errno
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+
+class Error(Exception):
+  pass
+
+
+_HEADER = struct.Struct('>I')
+
+STDOUT, STDERR, EXIT = 'o', 'e', 'x'
+
+
+def WriteFrame(sock, tag, data):
+  sock.sendall(tag + _HEADER.pack(len(data)) + data)
+
+
+def _ReadExactly(f, n):
+  data = f.read(n)
+  if len(data) != n:
+    raise Error('Connection closed in the middle of a frame')
+  return data
+
+
+def ReadFrame(f):
+  """Returns (tag, data), or (None, None) at EOF."""
+  tag = f.read(1)
+  if not tag:
+    return None, None
+  length, = _HEADER.unpack(_ReadExactly(f, _HEADER.size))
+  return tag, _ReadExactly(f, length)
+
+
+def _ForwardStdin(stdin, sock):
+  try:
+    while True:
+      # os.read() returns what's available, so --stream works as usual.
+      chunk = os.read(stdin.fileno(), 1 << 16)
+      if not chunk:
+        break
+      sock.sendall(chunk)
+  except socket.error:
+    pass  # the server went away; the main thread reports it
+  finally:
+    try:
+      sock.shutdown(socket.SHUT_WR)
+    except socket.error:
+      pass
+
+
+def Run(sock_path, argv, stdin=None, stdout=None, stderr=None, cwd=None):
+  """Run multi with argv in the server at sock_path.
+
+  Returns:
+    The exit status.
+
+  Raises:
+    socket.error if the server can't be reached.
+  """
+  stdin = stdin or sys.stdin
+  stdout = stdout or sys.stdout
+  stderr = stderr or sys.stderr
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(sock_path)
+  try:
+    request = {'argv': argv, 'cwd': cwd or os.getcwd()}
+    sock.sendall(json.dumps(request) + '\n')
+
+    # Send stdin on another thread, so we don't deadlock when the server
+    # writes a lot of log output before it has read all of stdin.
+    t = threading.Thread(target=_ForwardStdin, args=(stdin, sock))
+    t.daemon = True
+    t.start()
+
+    f = sock.makefile('rb')
+    while True:
+      tag, data = ReadFrame(f)
+      if tag is None:
+        raise Error('Server closed the connection without an exit status')
+      if tag == STDOUT:
+        stdout.write(data)
+        stdout.flush()
+      elif tag == STDERR:
+        stderr.write(data)
+        stderr.flush()
+      elif tag == EXIT:
+        return int(data)
+      else:
+        raise Error('Invalid frame tag %r' % tag)
+  finally:
+    sock.close()
+
+
+def _RunLocally(argv):
+  this_dir = os.path.dirname(os.path.abspath(__file__))
+  multi_py = os.path.join(this_dir, 'multi.py')
+  os.execv(sys.executable, [sys.executable, multi_py] + argv[1:])
+
+
+def main(argv):
+  """Returns an exit code."""
+  sock_path = os.environ.get('MULTI_SOCKET')
+  if not sock_path:
+    _RunLocally(argv)
+  try:
+    return Run(sock_path, ['multi'] + argv[1:])
+  except socket.error, e:
+    # Only fall back if we never got to send anything, so the action can't
+    # run twice.
+    if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+      raise
+    _RunLocally(argv)
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except Error, e:
+    print >>sys.stderr, 'multi_client:', e.args[0]
+    sys.exit(1)
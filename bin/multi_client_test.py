@@ -0,0 +1,34 @@
+#!/usr/bin/env python2
+"""
+multi_client_test.py: Tests for multi_client.py
+"""
+
+import socket
+import StringIO
+import unittest
+
+import multi_client  # module under test
+
+
+class MultiClientTest(unittest.TestCase):
+
+  def testFrames(self):
+    left, right = socket.socketpair()
+    multi_client.WriteFrame(left, multi_client.STDERR, 'log line\n')
+    multi_client.WriteFrame(left, multi_client.STDOUT, '')
+    multi_client.WriteFrame(left, multi_client.EXIT, '0')
+    left.close()
+
+    f = right.makefile('rb')
+    self.assertEqual(('e', 'log line\n'), multi_client.ReadFrame(f))
+    self.assertEqual(('o', ''), multi_client.ReadFrame(f))
+    self.assertEqual(('x', '0'), multi_client.ReadFrame(f))
+    self.assertEqual((None, None), multi_client.ReadFrame(f))
+
+  def testTruncatedFrame(self):
+    f = StringIO.StringIO('e\x00\x00\x00\x10abc')
+    self.assertRaises(multi_client.Error, multi_client.ReadFrame, f)
+
+
+if __name__ == '__main__':
+  unittest.main()
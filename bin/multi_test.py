@@ -3,9 +3,20 @@
 multi_test.py: Tests for multi.py
 """
 
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+import io_engine
 import multi  # module under test
+import multi_client
+import treespec
 
 
 class MultiTest(unittest.TestCase):
@@ -18,6 +29,276 @@ class MultiTest(unittest.TestCase):
     print multi.RelativePath('/foo/bar/baz.txt', '/foo/dir/link')
     print multi.RelativePath('/foo/bar/baz.txt', '/foo/dir/dir2/link')
 
+  def testParallelCopy(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      os.makedirs(os.path.join(src, 'a/b'))
+      pairs = []
+      for i in xrange(20):
+        name = 'a/b/file%d' % i
+        with open(os.path.join(src, name), 'w') as f:
+          f.write('x' * i)
+        pairs.append((os.path.join(src, name), name))
+      os.symlink('a/b/file1', os.path.join(src, 'link'))
+      pairs.append((os.path.join(src, 'link'), 'c/link'))
+
+      dest = os.path.join(tmp, 'dest')
+      multi.Dispatch(pairs, multi.CopyHandler(dest, force=True, jobs=4))
+
+      for i in xrange(20):
+        path = os.path.join(dest, 'a/b/file%d' % i)
+        self.assertEqual(i, os.path.getsize(path))
+      self.assertEqual('a/b/file1', os.readlink(os.path.join(dest, 'c/link')))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testDirFdCopy(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      pairs = []
+      # More dirs than cached fds, so some are closed and reopened.
+      for i in xrange(5):
+        name = 'd%d/sub/file' % i
+        os.makedirs(os.path.join(src, 'd%d/sub' % i))
+        with open(os.path.join(src, name), 'w') as f:
+          f.write('x' * i)
+        pairs.append((os.path.join(src, name), name))
+      os.symlink('d1/sub/file', os.path.join(src, 'link'))
+      pairs.append((os.path.join(src, 'link'), 'c/link'))
+
+      dest = os.path.join(tmp, 'dest')
+      engine = io_engine.DirFdEngine(max_fds=2)
+      multi.Dispatch(pairs, multi.CopyHandler(dest, force=True, jobs=4,
+                                              engine=engine))
+      engine.close()
+
+      for i in xrange(5):
+        path = os.path.join(dest, 'd%d/sub/file' % i)
+        self.assertEqual(i, os.path.getsize(path))
+      self.assertEqual('d1/sub/file',
+                       os.readlink(os.path.join(dest, 'c/link')))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testCopyUpdate(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      with open(src, 'w') as f:
+        f.write('hello')
+      dest = os.path.join(tmp, 'dest')
+      cache_path = os.path.join(tmp, 'cache')
+      pairs = [(src, 'out')]
+
+      def Copy(**kwargs):
+        h = multi.CopyHandler(dest, update=True, cache_path=cache_path,
+                              **kwargs)
+        multi.Dispatch(pairs, h)
+        return h.num_copied, h.num_skipped
+
+      self.assertEqual((1, 0), Copy())
+      self.assertEqual((0, 1), Copy())
+
+      # The source changed; same size, older timestamp is still copied
+      # because the cache knows the source's old mtime.
+      with open(src, 'w') as f:
+        f.write('HELLO')
+      os.utime(src, (1, 1))
+      self.assertEqual((1, 0), Copy())
+
+      # Without the cache, --checksum notices the same contents.
+      os.remove(cache_path)
+      os.utime(os.path.join(dest, 'out'), (0, 0))
+      self.assertEqual((0, 1), Copy(checksum=True))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testPlanDirs(self):
+    leaves = ['out/a/b', 'out/a', 'out/c/d/e', 'out']
+    dirs, existing = multi.PlanDirs(leaves, 'out')
+    self.assertEqual(
+        ['out', 'out/a', 'out/a/b', 'out/c', 'out/c/d', 'out/c/d/e'], dirs)
+    # out/a/b and out/c/d/e each fail with ENOENT twice before being made.
+    self.assertEqual(10, multi.LazyMkdirCost(leaves, existing))
+
+  def testMakePlannedDirs(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      rel_paths = ['a/b/c/file', 'a/b/file2', 'd/e/file', 'f/file', 'top']
+      os.makedirs(os.path.join(tmp, 'd'))
+      for jobs in (1, 3):
+        maker = multi.DirMaker()
+        multi.MakePlannedDirs(maker, tmp, rel_paths, jobs=jobs)
+        for d in ('a/b/c', 'd/e', 'f'):
+          self.assertTrue(os.path.isdir(os.path.join(tmp, d)))
+        self.assertEqual(6, maker.num_mkdir)
+
+        # No more syscalls for dirs in the plan.
+        maker.mkdir(os.path.join(tmp, 'a/b'))
+        self.assertEqual(6, maker.num_mkdir)
+    finally:
+      shutil.rmtree(tmp)
+
+  def testLinkBuilder(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      os.makedirs(os.path.join(tmp, 'src/a'))
+      os.makedirs(os.path.join(tmp, 'farm/x/y'))
+      for name in ('f1', 'f2'):
+        with open(os.path.join(tmp, 'src/a', name), 'w') as f:
+          f.write(name)
+
+      engine = io_engine.PathEngine()
+      for i in xrange(2):  # the second time replaces the links
+        b = multi.LinkBuilder(engine, relative=True)
+        for name in ('f1', 'f2'):
+          source = os.path.join(tmp, 'src/a', name)
+          dest = os.path.join(tmp, 'farm/x/y', name)
+          self.assertEqual('../../../src/a/' + name, b.Link(source, dest))
+          with open(dest) as f:
+            self.assertEqual(name, f.read())
+        self.assertEqual(1, len(b.rel_dirs))
+        self.assertEqual(i * 2, b.num_renamed)
+
+      b = multi.LinkBuilder(engine, force=False)
+      self.assertRaises(multi.Error, b.Link, source, dest)
+      self.assertEqual(['f1', 'f2'],
+                       sorted(os.listdir(os.path.join(tmp, 'farm/x/y'))))
+
+      # A file can't be replaced with a link to itself.
+      b = multi.LinkBuilder(engine)
+      self.assertRaises(multi.Error, b.Link, source, source)
+      self.assertEqual(False, os.path.islink(source))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testMoveAcrossDevices(self):
+    # Exercise the copy-then-remove path, even though it's all on one device.
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      src = os.path.join(tmp, 'src')
+      os.makedirs(os.path.join(src, 'tree/sub'))
+      with open(os.path.join(src, 'tree/sub/file'), 'w') as f:
+        f.write('contents')
+      os.utime(os.path.join(src, 'tree/sub/file'), (1000, 1000))
+      os.symlink('sub/file', os.path.join(src, 'tree/link'))
+      with open(os.path.join(src, 'single'), 'w') as f:
+        f.write('single')
+      os.makedirs(os.path.join(tmp, 'dest'))
+
+      pairs = [
+          (os.path.join(src, 'tree'), os.path.join(tmp, 'dest/tree')),
+          (os.path.join(src, 'single'), os.path.join(tmp, 'dest/single')),
+          (os.path.join(src, 'missing'), os.path.join(tmp, 'dest/missing')),
+      ]
+      num_ok, num_errors = multi.MoveAcrossDevices(
+          pairs, io_engine.PathEngine(), jobs=2)
+      self.assertEqual((2, 1), (num_ok, num_errors))
+
+      self.assertEqual([], os.listdir(src))
+      moved = os.path.join(tmp, 'dest/tree/sub/file')
+      with open(moved) as f:
+        self.assertEqual('contents', f.read())
+      self.assertEqual(1000, os.stat(moved).st_mtime)
+      self.assertEqual('sub/file',
+                       os.readlink(os.path.join(tmp, 'dest/tree/link')))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testStatsJson(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      out = os.path.join(tmp, 'stats.json')
+      old_stdin = sys.stdin
+      sys.stdin = StringIO.StringIO('a/b/c\na/b/d\n')
+      try:
+        multi.main(['multi', 'touch', os.path.join(tmp, 'dest'),
+                    '--stats-json', out])
+      finally:
+        sys.stdin = old_stdin
+
+      with open(out) as f:
+        d = json.load(f)
+      self.assertEqual(2, d['ops']['touch']['count'])
+      # dest/a/b and dest/a fail with ENOENT, then dest, dest/a, and dest/a/b
+      # are made.
+      self.assertEqual(5, d['ops']['mkdir']['count'])
+      self.assertTrue(d['wall_sec'] > 0)
+    finally:
+      shutil.rmtree(tmp)
+
+  def testServe(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      sock_path = os.path.join(tmp, 'sock')
+      t = threading.Thread(target=multi.Serve, args=(sock_path, 3))
+      t.daemon = True
+      t.start()
+      for _ in xrange(100):
+        if os.path.exists(sock_path):
+          break
+        time.sleep(0.01)
+
+      with open(os.path.join(tmp, 'treespec'), 'w') as f:
+        f.write('a/b\nc\n')
+
+      # Relative dest, resolved against the client's cwd.
+      stderr = StringIO.StringIO()
+      with open(os.path.join(tmp, 'treespec')) as stdin:
+        status = multi_client.Run(sock_path, ['multi', 'touch', 'out'],
+                                  stdin=stdin, stderr=stderr, cwd=tmp)
+      self.assertEqual(0, status)
+      self.assertTrue(os.path.isfile(os.path.join(tmp, 'out/a/b')))
+      self.assertTrue(os.path.isfile(os.path.join(tmp, 'out/c')))
+      self.assertTrue('multi: out/c' in stderr.getvalue(), stderr.getvalue())
+
+      stderr = StringIO.StringIO()
+      with open(os.devnull) as stdin:
+        status = multi_client.Run(sock_path, ['multi', 'bad', 'out'],
+                                  stdin=stdin, stderr=stderr, cwd=tmp)
+      self.assertEqual(1, status)
+      self.assertEqual("multi: Invalid action 'bad'\n", stderr.getvalue())
+
+      stdout = StringIO.StringIO()
+      with open(os.devnull) as stdin:
+        status = multi_client.Run(sock_path, ['multi', '--help'],
+                                  stdin=stdin, stdout=stdout, cwd=tmp)
+      self.assertEqual(0, status)
+      self.assertTrue(stdout.getvalue().startswith('Usage:'))
+
+      t.join()
+      self.assertFalse(os.path.exists(sock_path))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testNullAndTreespec(self):
+    tmp = tempfile.mkdtemp(prefix='multi_test')
+    try:
+      src = os.path.join(tmp, 'my src')
+      os.mkdir(src)
+      with open(os.path.join(src, 'a file'), 'w') as f:
+        f.write('a')
+      nul_input = 'f\0%s/a file\0dir 1/a copy\0' % src
+
+      status = multi.main(['multi', '-0', 'cp', os.path.join(tmp, 'out1')],
+                          stdin=StringIO.StringIO(nul_input))
+      self.assertTrue(os.path.isfile(os.path.join(tmp, 'out1/dir 1/a copy')))
+
+      spec_path = os.path.join(tmp, 'spec')
+      treespec.Compile(treespec.ParseNul(StringIO.StringIO(nul_input)),
+                       spec_path)
+      status = multi.main(['multi', '--treespec', spec_path, 'ln',
+                           os.path.join(tmp, 'out2')])
+      self.assertEqual(0, status)
+      self.assertEqual(os.path.join(src, 'a file'),
+                       os.readlink(os.path.join(tmp, 'out2/dir 1/a copy')))
+
+      self.assertRaises(multi.Error, multi.main,
+                        ['multi', '-0', '--stream', 'cp', 'out'])
+    finally:
+      shutil.rmtree(tmp)
 
 if __name__ == '__main__':
   unittest.main()
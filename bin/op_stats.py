@@ -0,0 +1,145 @@
+#!/usr/bin/env python2
+"""
+op_stats.py
+
+Per-operation statistics for 'multi --stats-json'.
+
+OpStats records, for each kind of operation (lstat, mkdir, copy, symlink,
+rename, ...): the number of calls, bytes, total and max time, and a histogram
+of latencies in power-of-two microsecond buckets.  It also keeps the N slowest
+individual calls, with their paths.
+
+StatsEngine wraps an io_engine instance and times every call through it, so
+the actions don't need to know about stats.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import heapq
+import json
+import threading
+import time
+
+
+class _OpCounter(object):
+
+  def __init__(self):
+    self.count = 0
+    self.num_bytes = 0
+    self.total_sec = 0.0
+    self.max_sec = 0.0
+    self.histogram = {}  # upper bound in microseconds -> count
+
+  def Add(self, seconds, num_bytes):
+    self.count += 1
+    self.num_bytes += num_bytes
+    self.total_sec += seconds
+    self.max_sec = max(self.max_sec, seconds)
+
+    bound = 1
+    us = seconds * 1e6
+    while bound < us:
+      bound <<= 1
+    self.histogram[bound] = self.histogram.get(bound, 0) + 1
+
+  def ToDict(self):
+    return {
+        'count': self.count,
+        'bytes': self.num_bytes,
+        'total_sec': self.total_sec,
+        'max_sec': self.max_sec,
+        # JSON keys must be strings.  Sort numerically for readability.
+        'histogram_us': [[bound, self.histogram[bound]]
+                         for bound in sorted(self.histogram)],
+    }
+
+
+class OpStats(object):
+  """Thread-safe collection of operation timings."""
+
+  def __init__(self, num_slowest=20):
+    self.num_slowest = num_slowest
+    self.ops = {}  # op name -> _OpCounter
+    self.slowest = []  # min-heap of (seconds, op, path)
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+
+  def Record(self, op, path, seconds, num_bytes=0):
+    with self.lock:
+      counter = self.ops.get(op)
+      if counter is None:
+        counter = self.ops[op] = _OpCounter()
+      counter.Add(seconds, num_bytes)
+
+      item = (seconds, op, path)
+      if len(self.slowest) < self.num_slowest:
+        heapq.heappush(self.slowest, item)
+      elif item > self.slowest[0]:
+        heapq.heapreplace(self.slowest, item)
+
+  def ToDict(self):
+    with self.lock:
+      return {
+          'wall_sec': time.time() - self.start_time,
+          'ops': dict((op, c.ToDict()) for op, c in self.ops.iteritems()),
+          'slowest': [
+              {'op': op, 'path': path, 'sec': sec}
+              for sec, op, path in sorted(self.slowest, reverse=True)],
+      }
+
+  def WriteJson(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.ToDict(), f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+class StatsEngine(object):
+  """Wraps an io_engine instance, recording each call in an OpStats."""
+
+  def __init__(self, engine, stats):
+    self.engine = engine
+    self.stats = stats
+
+  def _Timed(self, op, path, func, *args):
+    start = time.time()
+    try:
+      return func(*args)
+    finally:
+      self.stats.Record(op, path, time.time() - start)
+
+  def lstat(self, path):
+    return self._Timed('lstat', path, self.engine.lstat, path)
+
+  def readlink(self, path):
+    return self._Timed('readlink', path, self.engine.readlink, path)
+
+  def mkdir(self, path, mode=0777):
+    self._Timed('mkdir', path, self.engine.mkdir, path, mode)
+
+  def symlink(self, target, path):
+    self._Timed('symlink', path, self.engine.symlink, target, path)
+
+  def rename(self, source, dest):
+    self._Timed('rename', source, self.engine.rename, source, dest)
+
+  def unlink(self, path):
+    self._Timed('unlink', path, self.engine.unlink, path)
+
+  def open(self, path, flags, mode=0777):
+    return self._Timed('open', path, self.engine.open, path, flags, mode)
+
+  def touch(self, path):
+    self._Timed('touch', path, self.engine.touch, path)
+
+  def copy_file(self, source, dest, method='auto'):
+    start = time.time()
+    num_bytes = 0
+    try:
+      method, num_bytes = self.engine.copy_file(source, dest, method)
+      return method, num_bytes
+    finally:
+      self.stats.Record('copy', source, time.time() - start, num_bytes)
+
+  def close(self):
+    self.engine.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+"""
+op_stats_test.py: Tests for op_stats.py
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import io_engine
+import op_stats  # module under test
+
+
+class OpStatsTest(unittest.TestCase):
+
+  def testRecord(self):
+    stats = op_stats.OpStats(num_slowest=2)
+    stats.Record('lstat', 'a', 0.000003)
+    stats.Record('lstat', 'b', 0.5)
+    stats.Record('copy', 'c', 0.1, num_bytes=100)
+    stats.Record('copy', 'd', 0.2, num_bytes=50)
+
+    d = stats.ToDict()
+    print d
+    lstat = d['ops']['lstat']
+    self.assertEqual(2, lstat['count'])
+    self.assertEqual(0.5, lstat['max_sec'])
+    # 3 us falls in the (2, 4] bucket; 500000 us in (2^18, 2^19].
+    self.assertEqual([[4, 1], [1 << 19, 1]], lstat['histogram_us'])
+    self.assertEqual(150, d['ops']['copy']['bytes'])
+
+    self.assertEqual(['b', 'd'], [s['path'] for s in d['slowest']])
+
+  def testStatsEngine(self):
+    tmp = tempfile.mkdtemp(prefix='op_stats_test')
+    try:
+      stats = op_stats.OpStats()
+      e = op_stats.StatsEngine(io_engine.PathEngine(), stats)
+      e.mkdir(os.path.join(tmp, 'a'))
+      e.touch(os.path.join(tmp, 'a/b'))
+      method, num_bytes = e.copy_file(__file__, os.path.join(tmp, 'copy'))
+      self.assertEqual(os.path.getsize(__file__), num_bytes)
+      try:
+        e.mkdir(os.path.join(tmp, 'a'))
+      except OSError:
+        pass  # failed calls are still counted
+      else:
+        self.fail('Expected EEXIST')
+
+      out = os.path.join(tmp, 'stats.json')
+      stats.WriteJson(out)
+      with open(out) as f:
+        d = json.load(f)
+      self.assertEqual(2, d['ops']['mkdir']['count'])
+      self.assertEqual(1, d['ops']['touch']['count'])
+      self.assertEqual(num_bytes, d['ops']['copy']['bytes'])
+      self.assertEqual(4, len(d['slowest']))
+    finally:
+      shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  unittest.main()
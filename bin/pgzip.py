@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+"""
+pgzip.py
+
+Write gzip files using several cores, like pigz.
+
+The input is split into blocks, and each block is compressed on a thread pool
+(zlib releases the GIL) as a complete gzip member.  A gzip file may contain any
+number of members concatenated together, so the output is readable by gunzip,
+'tar xzf', and Python's gzip module.
+
+Compared with a single gzip stream, each block starts with an empty
+dictionary, so the output is slightly larger.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import collections
+import zlib
+
+import worker_pool
+
+
+DEFAULT_BLOCK_SIZE = 1 << 20  # 1 MiB, the same order as pigz's 128 KiB * 8
+
+
+def CompressMember(data, level):
+  """Returns data compressed as one complete gzip member."""
+  # wbits = 16 + MAX_WBITS means a gzip header and trailer, rather than zlib.
+  c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return c.compress(data) + c.flush()
+
+
+class ParallelGzipWriter(object):
+  """A write-only file object that compresses to another file object.
+
+  Usage:
+    w = ParallelGzipWriter(open('out.gz', 'wb'), jobs=4)
+    w.write(...)
+    w.close()  # also closes the underlying file
+  """
+
+  def __init__(self, fileobj, level=6, jobs=2, block_size=DEFAULT_BLOCK_SIZE):
+    self.fileobj = fileobj
+    self.level = level
+    self.jobs = jobs
+    self.block_size = block_size
+
+    self.pool = worker_pool.WorkerPool(jobs)
+    self.buf = []
+    self.buf_len = 0
+    # Jobs in output order.  Bounded, so memory use is about
+    # 3 * jobs * block_size.
+    self.pending = collections.deque()
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.closed = False
+
+  def _WriteCompleted(self, max_pending):
+    while len(self.pending) > max_pending:
+      member = self.pending.popleft().Wait()
+      self.fileobj.write(member)
+      self.bytes_out += len(member)
+
+  def _SubmitBlock(self):
+    data = ''.join(self.buf)
+    self.buf = []
+    self.buf_len = 0
+    self.pending.append(self.pool.Submit(CompressMember, data, self.level))
+    self._WriteCompleted(self.jobs * 2)
+
+  def write(self, data):
+    if self.closed:
+      raise ValueError('write() on closed ParallelGzipWriter')
+    self.buf.append(data)
+    self.buf_len += len(data)
+    self.bytes_in += len(data)
+    if self.buf_len >= self.block_size:
+      self._SubmitBlock()
+
+  def flush(self):
+    # Compression is block-based, so there's nothing useful to flush.
+    pass
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.buf_len or not self.bytes_in:
+      # An empty input still needs one member to be a valid gzip file.
+      self._SubmitBlock()
+    self._WriteCompleted(0)
+    self.pool.Join()
+    self.fileobj.close()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+"""
+pgzip_test.py: Tests for pgzip.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import gzip
+import unittest
+
+import pgzip  # module under test
+
+
+class _Output(object):
+  """A StringIO whose contents survive close()."""
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(data)
+
+  def close(self):
+    pass
+
+  def getvalue(self):
+    return ''.join(self.chunks)
+
+
+def _Gunzip(data):
+  return gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
+
+
+class ParallelGzipWriterTest(unittest.TestCase):
+
+  def testRoundTrip(self):
+    data = ''.join('line %d\n' % i for i in xrange(50000))
+    out = _Output()
+    w = pgzip.ParallelGzipWriter(out, level=6, jobs=3, block_size=10000)
+    for i in xrange(0, len(data), 777):
+      w.write(data[i:i+777])
+    w.close()
+
+    self.assertEqual(data, _Gunzip(out.getvalue()))
+    self.assertEqual(len(data), w.bytes_in)
+    self.assertEqual(len(out.getvalue()), w.bytes_out)
+
+  def testEmpty(self):
+    out = _Output()
+    w = pgzip.ParallelGzipWriter(out)
+    w.close()
+    self.assertEqual('', _Gunzip(out.getvalue()))
+
+
+if __name__ == '__main__':
+  unittest.main()
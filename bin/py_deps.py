@@ -94,6 +94,10 @@ def ModuleToRelativePath(modules, main_module):
 # TODO: Get rid of this?
 def CreateOptionsParser():
   parser = optparse.OptionParser()
+  parser.add_option(
+      '-0', '--null', dest='null', action='store_true', default=False,
+      help='Write NUL-delimited type/source/dest fields instead of lines, '
+           'for multi -0 and create.py -0')
   return parser
 
 
@@ -116,7 +120,10 @@ def main(argv):
   for file_type, input_path, archive_path in out:
     if input_path.startswith(stdlib_dir):
       continue
-    print '%s %s' % (input_path, archive_path)
+    if opts.null:
+      sys.stdout.write('%s\0%s\0%s\0' % (file_type, input_path, archive_path))
+    else:
+      print '%s %s' % (input_path, archive_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+"""
+stat_cache.py
+
+An on-disk record of what 'multi cp --update' copied on previous runs.  For
+each absolute source path, it stores the destination path, the source's size
+and mtime, the destination's size and mtime right after the copy, and
+optionally a content digest.
+
+If neither file has changed since, the copy can be skipped with two lstat()
+calls and no reads.
+
+File format: one entry per line, tab-separated:
+
+  src_size  src_mtime  dest_size  dest_mtime  digest  source  dest
+
+digest is '-' if it wasn't computed.  Text treespec paths can't contain
+whitespace, so tabs are safe.  Paths from 'multi -0' can; those with a tab or
+newline aren't cached.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import hashlib
+import os
+import re
+import threading
+
+
+def FileDigest(path):
+  """Returns the hex md5 of a file's contents."""
+  h = hashlib.md5()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class Entry(object):
+
+  def __init__(self, dest, src_size, src_mtime, dest_size, dest_mtime,
+               digest):
+    self.dest = dest
+    self.src_size = src_size
+    self.src_mtime = src_mtime
+    self.dest_size = dest_size
+    self.dest_mtime = dest_mtime
+    self.digest = digest  # None if not computed
+
+  def SourceMatches(self, st):
+    return (self.src_size, self.src_mtime) == (st.st_size, st.st_mtime)
+
+  def DestMatches(self, dest, st):
+    return (self.dest == dest and
+            (self.dest_size, self.dest_mtime) == (st.st_size, st.st_mtime))
+
+
+_UNSAFE = re.compile(r'[\t\n]')
+
+
+class StatCache(object):
+  """Maps source paths to Entry instances.  Thread-safe."""
+
+  def __init__(self, path=None):
+    """
+    Args:
+      path: file to load from and save to.  If None, the cache only lives for
+        this process.
+    """
+    self.path = path
+    self.entries = {}
+    self.lock = threading.Lock()
+    self.dirty = False
+    if path and os.path.exists(path):
+      self._Load()
+
+  def _Load(self):
+    with open(self.path) as f:
+      for line in f:
+        parts = line.rstrip('\n').split('\t')
+        if len(parts) != 7:
+          continue  # ignore corrupt lines; the file will be rewritten
+        (src_size, src_mtime, dest_size, dest_mtime, digest, source,
+         dest) = parts
+        self.entries[source] = Entry(
+            dest, int(src_size), float(src_mtime), int(dest_size),
+            float(dest_mtime), None if digest == '-' else digest)
+
+  def Lookup(self, source):
+    with self.lock:
+      return self.entries.get(source)
+
+  def Record(self, source, dest, src_st, dest_st, digest=None):
+    if _UNSAFE.search(source) or _UNSAFE.search(dest):
+      return  # can't be represented in the file format
+    entry = Entry(dest, src_st.st_size, src_st.st_mtime, dest_st.st_size,
+                  dest_st.st_mtime, digest)
+    with self.lock:
+      self.entries[source] = entry
+      self.dirty = True
+
+  def Save(self):
+    """Write the cache atomically, if anything changed."""
+    if not self.path or not self.dirty:
+      return
+    tmp = '%s.%d.tmp' % (self.path, os.getpid())
+    with open(tmp, 'w') as f:
+      for source in sorted(self.entries):
+        e = self.entries[source]
+        # repr() of a float round-trips exactly.
+        f.write('%d\t%r\t%d\t%r\t%s\t%s\t%s\n' % (
+            e.src_size, e.src_mtime, e.dest_size, e.dest_mtime,
+            e.digest or '-', source, e.dest))
+    os.rename(tmp, self.path)
+    self.dirty = False
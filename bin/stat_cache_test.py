@@ -0,0 +1,60 @@
+#!/usr/bin/env python2
+"""
+stat_cache_test.py: Tests for stat_cache.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import stat_cache  # module under test
+
+
+class StatCacheTest(unittest.TestCase):
+
+  def testSaveAndLoad(self):
+    tmp = tempfile.mkdtemp(prefix='stat_cache_test')
+    try:
+      path = os.path.join(tmp, 'cache')
+      st = os.stat(tmp)
+
+      cache = stat_cache.StatCache(path)
+      cache.Record('/src/a', '/dest/a', st, st, digest='abc')
+      cache.Record('/src/b', '/dest/b', st, st)
+      cache.Save()
+
+      cache = stat_cache.StatCache(path)
+      a = cache.Lookup('/src/a')
+      self.assertEqual('abc', a.digest)
+      self.assertEqual(True, a.SourceMatches(st))
+      self.assertEqual(True, a.DestMatches('/dest/a', st))
+      self.assertEqual(False, a.DestMatches('/dest/b', st))
+      self.assertEqual(None, cache.Lookup('/src/b').digest)
+      self.assertEqual(None, cache.Lookup('/src/c'))
+    finally:
+      shutil.rmtree(tmp)
+
+  def testFileDigest(self):
+    fd, path = tempfile.mkstemp(prefix='stat_cache_test')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        f.write('hello\n')
+      self.assertEqual('b1946ac92492d2347c6235b4d2611184',
+                       stat_cache.FileDigest(path))
+
+      # Spans more than one chunk.
+      with open(path, 'w') as f:
+        f.write('x' * (3 << 20))
+      self.assertEqual(hashlib.md5('x' * (3 << 20)).hexdigest(),
+                       stat_cache.FileDigest(path))
+    finally:
+      os.unlink(path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python2
+"""
+store.py
+
+Install package archives as trees of hard links into a content-addressed store.
+
+Usage:
+  store.py install foo.tin /opt/foo/1.2       # or a .tar.gz, or a .zip
+  store.py gc                                 # remove unreferenced objects
+  store.py gc -n                              # only show what would be removed
+
+The store ($TIN_STORE, or ~/.tin/store) holds each file once, named by its
+contents:
+
+  objects/md5/3b/5d5c3712955042212316173ccf37be     mode 0444
+  objects/md5/3b/5d5c3712955042212316173ccf37be.x   mode 0555, same contents
+  tmp/                                              partial objects
+
+An installed tree is a directory of hard links to objects, so installing N
+versions of a package stores each distinct file once.  Objects are read-only,
+since every tree that has the file shares the inode.  The tree must be on the
+same file system as the store.
+
+For a .tin made with 'create.py --index', TIN/toc has the digest of every
+file, so a file that's already in the store is linked without decompressing
+it.  Only new files are decompressed, and they're checked against their
+digests before they're added.  Other archives are read in full, and files are
+named by md5.
+
+An object whose link count is 1 isn't in any installed tree.  To uninstall,
+remove the tree, then run 'store.py gc'.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import errno
+import hashlib
+import optparse
+import os
+import shutil
+import stat
+import sys
+import tarfile
+
+import create
+import tin_archive
+import tin_gc
+
+
+class Error(Exception):
+  pass
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, 'store:', msg
+
+
+# crc32 digests in TIN/toc aren't good enough to name objects by, so those
+# files are read and named by md5.
+_TRUSTED_HASHES = ('md5', 'sha1', 'sha256', 'sha512')
+
+
+class Store(object):
+  """A directory of files named by their contents.
+
+  Usage:
+    s = Store('/home/andy/.tin/store')
+    path = s.ObjectPath('md5', digest, False)
+    if not os.path.exists(path):
+      s.Add('md5', digest, False, contents)
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self.objects_dir = os.path.join(root, 'objects')
+    self.tmp_dir = os.path.join(root, 'tmp')
+    self.num_tmp = 0
+    for d in (self.objects_dir, self.tmp_dir):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+
+  def ObjectPath(self, hash_name, digest, executable):
+    name = digest[2:] + ('.x' if executable else '')
+    return os.path.join(self.objects_dir, hash_name, digest[:2], name)
+
+  def Add(self, hash_name, digest, executable, contents, dest=None):
+    """Add an object, after checking that it has the given digest.
+
+    Args:
+      dest: If set, hard link the object here too.  That happens before the
+        object's temp link is removed, so its link count never drops to 1,
+        which would let a concurrent gc remove it.
+
+    Returns:
+      The path of the object.
+    """
+    h = create.NewHash(hash_name)
+    h.update(contents)
+    if h.hexdigest() != digest:
+      raise Error('Contents have %s %s, expected %s' % (hash_name,
+                                                        h.hexdigest(), digest))
+
+    path = self.ObjectPath(hash_name, digest, executable)
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+      try:
+        os.makedirs(d)
+      except OSError, e:
+        if e.errno != errno.EEXIST:  # another install made it
+          raise
+
+    # Write a private file, then link it into place, so an object is never
+    # partial.
+    self.num_tmp += 1
+    tmp = os.path.join(self.tmp_dir, 'obj.%d.%d' % (os.getpid(), self.num_tmp))
+    try:
+      with open(tmp, 'wb') as f:
+        f.write(contents)
+      os.chmod(tmp, 0555 if executable else 0444)
+      while True:
+        try:
+          os.link(tmp, path)
+        except OSError, e:
+          if e.errno != errno.EEXIST:
+            raise
+          # Another install added it.  Share that inode, unless a gc removes
+          # it first.
+          if dest is None:
+            break
+          try:
+            os.link(path, dest)
+            return path
+          except OSError, e:
+            if e.errno != errno.ENOENT:
+              raise
+            continue
+        if dest is not None:
+          os.link(tmp, dest)
+        break
+    finally:
+      os.unlink(tmp)
+    return path
+
+  def Objects(self):
+    """Yields (path, lstat result) of each object."""
+    for dir_path, _, files in os.walk(self.objects_dir):
+      for name in files:
+        path = os.path.join(dir_path, name)
+        try:
+          yield path, os.lstat(path)
+        except OSError:
+          pass  # removed by another gc
+
+  def StaleTempFiles(self):
+    """Returns the paths of partial objects whose process has died."""
+    result = []
+    for name in os.listdir(self.tmp_dir):
+      parts = name.split('.')
+      if (len(parts) == 3 and parts[1].isdigit() and
+          not tin_gc.PidIsAlive(int(parts[1]))):
+        result.append(os.path.join(self.tmp_dir, name))
+    return result
+
+
+def _HashContents(contents):
+  return 'md5', hashlib.md5(contents).hexdigest()
+
+
+def _Entries(a):
+  """Yields (TarInfo, digest, GetContents) for each entry in an archive.
+
+  digest is (hash name, hex digest), or None if the contents need to be
+  hashed.  GetContents() returns the contents of a regular file.
+  """
+  if a.zip:
+    for info in a.zip.infolist():
+      tarinfo = tarfile.TarInfo(info.filename.rstrip('/'))
+      mode = info.external_attr >> 16
+      if info.filename.endswith('/'):
+        tarinfo.type = tarfile.DIRTYPE
+      elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = a.zip.read(info)
+      tarinfo.mode = stat.S_IMODE(mode) or 0644
+      yield tarinfo, None, lambda info=info: a.zip.read(info)
+
+  elif a.toc is not None:
+    for _, _, _, digest, name in tin_archive.ParseToc(a.tail[0][1]):
+      hash_name = create.HashForDigest(digest)
+      tarinfo = a.Header(name)
+      if tarinfo is None or not tarinfo.isreg():
+        tarinfo, contents = a.Lookup(name)
+        yield tarinfo, None, lambda contents=contents: contents
+      elif hash_name in _TRUSTED_HASHES:
+        # Only decompressed if the object isn't in the store.
+        yield (tarinfo, (hash_name, digest),
+               lambda name=name: a.Lookup(name)[1])
+      else:
+        yield tarinfo, None, lambda name=name: a.Lookup(name)[1]
+    for tarinfo, contents in a.tail:
+      yield tarinfo, None, lambda contents=contents: contents
+
+  else:
+    for tarinfo, t in a.Stream():
+      contents = t.extractfile(tarinfo).read() if tarinfo.isreg() else ''
+      yield tarinfo, None, lambda contents=contents: contents
+
+
+def _CheckName(name):
+  parts = name.split('/')
+  if not name or name.startswith('/') or '..' in parts:
+    raise Error('Refusing to install %r outside the tree' % name)
+
+
+def _MakeParents(root, name):
+  """Make the parent dirs of name under root.
+
+  Raises Error if one of them is a symlink, e.g. from an earlier entry, since
+  files would be written wherever it points.
+  """
+  path = root
+  for part in name.split('/')[:-1]:
+    if not part or part == '.':
+      continue
+    path = os.path.join(path, part)
+    try:
+      st = os.lstat(path)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      os.mkdir(path)
+      continue
+    if not stat.S_ISDIR(st.st_mode):
+      raise Error('Refusing to install %r through %s, which is not a dir' %
+                  (name, path))
+
+
+def Install(store, archive_path, dest):
+  """Install an archive as a tree of hard links to objects in the store.
+
+  The tree is built next to dest, then renamed into place.
+
+  Returns:
+    (number of files, number linked to existing objects, number of new
+    objects, bytes in new objects)
+  """
+  if os.path.lexists(dest):
+    raise Error('%s already exists' % dest)
+  tmp_dest = '%s.tmp.%d' % (dest.rstrip('/'), os.getpid())
+
+  num_files = num_linked = num_added = bytes_added = 0
+  a = tin_archive.TinArchive(archive_path)
+  try:
+    os.makedirs(tmp_dest)
+    try:
+      for tarinfo, digest, get_contents in _Entries(a):
+        _CheckName(tarinfo.name)
+        _MakeParents(tmp_dest, tarinfo.name)
+        path = os.path.join(tmp_dest, tarinfo.name)
+
+        if tarinfo.isdir():
+          if not os.path.lexists(path):
+            os.mkdir(path)
+          elif not stat.S_ISDIR(os.lstat(path).st_mode):
+            raise Error('Refusing to replace %s with a dir' % path)
+          continue
+        if tarinfo.issym():
+          os.symlink(tarinfo.linkname, path)
+          continue
+        if not tarinfo.isreg():
+          raise Error("Can't install %s, of tar type %r" % (tarinfo.name,
+                                                             tarinfo.type))
+
+        contents = None
+        if digest is None:
+          contents = get_contents()
+          digest = _HashContents(contents)
+        hash_name, hex_digest = digest
+        executable = bool(tarinfo.mode & 0100)
+        obj = store.ObjectPath(hash_name, hex_digest, executable)
+        num_files += 1
+        try:
+          try:
+            os.link(obj, path)
+            num_linked += 1
+            continue
+          except OSError, e:
+            if e.errno != errno.ENOENT:  # not in the store, or removed by gc
+              raise
+          if contents is None:
+            contents = get_contents()
+          store.Add(hash_name, hex_digest, executable, contents, dest=path)
+        except OSError, e:
+          if e.errno == errno.EXDEV:
+            raise Error('%s must be on the same file system as the store %s'
+                        % (dest, store.root))
+          raise
+        num_added += 1
+        bytes_added += len(contents)
+    except:
+      shutil.rmtree(tmp_dest, ignore_errors=True)
+      raise
+  finally:
+    a.close()
+
+  os.rename(tmp_dest, dest)
+  return num_files, num_linked, num_added, bytes_added
+
+
+def Collect(store, dry_run=False):
+  """Remove objects that aren't linked from any installed tree.
+
+  Returns:
+    list of (path, bytes) removed
+  """
+  if not dry_run:
+    for path in store.StaleTempFiles():
+      log('removing %s', path)
+      os.unlink(path)
+
+  removed = []
+  for path, st in store.Objects():
+    if st.st_nlink != 1:
+      continue
+    if not dry_run:
+      try:
+        os.unlink(path)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        continue
+    removed.append((path, st.st_size))
+  return removed
+
+
+def Options():
+  """Returns an option parser instance."""
+  p = optparse.OptionParser(
+      'store.py install ARCHIVE DEST\n'
+      '       store.py gc [-n]')
+  p.add_option(
+      '--store', dest='store', type='str',
+      default=os.environ.get('TIN_STORE',
+                             os.path.expanduser('~/.tin/store')),
+      help='The store directory (default $TIN_STORE, or ~/.tin/store)')
+  p.add_option(
+      '-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+      help="With gc, print what would be removed, but don't remove it")
+  return p
+
+
+def main(argv):
+  """Returns an exit code."""
+  (opts, argv) = Options().parse_args(argv)
+  try:
+    action = argv[1]
+  except IndexError:
+    raise Error('Expected an action: install or gc')
+
+  store = Store(opts.store)
+
+  if action == 'install':
+    try:
+      archive_path, dest = argv[2:4]
+    except ValueError:
+      raise Error('Usage: store.py install ARCHIVE DEST')
+    num_files, num_linked, num_added, bytes_added = Install(
+        store, archive_path, dest)
+    log('Installed %s: %d files, %d already in the store, %d new (%d bytes)',
+        dest, num_files, num_linked, num_added, bytes_added)
+
+  elif action == 'gc':
+    removed = Collect(store, dry_run=opts.dry_run)
+    verb = 'would remove' if opts.dry_run else 'removed'
+    for path, num_bytes in removed:
+      print '%s %s (%d bytes)' % (verb, path, num_bytes)
+    log('%s %d objects, %d bytes', verb, len(removed),
+        sum(n for _, n in removed))
+
+  else:
+    raise Error('Invalid action %r' % action)
+
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except (Error, tin_archive.Error), e:
+    print >>sys.stderr, 'store:', e.args[0]
+    sys.exit(1)
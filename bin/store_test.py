@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+"""
+store_test.py: Tests for store.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import create_test
+import store  # module under test
+
+
+class StoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='store_test')
+    self.store = store.Store(os.path.join(self.tmp, 'store'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Create(self, name, files, flags):
+    return create_test.MakeArchive(self.tmp, name, files, flags)
+
+  def _Install(self, archive, name):
+    dest = os.path.join(self.tmp, 'installed', name)
+    return dest, store.Install(self.store, archive, dest)
+
+  def testAdd(self):
+    digest = 'd41d8cd98f00b204e9800998ecf8427e'  # md5 of ''
+    path = self.store.Add('md5', digest, False, '')
+    self.assertEqual(path, self.store.ObjectPath('md5', digest, False))
+    self.assertEqual(0444, os.stat(path).st_mode & 0777)
+    # Adding it again is fine.
+    self.store.Add('md5', digest, False, '')
+    self.assertRaises(store.Error, self.store.Add, 'md5', digest, False, 'x')
+    self.assertEqual([], os.listdir(self.store.tmp_dir))
+
+  def testInstall(self):
+    for flags in [['--index'], ['--index', '--hash', 'crc32'], [],
+                  ['--kind', 'zip']]:
+      files = [('main.sh', '#!/bin/sh\necho hi\n'), ('lib/a.txt', 'a\n'),
+               ('lib/b.txt', 'b\n' * 1000)]
+      v1 = self._Create('v1', files, flags)
+      files[1] = ('lib/a.txt', 'changed\n')
+      v2 = self._Create('v2', files, flags)
+
+      dest1, (num_files, num_linked, num_added, _) = self._Install(v1, 'v1')
+      self.assertEqual(0, num_linked)
+      self.assertEqual(num_files, num_added)
+
+      dest2, (num_files, num_linked, num_added, _) = self._Install(v2, 'v2')
+      # main.sh and lib/b.txt are shared.  TIN/checksum and TIN/toc differ.
+      self.assertTrue(num_linked >= 2, num_linked)
+      self.assertTrue(num_added <= num_files - 2, num_added)
+
+      self.assertEqual('changed\n',
+                       open(os.path.join(dest2, 'lib/a.txt')).read())
+      self.assertTrue(os.access(os.path.join(dest2, 'main.sh'), os.X_OK))
+      self.assertFalse(os.access(os.path.join(dest2, 'lib/b.txt'), os.X_OK))
+      b1 = os.stat(os.path.join(dest1, 'lib/b.txt'))
+      b2 = os.stat(os.path.join(dest2, 'lib/b.txt'))
+      self.assertEqual(b1.st_ino, b2.st_ino)
+      self.assertEqual(3, b2.st_nlink)  # the object and 2 trees
+
+      self.assertRaises(store.Error, store.Install, self.store, v2, dest2)
+
+      # Uninstall v1.  Only its lib/a.txt is garbage.
+      shutil.rmtree(dest1)
+      removed = store.Collect(self.store)
+      self.assertTrue(1 <= len(removed) < num_files, removed)
+      self.assertEqual('b\n' * 1000,
+                       open(os.path.join(dest2, 'lib/b.txt')).read())
+
+      shutil.rmtree(dest2)
+      store.Collect(self.store)
+      self.assertEqual([], list(self.store.Objects()))
+
+  def testGcDuringInstall(self):
+    archive = self._Create('v1', [('main.sh', '#!/bin/sh\n'),
+                                  ('a.txt', 'a\n')], ['--index'])
+    # Run a gc right after Add drops each temp link.  The new object must
+    # already be linked from the tree.
+    real_unlink = os.unlink
+    def Unlink(path):
+      real_unlink(path)
+      if path.startswith(self.store.tmp_dir):
+        self.assertEqual([], store.Collect(self.store))
+    os.unlink = Unlink
+    try:
+      dest, (num_files, _, num_added, _) = self._Install(archive, 'v1')
+    finally:
+      os.unlink = real_unlink
+    self.assertEqual(num_files, num_added)
+    for path, st in self.store.Objects():
+      self.assertEqual(2, st.st_nlink, path)
+
+  def testSymlinkEscape(self):
+    outside = os.path.join(self.tmp, 'outside')
+    os.mkdir(outside)
+    archive = os.path.join(self.tmp, 'evil.tar.gz')
+    t = tarfile.open(archive, 'w:gz')
+    link = tarfile.TarInfo('lib')
+    link.type = tarfile.SYMTYPE
+    link.linkname = outside
+    t.addfile(link)
+    f = tarfile.TarInfo('lib/x')
+    f.size = 3
+    t.addfile(f, cStringIO.StringIO('bad'))
+    t.close()
+
+    dest = os.path.join(self.tmp, 'installed')
+    self.assertRaises(store.Error, store.Install, self.store, archive, dest)
+    self.assertEqual([], os.listdir(outside))
+    self.assertFalse(os.path.exists(dest))
+
+  def testCollectStaleTemp(self):
+    stale = os.path.join(self.store.tmp_dir, 'obj.999999999.1')
+    live = os.path.join(self.store.tmp_dir, 'obj.%d.1' % os.getpid())
+    for path in (stale, live):
+      open(path, 'w').close()
+    store.Collect(self.store)
+    self.assertEqual([os.path.basename(live)], os.listdir(self.store.tmp_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
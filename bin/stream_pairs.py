@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+"""
+stream_pairs.py
+
+Dedupe and sort (source, dest) pairs from a treespec without holding the
+whole treespec in memory.  Used by 'multi --stream'.
+
+- StreamDedupe() passes pairs through as they arrive, dropping repeated
+  destinations.  It remembers destinations in a DestIndex, which stores a 64-bit
+  hash per entry in a flat array rather than a set of strings.
+- ExternalSort() sorts by destination using bounded memory: sorted runs are
+  spilled to temp files and merged.  Since its output is sorted, duplicates
+  are adjacent and are dropped without an index.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import array
+import hashlib
+import heapq
+import struct
+import tempfile
+
+
+class DestIndex(object):
+  """A set of destination paths, stored as 64-bit hashes.
+
+  This is an open addressing hash table in an array('L'), so each entry costs
+  16 bytes at the maximum load factor of 1/2, instead of a Python string and a
+  set slot.  Two different paths with the same 64-bit hash are treated as
+  duplicates; for md5 that's not going to happen in practice.
+  """
+
+  def __init__(self, initial_size=1024):
+    self.table = array.array('L', [0]) * initial_size
+    self.mask = initial_size - 1
+    self.count = 0
+
+  @staticmethod
+  def _Hash(path):
+    h = struct.unpack('<Q', hashlib.md5(path).digest()[:8])[0]
+    return h or 1  # 0 marks an empty slot
+
+  def _Insert(self, h):
+    """Returns True if h was added, False if it was already present."""
+    table = self.table
+    mask = self.mask
+    i = h & mask
+    while True:
+      slot = table[i]
+      if slot == 0:
+        table[i] = h
+        return True
+      if slot == h:
+        return False
+      i = (i + 1) & mask
+
+  def _Grow(self):
+    old = self.table
+    self.table = array.array('L', [0]) * (len(old) * 2)
+    self.mask = len(self.table) - 1
+    for h in old:
+      if h:
+        self._Insert(h)
+
+  def Add(self, path):
+    """Returns True if path is new, False if it was already added."""
+    if (self.count + 1) * 2 > len(self.table):
+      self._Grow()
+    added = self._Insert(self._Hash(path))
+    if added:
+      self.count += 1
+    return added
+
+  def __len__(self):
+    return self.count
+
+
+class DupeCounter(object):
+  """Counts the duplicates dropped by StreamDedupe() or ExternalSort()."""
+
+  def __init__(self):
+    self.num_dupes = 0
+
+
+def StreamDedupe(pairs, counter=None):
+  """Yield pairs in input order, skipping destinations we've already seen."""
+  index = DestIndex()
+  for src, dest in pairs:
+    if index.Add(dest):
+      yield src, dest
+    elif counter:
+      counter.num_dupes += 1
+
+
+# Pairs are spilled as "dest NUL src" lines, so the natural string order sorts
+# by destination, then source.  Treespec filenames can't contain whitespace, so
+# NUL and newline never occur in them.
+
+def _SpillRun(run, tmp_dir):
+  run.sort()
+  f = tempfile.TemporaryFile(prefix='multi-sort-', dir=tmp_dir)
+  for line in run:
+    f.write(line)
+  f.seek(0)
+  return f
+
+
+def ExternalSort(pairs, max_lines=100000, tmp_dir=None, counter=None):
+  """Yield unique pairs sorted by destination, like multi.RemoveDupes().
+
+  At most max_lines pairs are held in memory; the rest are spilled to
+  temporary files in tmp_dir.  If the input fits in one run, nothing touches
+  the disk.
+
+  NOTE: Like StreamDedupe(), this keeps only the first pair for a destination,
+  which here means the one with the smallest source.
+  """
+  runs = []
+  run = []
+  for src, dest in pairs:
+    run.append('%s\0%s\n' % (dest, src))
+    if len(run) >= max_lines:
+      runs.append(_SpillRun(run, tmp_dir))
+      run = []
+
+  if runs:
+    if run:
+      runs.append(_SpillRun(run, tmp_dir))
+    merged = heapq.merge(*runs)
+  else:
+    run.sort()
+    merged = iter(run)
+
+  last_dest = None
+  for line in merged:
+    dest, src = line[:-1].split('\0', 1)
+    if dest == last_dest:
+      if counter:
+        counter.num_dupes += 1
+      continue
+    last_dest = dest
+    yield src, dest
+
+  for f in runs:
+    f.close()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+"""
+stream_pairs_test.py: Tests for stream_pairs.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import unittest
+
+import stream_pairs  # module under test
+
+
+PAIRS = [
+    ('c', 'c'),
+    ('a', 'x/a'),
+    ('b', 'b'),
+    ('a', 'x/a'),
+    ('a2', 'x/a'),
+    ('d', 'd'),
+]
+
+
+class StreamPairsTest(unittest.TestCase):
+
+  def testDestIndex(self):
+    index = stream_pairs.DestIndex(initial_size=4)
+    for i in xrange(1000):
+      self.assertEqual(True, index.Add('path/%d' % i))
+    for i in xrange(1000):
+      self.assertEqual(False, index.Add('path/%d' % i))
+    self.assertEqual(1000, len(index))
+
+  def testStreamDedupe(self):
+    counter = stream_pairs.DupeCounter()
+    out = list(stream_pairs.StreamDedupe(PAIRS, counter=counter))
+    self.assertEqual(
+        [('c', 'c'), ('a', 'x/a'), ('b', 'b'), ('d', 'd')], out)
+    self.assertEqual(2, counter.num_dupes)
+
+  def testExternalSort(self):
+    expected = [('b', 'b'), ('c', 'c'), ('d', 'd'), ('a', 'x/a')]
+    # In memory, and spilled to several runs.
+    for max_lines in (100, 2, 1):
+      counter = stream_pairs.DupeCounter()
+      out = list(stream_pairs.ExternalSort(
+          PAIRS, max_lines=max_lines, counter=counter))
+      self.assertEqual(expected, out)
+      self.assertEqual(2, counter.num_dupes)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -12,6 +12,11 @@
 #   tin build-python
 #   tin list <tin>
 #   tin cat <tin> <path>...
+#   tin gc [--max-bytes <size>] [-n]
+#   tin delta <old> <new>
+#   tin patch [-o <new>] <old> <patch>
+#   tin install <tin> <dest>
+#   tin store-gc [-n]
 #   tin -h | --help
 #   tin --version
 #
@@ -27,6 +32,13 @@
 #
 #   list        List the contents of a .tin file.
 #   cat         Write individual files in a .tin to stdout.
+#   gc          Remove least recently used extract dirs in $TMP until they fit
+#               in a budget.
+#   delta       Write a patch that turns one .tin into another.
+#   patch       Rebuild a .tin from an old version and a patch, and verify it.
+#   install     Install an archive as a tree of hard links into a
+#               content-addressed store.
+#   store-gc    Remove store objects that no installed tree links to.
 #
 # TODO:
 #
@@ -74,6 +86,22 @@ hg-info() {
   $TIN_BASE_DIR/tin/hg-info.sh "$@"
 }
 
+gc() {
+  $THIS_DIR/tin_gc.py "$@"
+}
+
+# Install a package archive as hard links into the content-addressed store
+# ($TIN_STORE), so unchanged files across versions are stored once.
+#   tin install foo.tin /opt/foo/1.2
+install() {
+  $THIS_DIR/store.py install "$@"
+}
+
+# Remove store objects that no installed tree links to.
+store-gc() {
+  $THIS_DIR/store.py gc "$@"
+}
+
 # BUILD
 
 
@@ -110,23 +138,28 @@ build-python() {
     | create --set-pythonpath "$@"
 }
 
-# List the contents of a tin file.
-# TODO:
-# - fix bug if .tin file isn't executable
-# - what if not even a .tin or .tar file
-# - need shell tests for these
+# List the contents of a tin file.  With --index, only the table of contents
+# is read.
 list() {
-  set -o nounset
-  local tin_file=$1
-  TIN_UNTAR=1 ./$tin_file | tar tvzf -
+  $THIS_DIR/tin_archive.py list "$@"
 }
 
-# Print a specific file.
+# Print specific files.
 cat() {
-  set -o nounset
-  local tin_file=$1
-  shift
-  TIN_UNTAR=1 ./$tin_file | tar --to-stdout -xvzf - "$@"
+  $THIS_DIR/tin_archive.py cat "$@"
+}
+
+# Write a patch that turns one version of a tin file into another.  Files that
+# didn't change aren't in the patch, if both were created with --index.
+#   tin delta OLD NEW > patch
+delta() {
+  $THIS_DIR/tin_delta.py delta "$@"
+}
+
+# Rebuild the new version from the old one and a patch, and verify it.
+#   tin patch OLD patch > NEW
+patch() {
+  $THIS_DIR/tin_delta.py patch "$@"
 }
 
 "$@"
@@ -0,0 +1,267 @@
+#!/usr/bin/env python2
+"""
+tin_archive.py
+
+List and read files in a .tin archive without running or extracting it.
+
+Usage:
+  tin_archive.py list foo.tin
+  tin_archive.py cat foo.tin TIN/checksum lib/foo.py
+
+A .tin made with 'create.py --index' has a table of contents, TIN/toc, and each
+file is its own gzip member.  The prelude has the offset of TIN/toc, so only
+the table and the requested members are read and decompressed.
+
+Other tar .tin files are decompressed from the start of the payload up to the
+last requested file.  Zip .tin files are read through their central directory.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import gzip
+import re
+import sys
+import tarfile
+import zipfile
+import zlib
+
+
+class Error(Exception):
+  pass
+
+
+# The prelude is shorter than this; see create.py.
+_MAX_PRELUDE = 1 << 16
+
+# Enough compressed bytes for the first tar block of a member.
+_HEADER_READ = 4096
+
+_VAR_RE = re.compile(r"^(\w+)='([^']*)'$", re.MULTILINE)
+
+
+def _PreludeVars(head):
+  end = head.find('\nmain() {')
+  return dict(_VAR_RE.findall(head[:end] if end != -1 else head))
+
+
+def ReadPreludeVars(f):
+  """Returns a dict of the variables assigned in the prelude.
+
+  Unlike ReadPrelude(), this works for zip .tin files too.
+  """
+  f.seek(0)
+  head = f.read(_MAX_PRELUDE)
+  if not head.startswith('#!'):
+    return {}  # --no-prelude
+  return _PreludeVars(head)
+
+
+def ReadPrelude(f):
+  """Returns (payload offset, dict of the variables assigned in the prelude)."""
+  f.seek(0)
+  head = f.read(_MAX_PRELUDE)
+  if not head.startswith('#!'):
+    return 0, {}  # --no-prelude
+  prelude_vars = _PreludeVars(head)
+  if 'payload_offset' in prelude_vars:
+    return int(prelude_vars['payload_offset']) - 1, prelude_vars
+  # Archives created before payload_offset was added end the prelude with a
+  # line containing just 'exit'.
+  i = head.find('\nexit\n')
+  if i == -1:
+    raise Error("Couldn't find the end of the prelude")
+  return i + len('\nexit\n'), prelude_vars
+
+
+def _ReadMember(f, offset, length):
+  """Returns the tar bytes in the gzip member at offset."""
+  f.seek(offset)
+  data = f.read(length)
+  if len(data) != length:
+    raise Error('Member at offset %d is truncated' % offset)
+  return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+def _Gunzip(data):
+  """Decompress all the gzip members in data."""
+  out = []
+  while data:
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out.append(d.decompress(data))
+    data = d.unused_data
+  return ''.join(out)
+
+
+def _FirstFile(tar_bytes):
+  """Returns (TarInfo, contents) of the first file in some tar bytes."""
+  t = tarfile.open(fileobj=cStringIO.StringIO(tar_bytes), mode='r:')
+  tarinfo = t.next()
+  if tarinfo is None:
+    raise Error('Empty member')
+  if tarinfo.isreg():
+    return tarinfo, t.extractfile(tarinfo).read()
+  return tarinfo, ''
+
+
+def ParseToc(toc):
+  """Yields (offset, length, size, digest, name) from TIN/toc contents."""
+  for line in toc.splitlines():
+    offset, length, size, digest, name = line.split('\t')
+    yield (int(offset), int(length), int(size), digest,
+           name.decode('string_escape'))
+
+
+class TinArchive(object):
+  """A .tin file, or a .tar.gz made with --no-prelude.
+
+  Usage:
+    a = TinArchive('foo.tin')
+    for size, name in a.List():
+      ...
+    contents = a.Cat('TIN/checksum')
+    a.close()
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.f = open(path, 'rb')
+    self.zip = None
+    self.toc = None  # [(offset, length, size, name)] in archive order
+    self.toc_index = None  # name -> (offset, length)
+    self.tail = None  # [(TarInfo, contents)] of TIN/toc and after
+
+    if zipfile.is_zipfile(self.f):
+      self.zip = zipfile.ZipFile(self.f)
+      self.prelude_vars = ReadPreludeVars(self.f)
+      return
+
+    self.payload_offset, self.prelude_vars = ReadPrelude(self.f)
+    toc_offset = int(self.prelude_vars.get('toc_offset', 0))
+    if toc_offset:
+      # TIN/toc is followed by TIN/checksum and the end of the archive, which
+      # are small.
+      self.f.seek(toc_offset)
+      t = tarfile.open(fileobj=cStringIO.StringIO(_Gunzip(self.f.read())),
+                       mode='r:')
+      self.tail = [(tarinfo, t.extractfile(tarinfo).read()) for tarinfo in t]
+      if not self.tail or self.tail[0][0].name != 'TIN/toc':
+        raise Error('Expected TIN/toc at offset %d' % toc_offset)
+      self.toc = [(offset, length, size, name)
+                  for offset, length, size, _, name
+                  in ParseToc(self.tail[0][1])]
+      self.toc_index = dict((name, (offset, length))
+                            for offset, length, _, name in self.toc)
+
+  def Stream(self):
+    """Yields (TarInfo, TarFile) for each member, decompressing as it goes."""
+    self.f.seek(self.payload_offset)
+    # GzipFile reads all the members of a --cache-dir archive, unlike 'r|gz'.
+    t = tarfile.open(fileobj=gzip.GzipFile(fileobj=self.f), mode='r|')
+    for tarinfo in t:
+      yield tarinfo, t
+
+  def List(self):
+    """Returns a list of (size, name), in archive order."""
+    if self.zip:
+      return [(i.file_size, i.filename) for i in self.zip.infolist()]
+    if self.toc is not None:
+      return ([(size, name) for _, _, size, name in self.toc] +
+              [(tarinfo.size, tarinfo.name) for tarinfo, _ in self.tail])
+    return [(tarinfo.size, tarinfo.name) for tarinfo, _ in self.Stream()]
+
+  def Lookup(self, name):
+    """Returns (TarInfo, contents) of a file in a tar.
+
+    The contents of anything but a regular file are empty.
+    """
+    if self.zip:
+      raise AssertionError('Not a tar')
+
+    if self.toc is not None:
+      if name in self.toc_index:
+        offset, length = self.toc_index[name]
+        tarinfo, contents = _FirstFile(_ReadMember(self.f, offset, length))
+      else:
+        for tarinfo, contents in self.tail:
+          if tarinfo.name == name:
+            break
+        else:
+          raise Error('%s has no file %r' % (self.path, name))
+    else:
+      for tarinfo, t in self.Stream():
+        if tarinfo.name == name:
+          contents = t.extractfile(tarinfo).read() if tarinfo.isreg() else ''
+          break
+      else:
+        raise Error('%s has no file %r' % (self.path, name))
+    return tarinfo, contents
+
+  def Header(self, name):
+    """Returns the TarInfo of a file in an indexed archive, or None.
+
+    Only the start of the file's member is decompressed, so this is cheap
+    even for large files.  None means the header needs more than one block,
+    e.g. for a long name, so use Lookup().
+    """
+    offset, length = self.toc_index[name]
+    self.f.seek(offset)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = d.decompress(self.f.read(min(length, _HEADER_READ)),
+                       tarfile.BLOCKSIZE)
+    if len(buf) < tarfile.BLOCKSIZE:
+      raise Error('Member at offset %d is truncated' % offset)
+    try:
+      tarinfo = tarfile.TarInfo.frombuf(buf)
+    except tarfile.HeaderError, e:
+      raise Error('Invalid header at offset %d: %s' % (offset, e))
+    if tarinfo.name != name:
+      return None  # a GNU long name or pax header
+    return tarinfo
+
+  def Cat(self, name):
+    """Returns the contents of a file."""
+    if self.zip:
+      try:
+        return self.zip.read(name)
+      except KeyError:
+        raise Error('%s has no file %r' % (self.path, name))
+
+    tarinfo, contents = self.Lookup(name)
+    if tarinfo.issym():
+      raise Error('%s is a symlink to %s' % (name, tarinfo.linkname))
+    return contents
+
+  def close(self):
+    self.f.close()
+
+
+def main(argv):
+  """Returns an exit code."""
+  try:
+    action, path = argv[1:3]
+  except ValueError:
+    raise Error('Usage: tin_archive.py (list | cat) TIN [NAME...]')
+
+  a = TinArchive(path)
+  try:
+    if action == 'list':
+      for size, name in a.List():
+        print '%10d  %s' % (size, name)
+    elif action == 'cat':
+      for name in argv[3:]:
+        sys.stdout.write(a.Cat(name))
+    else:
+      raise Error('Invalid action %r' % action)
+  finally:
+    a.close()
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except Error, e:
+    print >>sys.stderr, 'tin_archive:', e.args[0]
+    sys.exit(1)
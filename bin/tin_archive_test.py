@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+"""
+tin_archive_test.py: Tests for tin_archive.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import create
+import create_test
+import tin_archive  # module under test
+
+
+FILES = [
+    ('main.sh', '#!/bin/sh\necho hi\n'),
+    ('lib/a.py', 'a = 1\n' * 1000),
+    ('lib/b\tc.txt', 'tab in the name\n'),
+]
+
+
+class TinArchiveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='tin_archive_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Create(self, name, flags):
+    return create_test.MakeArchive(self.tmp, name, FILES, flags)
+
+  def _CheckArchive(self, out):
+    a = tin_archive.TinArchive(out)
+    try:
+      names = [name for _, name in a.List()]
+      self.assertEqual([name for name, _ in FILES],
+                       [n for n in names if not n.startswith('TIN/')])
+      self.assertEqual('TIN/checksum', names[-1])
+      for name, contents in FILES:
+        self.assertEqual(contents, a.Cat(name))
+      self.assertTrue(a.Cat('TIN/checksum').endswith('src/lib/b\tc.txt\n'))
+      self.assertRaises(tin_archive.Error, a.Cat, 'nope')
+    finally:
+      a.close()
+
+  def testFormats(self):
+    for name, flags in [
+        ('plain.tin', []),
+        ('index.tin', ['--index']),
+        ('index-cached.tin', ['--index', '--cache-dir',
+                              os.path.join(self.tmp, 'cache')]),
+        ('cached.tar.gz', ['--no-prelude', '--cache-dir',
+                           os.path.join(self.tmp, 'cache')]),
+        ('zip.tin', ['--kind', 'zip'])]:
+      out = self._Create(name, flags)
+      self._CheckArchive(out)
+
+  def testIndexIsRandomAccess(self):
+    out = self._Create('index.tin', ['--index'])
+    a = tin_archive.TinArchive(out)
+    self.assertTrue(a.toc is not None)
+    offset, length, size, name = a.toc[1]
+    self.assertEqual('lib/a.py', name)
+    self.assertEqual(6000, size)
+    a.close()
+
+    # Corrupt the member of lib/a.py.  The other files are still readable,
+    # since they're never decompressed together.
+    with open(out, 'r+b') as f:
+      f.seek(offset + length // 2)
+      f.write('\xff' * 8)
+    a = tin_archive.TinArchive(out)
+    self.assertEqual(FILES[2][1], a.Cat(FILES[2][0]))
+    self.assertEqual(FILES[0][1], a.Cat(FILES[0][0]))
+    a.close()
+
+  def testParseToc(self):
+    toc = (create.TocLine(100, 20, 5, 'abc', 'a\tb\nc') +
+           create.TocLine(120, 30, 6, 'def', 'd'))
+    self.assertEqual(
+        [(100, 20, 5, 'abc', 'a\tb\nc'), (120, 30, 6, 'def', 'd')],
+        list(tin_archive.ParseToc(toc)))
+
+
+if __name__ == '__main__':
+  unittest.main()
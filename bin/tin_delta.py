@@ -0,0 +1,373 @@
+#!/usr/bin/env python2
+"""
+tin_delta.py
+
+Send a new version of a .tin as a delta against an old version.
+
+Usage:
+  tin_delta.py delta OLD NEW > patch
+  tin_delta.py patch OLD patch > NEW
+  tin_delta.py patch -o NEW OLD patch
+
+The delta works on gzip members.  In an archive made with 'create.py --index',
+each file is its own member, and TIN/toc has their offsets and digests.  A
+member of NEW whose bytes are also in OLD is sent as a reference to OLD, and
+everything else (the prelude, changed files, the table, the checksum) is sent
+as literal bytes.  If either archive has no index, the delta is all of NEW.
+
+An unchanged file keeps the same member bytes when its contents, tar header
+(including mtime), and compression level are the same.
+
+'patch' rebuilds NEW in a temp file, checks its md5 against the one in the
+patch, and checks each file against its digest in TIN/checksum, and
+TIN/checksum against the checksum in the prelude, before writing any output.
+
+Patch format (little-endian):
+
+  header  magic 'TINDELTA', u32 version, md5 of OLD, md5 of NEW (16 bytes
+          each), u64 size of NEW
+  ops     'c' u64 offset u64 length    copy bytes from OLD
+          'l' u64 length, then bytes   literal bytes
+          'e'                          end
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import hashlib
+import optparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import create
+import tin_archive
+
+
+class Error(Exception):
+  pass
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, 'tin_delta:', msg
+
+
+MAGIC = 'TINDELTA'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sI16s16sQ')
+_OP = struct.Struct('<cQQ')
+_LITERAL = struct.Struct('<cQ')
+
+COPY, LITERAL, END = 'c', 'l', 'e'
+
+_CHUNK_SIZE = 1 << 20
+
+
+def _FileMd5(path):
+  h = hashlib.md5()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(_CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.digest()
+
+
+def _Members(path):
+  """Returns [(offset, length, digest)] of file members, or None.
+
+  None means the archive has no index.
+  """
+  try:
+    a = tin_archive.TinArchive(path)
+  except tin_archive.Error, e:
+    raise Error('%s: %s' % (path, e.args[0]))
+  try:
+    if a.toc is None:
+      return None
+    toc = a.tail[0][1]
+  finally:
+    a.close()
+  return [(offset, length, digest)
+          for offset, length, _, digest, _ in tin_archive.ParseToc(toc)]
+
+
+def Diff(old_path, new_path):
+  """Returns a list of ops that build NEW from OLD.
+
+  Each op is (COPY, offset in OLD, length) or (LITERAL, offset in NEW, length).
+  """
+  new_size = os.path.getsize(new_path)
+  old_members = _Members(old_path)
+  new_members = _Members(new_path)
+  if old_members is None or new_members is None:
+    return [(LITERAL, 0, new_size)]
+
+  by_digest = {}  # (digest, length) -> [offset in OLD]
+  for offset, length, digest in old_members:
+    by_digest.setdefault((digest, length), []).append(offset)
+
+  ops = []
+  def Add(kind, offset, length):
+    # Merge with the previous op if it's contiguous.
+    if ops and ops[-1][0] == kind and ops[-1][1] + ops[-1][2] == offset:
+      ops[-1] = (kind, ops[-1][1], ops[-1][2] + length)
+    else:
+      ops.append((kind, offset, length))
+
+  pos = 0
+  with open(old_path, 'rb') as old_f, open(new_path, 'rb') as new_f:
+    for offset, length, digest in new_members:
+      if offset > pos:
+        Add(LITERAL, pos, offset - pos)  # e.g. the prelude
+      new_f.seek(offset)
+      new_bytes = new_f.read(length)
+      for old_offset in by_digest.get((digest, length), []):
+        old_f.seek(old_offset)
+        # The digest is of the file contents, so compare the member bytes.
+        if old_f.read(length) == new_bytes:
+          Add(COPY, old_offset, length)
+          break
+      else:
+        Add(LITERAL, offset, length)
+      pos = offset + length
+  if pos < new_size:
+    Add(LITERAL, pos, new_size - pos)
+  return ops
+
+
+def WriteDelta(old_path, new_path, out_f):
+  """Write a patch that builds NEW from OLD.
+
+  Returns:
+    (bytes copied from OLD, literal bytes)
+  """
+  ops = Diff(old_path, new_path)
+  out_f.write(_HEADER.pack(MAGIC, VERSION, _FileMd5(old_path),
+                           _FileMd5(new_path), os.path.getsize(new_path)))
+  num_copied = num_literal = 0
+  with open(new_path, 'rb') as new_f:
+    for kind, offset, length in ops:
+      if kind == COPY:
+        out_f.write(_OP.pack(COPY, offset, length))
+        num_copied += length
+      else:
+        out_f.write(_LITERAL.pack(LITERAL, length))
+        new_f.seek(offset)
+        _CopyRange(new_f, out_f, length)
+        num_literal += length
+  out_f.write(END)
+  return num_copied, num_literal
+
+
+def _CopyRange(in_f, out_f, length):
+  while length:
+    chunk = in_f.read(min(length, _CHUNK_SIZE))
+    if not chunk:
+      raise Error('Unexpected end of file')
+    out_f.write(chunk)
+    length -= len(chunk)
+
+
+def _ReadStruct(f, s):
+  data = f.read(s.size)
+  if len(data) != s.size:
+    raise Error('Patch is truncated')
+  return s.unpack(data)
+
+
+def ApplyDelta(old_path, patch_f, out_f):
+  """Write NEW, built from OLD and a patch, to out_f.
+
+  Returns:
+    (md5 digest, size) that NEW should have, according to the patch.
+  """
+  magic, version, old_md5, new_md5, new_size = _ReadStruct(patch_f, _HEADER)
+  if magic != MAGIC:
+    raise Error('Not a tin delta')
+  if version != VERSION:
+    raise Error('Patch has version %d, expected %d' % (version, VERSION))
+  if _FileMd5(old_path) != old_md5:
+    raise Error("%s isn't the archive this patch was made from" % old_path)
+
+  with open(old_path, 'rb') as old_f:
+    while True:
+      kind = patch_f.read(1)
+      if kind == END:
+        break
+      elif kind == COPY:
+        patch_f.seek(-1, os.SEEK_CUR)
+        _, offset, length = _ReadStruct(patch_f, _OP)
+        old_f.seek(offset)
+        _CopyRange(old_f, out_f, length)
+      elif kind == LITERAL:
+        patch_f.seek(-1, os.SEEK_CUR)
+        _, length = _ReadStruct(patch_f, _LITERAL)
+        _CopyRange(patch_f, out_f, length)
+      else:
+        raise Error('Invalid op %r in patch' % kind)
+  return new_md5, new_size
+
+
+# Members that create.py writes after the files, which aren't in TIN/checksum.
+_GENERATED_NAMES = (create.TOC_NAME, create.MATERIALIZE_NAME, 'TIN/checksum')
+
+
+def _CheckDigest(name, digest, f):
+  hash_name = create.HashForDigest(digest)
+  if hash_name is None:
+    raise Error('Unknown digest %r for %s' % (digest, name))
+  h = create.NewHash(hash_name)
+  while True:
+    chunk = f.read(_CHUNK_SIZE)
+    if not chunk:
+      break
+    h.update(chunk)
+  if h.hexdigest() != digest:
+    raise Error("%s doesn't match its digest in TIN/checksum" % name)
+
+
+def _Files(a):
+  """Yields (name, file object) for each member, in archive order.
+
+  The file object is None for anything but a regular file.
+  """
+  if a.zip:
+    for info in a.zip.infolist():
+      yield info.filename, a.zip.open(info)
+  else:
+    for tarinfo, t in a.Stream():
+      yield tarinfo.name, t.extractfile(tarinfo) if tarinfo.isreg() else None
+
+
+def Verify(path):
+  """Check each file in an archive against TIN/checksum.
+
+  The prelude's checksum is checked against TIN/checksum.  For an indexed
+  archive, TIN/toc has the same digests as TIN/checksum, in the same order,
+  along with the archive names, so files are read through the index.  Other
+  tar archives are decompressed twice: once to find TIN/checksum, which is at
+  the end, and once to check the files.
+
+  Returns:
+    The number of files checked.
+  """
+  a = tin_archive.TinArchive(path)
+  try:
+    checksum_contents = a.Cat('TIN/checksum')
+    expected = a.prelude_vars.get('checksum')  # None for --no-prelude
+    if (expected is not None and
+        hashlib.md5(checksum_contents).hexdigest() != expected):
+      raise Error("TIN/checksum doesn't match the checksum in the prelude")
+    digests = [line.split(' ', 1)[0].lstrip('\\')
+               for line in checksum_contents.splitlines()]
+
+    num_checked = 0
+    if a.toc is not None:
+      toc = list(tin_archive.ParseToc(a.tail[0][1]))
+      if digests != [digest for _, _, _, digest, _ in toc]:
+        raise Error("TIN/toc doesn't match TIN/checksum")
+      for _, _, _, digest, name in toc:
+        tarinfo, contents = a.Lookup(name)
+        if not tarinfo.isreg():
+          continue  # the digest is of a symlink's target
+        _CheckDigest(name, digest, cStringIO.StringIO(contents))
+        num_checked += 1
+      return num_checked
+
+    num_files = 0
+    for name, f in _Files(a):
+      if name in _GENERATED_NAMES:
+        continue
+      if num_files == len(digests):
+        raise Error('%s has more files than TIN/checksum' % path)
+      digest = digests[num_files]
+      num_files += 1
+      if f is None:
+        continue  # the digest is of a symlink's target
+      _CheckDigest(name, digest, f)
+      num_checked += 1
+    if num_files != len(digests):
+      raise Error('%s has %d files, but TIN/checksum has %d' %
+                  (path, num_files, len(digests)))
+    return num_checked
+  finally:
+    a.close()
+
+
+def Patch(old_path, patch_path, out_f):
+  """Build NEW in a temp file, verify it, then copy it to out_f."""
+  fd, tmp_path = tempfile.mkstemp(prefix='tin_delta')
+  try:
+    with os.fdopen(fd, 'wb') as tmp_f, open(patch_path, 'rb') as patch_f:
+      new_md5, new_size = ApplyDelta(old_path, patch_f, tmp_f)
+    if os.path.getsize(tmp_path) != new_size or _FileMd5(tmp_path) != new_md5:
+      raise Error("The patched archive doesn't match the one the patch was "
+                  "made from")
+    num_checked = Verify(tmp_path)
+    log('Checked %d files', num_checked)
+    with open(tmp_path, 'rb') as f:
+      shutil.copyfileobj(f, out_f, _CHUNK_SIZE)
+  finally:
+    os.unlink(tmp_path)
+
+
+def Options():
+  """Returns an option parser instance."""
+  p = optparse.OptionParser(
+      'tin_delta.py delta OLD NEW > patch\n'
+      '       tin_delta.py [-o NEW] patch OLD patch > NEW')
+  p.add_option(
+      '-o', '--output', dest='output', type='str', default=None,
+      help='With patch, write NEW here instead of stdout.  It only appears '
+           'if it was verified.')
+  return p
+
+
+def main(argv):
+  """Returns an exit code."""
+  (opts, argv) = Options().parse_args(argv)
+  try:
+    action, first, second = argv[1:4]
+  except ValueError:
+    raise Error('Expected an action and 2 files')
+
+  if action == 'delta':
+    num_copied, num_literal = WriteDelta(first, second, sys.stdout)
+    log('%d bytes referenced from %s, %d literal bytes', num_copied, first,
+        num_literal)
+
+  elif action == 'patch':
+    if opts.output:
+      tmp = opts.output + '.tmp'
+      try:
+        with open(tmp, 'wb') as f:
+          Patch(first, second, f)
+      except:
+        os.unlink(tmp)
+        raise
+      os.chmod(tmp, 0755)
+      os.rename(tmp, opts.output)
+      log('Wrote %s', opts.output)
+    else:
+      Patch(first, second, sys.stdout)
+
+  else:
+    raise Error('Invalid action %r' % action)
+
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except (Error, tin_archive.Error), e:
+    print >>sys.stderr, 'tin_delta:', e.args[0]
+    sys.exit(1)
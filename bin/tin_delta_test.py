@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+"""
+tin_delta_test.py: Tests for tin_delta.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cStringIO
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import create_test
+import tin_archive
+import tin_delta  # module under test
+
+
+class TinDeltaTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='tin_delta_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Create(self, name, files, flags):
+    return create_test.MakeArchive(self.tmp, name, files, flags)
+
+  def _Patch(self, old, new):
+    patch = cStringIO.StringIO()
+    num_copied, num_literal = tin_delta.WriteDelta(old, new, patch)
+    out = cStringIO.StringIO()
+    patch_path = os.path.join(self.tmp, 'patch')
+    with open(patch_path, 'wb') as f:
+      f.write(patch.getvalue())
+    tin_delta.Patch(old, patch_path, out)
+    self.assertEqual(open(new, 'rb').read(), out.getvalue())
+    return num_copied, num_literal, patch_path
+
+  def testIndexed(self):
+    big = ''.join('line %d\n' % i for i in xrange(20000))
+    files = [('a.txt', big), ('b.txt', 'b\n'), ('c.txt', big + 'c\n')]
+    old = self._Create('old.tin', files, ['--index'])
+    files[1] = ('b.txt', 'changed\n')
+    new = self._Create('new.tin', files, ['--index'])
+
+    num_copied, num_literal, _ = self._Patch(old, new)
+    # a.txt and c.txt are referenced, so the patch is much smaller.
+    self.assertTrue(num_copied > 2 * num_literal, (num_copied, num_literal))
+    self.assertEqual(os.path.getsize(new), num_copied + num_literal)
+
+    ops = tin_delta.Diff(old, new)
+    self.assertEqual([tin_delta.LITERAL, tin_delta.COPY, tin_delta.LITERAL,
+                      tin_delta.COPY, tin_delta.LITERAL],
+                     [kind for kind, _, _ in ops])
+
+  def testNotIndexed(self):
+    files = [('a.txt', 'a\n')]
+    old = self._Create('old.tin', files, [])
+    new = self._Create('new.tin', files, ['--index'])
+    num_copied, num_literal, _ = self._Patch(old, new)
+    self.assertEqual(0, num_copied)
+    self.assertEqual(os.path.getsize(new), num_literal)
+
+  def testWrongOld(self):
+    old = self._Create('old.tin', [('a.txt', 'a\n')], ['--index'])
+    new = self._Create('new.tin', [('a.txt', 'b\n')], ['--index'])
+    _, _, patch_path = self._Patch(old, new)
+    self.assertRaises(tin_delta.Error, tin_delta.Patch, new, patch_path,
+                      cStringIO.StringIO())
+
+  def testVerify(self):
+    files = [('a.txt', 'a\n' * 1000), ('b.txt', 'b\n')]
+    path = self._Create('new.tin', files, ['--index'])
+    self.assertEqual(2, tin_delta.Verify(path))
+
+    # Replace the member of a.txt with one that has different contents but
+    # the same length, and patch the table so it still points at it.
+    a = tin_archive.TinArchive(path)
+    offset, length, _, _ = a.toc[0]
+    a.close()
+    other = self._Create('other.tin', [('a.txt', 'x\n' * 1000)], ['--index'])
+    a = tin_archive.TinArchive(other)
+    other_offset, other_length, _, _ = a.toc[0]
+    a.close()
+    self.assertEqual(length, other_length)
+
+    with open(other, 'rb') as f:
+      f.seek(other_offset)
+      member = f.read(other_length)
+    with open(path, 'r+b') as f:
+      f.seek(offset)
+      f.write(member)
+    self.assertRaises(tin_delta.Error, tin_delta.Verify, path)
+
+  def testVerifyNotIndexed(self):
+    files = [('a.txt', 'a\n' * 1000), ('b.txt', 'b\n')]
+    for flags in [[], ['--kind', 'zip']]:
+      path = self._Create('new.tin', files, flags)
+      self.assertEqual(2, tin_delta.Verify(path))
+
+      # Change the checksum in the prelude.
+      with open(path, 'r+b') as f:
+        f.seek(f.read().index("checksum='") + len("checksum='"))
+        f.write('0' * 32)
+      self.assertRaises(tin_delta.Error, tin_delta.Verify, path)
+
+    path = os.path.join(self.tmp, 'bad.tar.gz')
+    t = tarfile.open(path, 'w:gz')
+    for name, contents in [
+        ('a.txt', 'a\n'),
+        ('TIN/checksum', '%s  a.txt\n' % hashlib.md5('b\n').hexdigest())]:
+      tarinfo = tarfile.TarInfo(name)
+      tarinfo.size = len(contents)
+      t.addfile(tarinfo, cStringIO.StringIO(contents))
+    t.close()
+    self.assertRaises(tin_delta.Error, tin_delta.Verify, path)
+
+
+if __name__ == '__main__':
+  unittest.main()
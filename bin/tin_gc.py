@@ -0,0 +1,238 @@
+#!/usr/bin/env python2
+"""
+tin_gc.py
+
+Remove least recently used .tin extract dirs ($TMP/tin-*) until they fit in a
+byte budget.
+
+Usage:
+  tin_gc.py --max-bytes 2G          # evict from $TMP, or /tmp
+  tin_gc.py --max-bytes 2G -n       # only show what would be removed
+
+Each run of a .tin touches its extract dir, so the dir's mtime is its last use.
+Sizes are disk usage, as with 'du'.
+
+A dir is never removed while a running process has it in TIN_EXTRACT_DIR,
+which the prelude exports, and which is visible in /proc/PID/environ.  A dir
+is removed by taking its extraction lock, checking /proc again, and renaming it
+away first, so a .tin starting at the same time either sees the whole dir or
+extracts it again.
+
+Private dirs left by extractions that died (tin-*.tmp.PID) are removed too.
+
+When $TIN_GC_MAX_BYTES is set, the prelude of each .tin does the same thing
+after it extracts, without the reporting.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import errno
+import optparse
+import os
+import re
+import shutil
+import sys
+
+
+class Error(Exception):
+  pass
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, 'tin_gc:', msg
+
+
+# tin-CHECKSUM and tin-lazy-CHECKSUM, but not .lock, .tmp.PID, or .gc.PID dirs.
+_EXTRACT_DIR_RE = re.compile(r'^tin-(lazy-)?[0-9a-f]+$')
+_TEMP_DIR_RE = re.compile(r'^tin-(lazy-)?[0-9a-f]+\.(tmp|gc)\.(\d+)$')
+
+_SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def ParseSize(s):
+  """Parse a byte count like '500M' or '2G'."""
+  multiplier = _SIZE_SUFFIXES.get(s[-1:].upper())
+  digits = s[:-1] if multiplier else s
+  try:
+    n = int(digits)
+  except ValueError:
+    raise Error('Invalid size %r' % s)
+  return n * (multiplier or 1)
+
+
+def DiskUsage(path):
+  """Returns the bytes used by a tree on disk."""
+  total = os.lstat(path).st_blocks * 512
+  for dir_path, dirs, files in os.walk(path):
+    for name in dirs + files:
+      try:
+        total += os.lstat(os.path.join(dir_path, name)).st_blocks * 512
+      except OSError:
+        pass  # removed while we were walking
+  return total
+
+
+def ListExtractDirs(tmp_dir):
+  """Returns a list of (last use, path) for complete extract dirs."""
+  result = []
+  for name in os.listdir(tmp_dir):
+    if not _EXTRACT_DIR_RE.match(name):
+      continue
+    path = os.path.join(tmp_dir, name)
+    try:
+      st = os.lstat(path)
+    except OSError:
+      continue
+    if os.path.isdir(path) and not os.path.islink(path):
+      result.append((st.st_mtime, path))
+  return result
+
+
+def InUseDirs(proc_dir='/proc'):
+  """Returns the real paths of every TIN_EXTRACT_DIR we can see in /proc."""
+  in_use = set()
+  try:
+    pids = [name for name in os.listdir(proc_dir) if name.isdigit()]
+  except OSError:
+    return in_use  # not Linux
+  for pid in pids:
+    try:
+      with open(os.path.join(proc_dir, pid, 'environ')) as f:
+        environ = f.read()
+    except IOError:
+      continue  # exited, or another user's process
+    for entry in environ.split('\0'):
+      if entry.startswith('TIN_EXTRACT_DIR='):
+        in_use.add(os.path.realpath(entry[len('TIN_EXTRACT_DIR='):]))
+  return in_use
+
+
+def PidIsAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno != errno.ESRCH
+  return True
+
+
+def StaleTempDirs(tmp_dir):
+  """Returns the paths of temp dirs whose process has died."""
+  result = []
+  for name in os.listdir(tmp_dir):
+    m = _TEMP_DIR_RE.match(name)
+    if m and not PidIsAlive(int(m.group(3))):
+      result.append(os.path.join(tmp_dir, name))
+  return result
+
+
+def _Remove(path, get_in_use):
+  """Remove an extract dir under its lock.
+
+  The dirs in use are read again under the lock, since a .tin may have started
+  from this one after the first read.
+
+  Returns:
+    True if it was removed, or False if it's locked, in use, or already gone.
+  """
+  lock = path + '.lock'
+  try:
+    os.mkdir(lock)
+  except OSError, e:
+    if e.errno == errno.EEXIST:
+      return False
+    raise
+  try:
+    with open(os.path.join(lock, 'pid'), 'w') as f:
+      f.write('%d\n' % os.getpid())
+    if os.path.realpath(path) in get_in_use():
+      log('keeping %s, which is in use', path)
+      return False
+    doomed = '%s.gc.%d' % (path, os.getpid())
+    try:
+      os.rename(path, doomed)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return False  # another gc removed it
+      raise
+  finally:
+    shutil.rmtree(lock)
+  shutil.rmtree(doomed)
+  return True
+
+
+def Collect(tmp_dir, max_bytes, get_in_use=InUseDirs, dry_run=False):
+  """Evict least recently used extract dirs until they fit in max_bytes.
+
+  Args:
+    get_in_use: Returns the set of real paths to keep.  It's called once up
+      front, and again under the lock of each dir that's removed.
+
+  Returns:
+    (list of (path, bytes) removed, bytes left)
+  """
+  in_use = get_in_use()
+
+  if not dry_run:
+    for path in StaleTempDirs(tmp_dir):
+      log('removing %s', path)
+      shutil.rmtree(path, ignore_errors=True)
+
+  dirs = sorted(ListExtractDirs(tmp_dir))  # oldest first
+  sizes = dict((path, DiskUsage(path)) for _, path in dirs)
+  total = sum(sizes.itervalues())
+
+  removed = []
+  for _, path in dirs:
+    if total <= max_bytes:
+      break
+    if os.path.realpath(path) in in_use:
+      log('keeping %s, which is in use', path)
+      continue
+    if not dry_run and not _Remove(path, get_in_use):
+      continue
+    removed.append((path, sizes[path]))
+    total -= sizes[path]
+  return removed, total
+
+
+def Options():
+  """Returns an option parser instance."""
+  p = optparse.OptionParser('tin_gc.py [options]')
+  p.add_option(
+      '--tmp-dir', dest='tmp_dir', type='str',
+      default=os.environ.get('TMP', '/tmp'),
+      help='Where the extract dirs are (default $TMP, or /tmp)')
+  p.add_option(
+      '--max-bytes', dest='max_bytes', type='str',
+      default=os.environ.get('TIN_GC_MAX_BYTES', '1G'),
+      help='Budget for all extract dirs, e.g. 500M or 2G (default '
+           '$TIN_GC_MAX_BYTES, or 1G)')
+  p.add_option(
+      '-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+      help="Print what would be removed, but don't remove it")
+  return p
+
+
+def main(argv):
+  """Returns an exit code."""
+  (opts, argv) = Options().parse_args(argv)
+  max_bytes = ParseSize(opts.max_bytes)
+
+  removed, total = Collect(opts.tmp_dir, max_bytes, dry_run=opts.dry_run)
+  verb = 'would remove' if opts.dry_run else 'removed'
+  for path, num_bytes in removed:
+    print '%s %s (%d bytes)' % (verb, path, num_bytes)
+  log('%s %d dirs, %d bytes; %d bytes left of %d', verb, len(removed),
+      sum(n for _, n in removed), total, max_bytes)
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except Error, e:
+    print >>sys.stderr, 'tin_gc:', e.args[0]
+    sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+"""
+tin_gc_test.py: Tests for tin_gc.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import tin_gc  # module under test
+
+
+def _MakeExtractDir(tmp, name, num_bytes, mtime):
+  path = os.path.join(tmp, name)
+  os.makedirs(os.path.join(path, 'TIN'))
+  with open(os.path.join(path, 'data'), 'w') as f:
+    f.write('x' * num_bytes)
+  os.utime(path, (mtime, mtime))
+  return path
+
+
+class TinGcTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='tin_gc_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testParseSize(self):
+    self.assertEqual(100, tin_gc.ParseSize('100'))
+    self.assertEqual(2 << 20, tin_gc.ParseSize('2M'))
+    self.assertEqual(3 << 30, tin_gc.ParseSize('3g'))
+    self.assertRaises(tin_gc.Error, tin_gc.ParseSize, 'lots')
+
+  def testCollect(self):
+    now = time.time()
+    old = _MakeExtractDir(self.tmp, 'tin-aaaa', 100000, now - 300)
+    in_use = _MakeExtractDir(self.tmp, 'tin-bbbb', 100000, now - 200)
+    lazy = _MakeExtractDir(self.tmp, 'tin-lazy-cccc', 100000, now - 100)
+    new = _MakeExtractDir(self.tmp, 'tin-dddd', 100000, now)
+    # Not extract dirs.
+    os.mkdir(os.path.join(self.tmp, 'tin-dddd.lock'))
+    os.mkdir(os.path.join(self.tmp, 'other'))
+
+    size = tin_gc.DiskUsage(new)
+    self.assertTrue(size >= 100000, size)
+    get_in_use = lambda: set([os.path.realpath(in_use)])
+
+    # Room for 2 dirs.  The oldest is removed, and the one in use is skipped.
+    removed, left = tin_gc.Collect(self.tmp, 2 * size, get_in_use=get_in_use,
+                                   dry_run=True)
+    self.assertEqual([old, lazy], [path for path, _ in removed])
+    self.assertEqual(2 * size, left)
+    self.assertTrue(os.path.exists(old))
+
+    removed, left = tin_gc.Collect(self.tmp, 2 * size, get_in_use=get_in_use)
+    self.assertEqual([old, lazy], [path for path, _ in removed])
+    self.assertEqual(
+        ['other', 'tin-bbbb', 'tin-dddd', 'tin-dddd.lock'],
+        sorted(os.listdir(self.tmp)))
+
+  def testLockedDirIsKept(self):
+    path = _MakeExtractDir(self.tmp, 'tin-aaaa', 1000, time.time())
+    os.mkdir(path + '.lock')
+    removed, _ = tin_gc.Collect(self.tmp, 0, get_in_use=set)
+    self.assertEqual([], removed)
+    self.assertTrue(os.path.exists(path))
+
+  def testStartedDuringCollect(self):
+    path = _MakeExtractDir(self.tmp, 'tin-aaaa', 1000, time.time())
+    # A .tin starts from the dir after the first read of /proc.
+    reads = []
+    def GetInUse():
+      reads.append(path)
+      return set() if len(reads) == 1 else set([os.path.realpath(path)])
+    removed, _ = tin_gc.Collect(self.tmp, 0, get_in_use=GetInUse)
+    self.assertEqual([], removed)
+    self.assertEqual(2, len(reads))
+    self.assertEqual(['tin-aaaa'], os.listdir(self.tmp))
+
+  def testStaleTempDirs(self):
+    p = subprocess.Popen(['true'])
+    p.wait()  # its pid is now dead
+    stale = os.path.join(self.tmp, 'tin-aaaa.tmp.%d' % p.pid)
+    live = os.path.join(self.tmp, 'tin-aaaa.tmp.%d' % os.getpid())
+    os.mkdir(stale)
+    os.mkdir(live)
+    self.assertEqual([stale], tin_gc.StaleTempDirs(self.tmp))
+
+    tin_gc.Collect(self.tmp, 0, get_in_use=set)
+    self.assertFalse(os.path.exists(stale))
+    self.assertTrue(os.path.exists(live))
+
+  def testInUseDirs(self):
+    if not os.path.isdir('/proc/self'):
+      return
+    path = _MakeExtractDir(self.tmp, 'tin-aaaa', 1000, time.time())
+    env = dict(os.environ, TIN_EXTRACT_DIR=path)
+    p = subprocess.Popen(['sleep', '10'], env=env)
+    try:
+      self.assertTrue(os.path.realpath(path) in tin_gc.InUseDirs())
+    finally:
+      p.kill()
+      p.wait()
+
+  def testTinSh(self):
+    path = _MakeExtractDir(self.tmp, 'tin-aaaa', 1000, time.time())
+    tin_sh = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'tin.sh')
+    p = subprocess.Popen(
+        ['bash', tin_sh, 'gc', '--tmp-dir', self.tmp, '--max-bytes', '0',
+         '-n'], stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    out = p.communicate()[0]
+    self.assertEqual(0, p.returncode)
+    self.assertTrue(out.startswith('would remove %s ' % path), out)
+    self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python2
+"""
+treespec.py
+
+Compiled treespecs: a binary form of the 'source dest' lines that multi and
+create.py read, which can hold any file name except one containing NUL, and
+can be loaded with mmap() instead of splitting lines.
+
+Usage:
+  treespec.py compile OUT < spec.txt       # from text lines
+  treespec.py -0 compile OUT < spec.nul    # from NUL-delimited fields
+  treespec.py decompile IN > spec.txt
+  treespec.py -0 decompile IN > spec.nul
+
+Text input is the create.py syntax: 'x src dest', 'f src dest', 'src dest', or
+'src'.  Blank lines and # comments are skipped.
+
+NUL-delimited input (-0) is a sequence of records of exactly 3 NUL-terminated
+fields: type ('f' or 'x'), source, and dest.  For example:
+
+  find . -type f -printf 'f\\0%p\\0%P\\0' | multi -0 cp /dest
+
+File format (little-endian):
+
+  header   magic 'TREESPEC', u32 version, u32 number of records,
+           u64 offset of the index
+  records  u8 type, u32 source length, u32 dest length, source, dest
+  index    u64 record offset for each record, sorted by dest
+
+Records are in input order, and only the first record for each dest is kept,
+so the index is a set of unique dests.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import mmap
+import optparse
+import os
+import struct
+import sys
+
+
+class Error(Exception):
+  pass
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, 'treespec:', msg
+
+
+MAGIC = 'TREESPEC'
+VERSION = 1
+
+DATA_FILE = 0
+EXECUTABLE_FILE = 1
+
+_TYPE_NAMES = {'f': DATA_FILE, 'x': EXECUTABLE_FILE}
+_TYPE_CHARS = {DATA_FILE: 'f', EXECUTABLE_FILE: 'x'}
+
+_HEADER = struct.Struct('<8sIIQ')
+_RECORD = struct.Struct('<BII')
+_OFFSET = struct.Struct('<Q')
+
+
+def ParseText(lines):
+  """Yields (type, source, dest) from treespec lines."""
+  for line in lines:
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    parts = line.split(None, 2)
+    if len(parts) == 3:
+      file_type = _TYPE_NAMES.get(parts[0])
+      if file_type is None:
+        raise Error('Invalid file type %r in line %r' % (parts[0], line))
+      yield file_type, parts[1], parts[2]
+    elif len(parts) == 2:
+      yield DATA_FILE, parts[0], parts[1]
+    else:
+      yield DATA_FILE, parts[0], parts[0]
+
+
+def ParseNul(f):
+  """Yields (type, source, dest) from NUL-delimited type/source/dest fields."""
+  fields = f.read().split('\0')
+  if fields.pop() != '':
+    raise Error('NUL-delimited input must end with a NUL')
+  if len(fields) % 3:
+    raise Error('Expected records of 3 NUL-delimited fields, got %d fields' %
+                len(fields))
+  for i in xrange(0, len(fields), 3):
+    type_name, src, dest = fields[i:i+3]
+    file_type = _TYPE_NAMES.get(type_name)
+    if file_type is None:
+      raise Error('Invalid file type %r in record %d' % (type_name, i // 3))
+    if not src or not dest:
+      raise Error('Empty path in record %d' % (i // 3))
+    yield file_type, src, dest
+
+
+def Compile(records, out_path):
+  """Write records to a compiled treespec.
+
+  Returns:
+    The number of records dropped because their dest was a duplicate.
+  """
+  seen = set()
+  offsets = []  # (dest, offset)
+  num_dupes = 0
+
+  tmp_path = out_path + '.tmp'
+  try:
+    with open(tmp_path, 'wb') as f:
+      f.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+      pos = _HEADER.size
+      for file_type, src, dest in records:
+        if dest in seen:
+          num_dupes += 1
+          continue
+        seen.add(dest)
+        offsets.append((dest, pos))
+        f.write(_RECORD.pack(file_type, len(src), len(dest)))
+        f.write(src)
+        f.write(dest)
+        pos += _RECORD.size + len(src) + len(dest)
+
+      offsets.sort()
+      f.write(''.join(_OFFSET.pack(offset) for _, offset in offsets))
+      f.seek(0)
+      f.write(_HEADER.pack(MAGIC, VERSION, len(offsets), pos))
+  except:
+    os.unlink(tmp_path)
+    raise
+  os.rename(tmp_path, out_path)
+  return num_dupes
+
+
+class Treespec(object):
+  """A compiled treespec, mapped into memory.
+
+  Usage:
+    spec = Treespec('foo.treespec')
+    for file_type, src, dest in spec.SortedRecords():
+      ...
+    spec.close()
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size < _HEADER.size:
+        raise Error('%s is too short to be a treespec' % path)
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, self.num_records, self.index_offset = (
+        _HEADER.unpack_from(self.data))
+    if magic != MAGIC:
+      raise Error('%s is not a compiled treespec' % path)
+    if version != VERSION:
+      raise Error('%s has version %d, expected %d' % (path, version, VERSION))
+    if self.index_offset + self.num_records * _OFFSET.size != size:
+      raise Error('%s is truncated or corrupt' % path)
+
+  def __len__(self):
+    return self.num_records
+
+  def _RecordAt(self, pos):
+    """Returns ((type, source, dest), position of the next record)."""
+    file_type, src_len, dest_len = _RECORD.unpack_from(self.data, pos)
+    start = pos + _RECORD.size
+    end = start + src_len + dest_len
+    if end > self.index_offset:
+      raise Error('Record at offset %d is truncated' % pos)
+    d = self.data
+    return (file_type, d[start:start+src_len], d[start+src_len:end]), end
+
+  def _Offset(self, i):
+    pos = self.index_offset + i * _OFFSET.size
+    return _OFFSET.unpack_from(self.data, pos)[0]
+
+  def _DestAt(self, pos):
+    _, src_len, dest_len = _RECORD.unpack_from(self.data, pos)
+    start = pos + _RECORD.size + src_len
+    return self.data[start:start+dest_len]
+
+  def __iter__(self):
+    """Yields (type, source, dest) in input order."""
+    pos = _HEADER.size
+    while pos < self.index_offset:
+      record, pos = self._RecordAt(pos)
+      yield record
+
+  def SortedRecords(self):
+    """Yields (type, source, dest) sorted by dest."""
+    for i in xrange(self.num_records):
+      yield self._RecordAt(self._Offset(i))[0]
+
+  def Lookup(self, dest):
+    """Returns the (type, source, dest) record for dest, or None."""
+    lo, hi = 0, self.num_records
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._DestAt(self._Offset(mid)) < dest:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self.num_records:
+      record = self._RecordAt(self._Offset(lo))[0]
+      if record[2] == dest:
+        return record
+    return None
+
+  def close(self):
+    self.data.close()
+
+
+def WriteText(records, f):
+  for file_type, src, dest in records:
+    # The dest is the rest of the line, so it may have inner spaces.
+    if src.split() != [src] or dest.strip() != dest or '\n' in dest:
+      raise Error("%r -> %r can't be written as text; use -0" % (src, dest))
+    f.write('%s %s %s\n' % (_TYPE_CHARS[file_type], src, dest))
+
+
+def WriteNul(records, f):
+  for file_type, src, dest in records:
+    f.write('%s\0%s\0%s\0' % (_TYPE_CHARS[file_type], src, dest))
+
+
+def Options():
+  """Returns an option parser instance."""
+  p = optparse.OptionParser(
+      'treespec.py [options] compile OUT < spec\n'
+      '       treespec.py [options] decompile IN > spec')
+  p.add_option(
+      '-0', '--null', dest='null', action='store_true', default=False,
+      help='Read or write NUL-delimited type/source/dest fields instead of '
+           'text lines')
+  p.add_option(
+      '--sorted', dest='sorted', action='store_true', default=False,
+      help='With decompile, write records sorted by dest rather than in '
+           'input order')
+  return p
+
+
+def main(argv):
+  """Returns an exit code."""
+  (opts, argv) = Options().parse_args(argv)
+
+  try:
+    action, path = argv[1:3]
+  except ValueError:
+    raise Error('Expected an action and a path')
+
+  if action == 'compile':
+    if opts.null:
+      records = ParseNul(sys.stdin)
+    else:
+      records = ParseText(sys.stdin)
+    num_dupes = Compile(records, path)
+    if num_dupes:
+      log('skipped %d duplicate destinations', num_dupes)
+    log('Wrote %s', path)
+
+  elif action == 'decompile':
+    spec = Treespec(path)
+    try:
+      records = spec.SortedRecords() if opts.sorted else iter(spec)
+      if opts.null:
+        WriteNul(records, sys.stdout)
+      else:
+        WriteText(records, sys.stdout)
+    finally:
+      spec.close()
+
+  else:
+    raise Error('Invalid action %r' % action)
+
+  return 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except Error, e:
+    print >>sys.stderr, 'treespec:', e.args[0]
+    sys.exit(1)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+"""
+treespec_test.py: Tests for treespec.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import treespec  # module under test
+
+
+class TreespecTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='treespec_test')
+    self.path = os.path.join(self.tmp, 'spec')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testParseText(self):
+    records = list(treespec.ParseText([
+        '# comment',
+        '',
+        '/tmp/foo foo',
+        'foo',
+        'f /tmp/bar bar',
+        'x /tmp/bin bin',
+    ]))
+    self.assertEqual([
+        (treespec.DATA_FILE, '/tmp/foo', 'foo'),
+        (treespec.DATA_FILE, 'foo', 'foo'),
+        (treespec.DATA_FILE, '/tmp/bar', 'bar'),
+        (treespec.EXECUTABLE_FILE, '/tmp/bin', 'bin'),
+    ], records)
+
+    self.assertRaises(treespec.Error, list, treespec.ParseText(['y a b']))
+
+  def testParseNul(self):
+    f = StringIO.StringIO('f\0my file\0dir/my file\0x\0a\nb\0c\0')
+    self.assertEqual([
+        (treespec.DATA_FILE, 'my file', 'dir/my file'),
+        (treespec.EXECUTABLE_FILE, 'a\nb', 'c'),
+    ], list(treespec.ParseNul(f)))
+
+    for bad in ['f\0a\0b', 'f\0a\0', 'z\0a\0b\0', 'f\0\0b\0']:
+      self.assertRaises(treespec.Error, list,
+                        treespec.ParseNul(StringIO.StringIO(bad)))
+
+  def testCompile(self):
+    records = [
+        (treespec.DATA_FILE, 'src/c', 'c'),
+        (treespec.EXECUTABLE_FILE, 'src/a b', 'a b'),
+        (treespec.DATA_FILE, 'src/b', 'b'),
+        (treespec.DATA_FILE, 'other/c', 'c'),  # duplicate dest
+    ]
+    self.assertEqual(1, treespec.Compile(records, self.path))
+
+    spec = treespec.Treespec(self.path)
+    self.assertEqual(3, len(spec))
+    self.assertEqual(records[:3], list(spec))
+    self.assertEqual(['a b', 'b', 'c'],
+                     [dest for _, _, dest in spec.SortedRecords()])
+    self.assertEqual(records[1], spec.Lookup('a b'))
+    self.assertEqual(records[0], spec.Lookup('c'))
+    self.assertEqual(None, spec.Lookup('a'))
+    self.assertEqual(None, spec.Lookup('d'))
+    spec.close()
+
+    f = StringIO.StringIO()
+    treespec.WriteNul(list(treespec.Treespec(self.path)), f)
+    self.assertEqual(records[:3],
+                     list(treespec.ParseNul(StringIO.StringIO(f.getvalue()))))
+    # The dest can have a space in text, but not the source.
+    text_records = [(treespec.EXECUTABLE_FILE, 'src/b', 'b c')]
+    f = StringIO.StringIO()
+    treespec.WriteText(text_records, f)
+    self.assertEqual(text_records,
+                     list(treespec.ParseText(f.getvalue().splitlines())))
+    self.assertRaises(treespec.Error, treespec.WriteText,
+                      [(treespec.DATA_FILE, 'a b', 'c')], StringIO.StringIO())
+
+  def testEmpty(self):
+    treespec.Compile([], self.path)
+    spec = treespec.Treespec(self.path)
+    self.assertEqual([], list(spec))
+    self.assertEqual(None, spec.Lookup('a'))
+
+  def testCorrupt(self):
+    with open(self.path, 'w') as f:
+      f.write('a b\n')
+    self.assertRaises(treespec.Error, treespec.Treespec, self.path)
+
+    treespec.Compile([(treespec.DATA_FILE, 'a', 'b')], self.path)
+    with open(self.path, 'r+') as f:
+      f.truncate(os.path.getsize(self.path) - 1)
+    self.assertRaises(treespec.Error, treespec.Treespec, self.path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+"""
+worker_pool.py
+
+A small bounded thread pool.  Used by 'multi' to overlap file I/O; most of the
+time is spent in syscalls and zlib/hashlib, which release the GIL.
+
+Usage:
+
+  pool = WorkerPool(4)
+  job = pool.Submit(shutil.copy, 'foo', 'bar')
+  job.Wait()   # optional: returns the result or raises the job's exception
+  pool.Join()  # waits for everything, and raises the first error
+"""
+
+__author__ = 'Andy Chu'
+
+
+import Queue
+import sys
+import threading
+
+
+class Job(object):
+  """The result of a function run on a worker thread."""
+
+  def __init__(self, func, args):
+    self.func = func
+    self.args = args
+    self.result = None
+    self.exc_info = None
+    self.done = threading.Event()
+
+  def Run(self):
+    try:
+      self.result = self.func(*self.args)
+    except Exception:
+      self.exc_info = sys.exc_info()
+    self.done.set()
+
+  def Wait(self):
+    """Block until the job has run.  Returns its result or re-raises."""
+    self.done.wait()
+    if self.exc_info:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.result
+
+
+class WorkerPool(object):
+  """A fixed number of daemon threads reading jobs from a bounded queue.
+
+  Submit() blocks when the queue is full, so a fast producer (e.g. a loop over
+  a huge treespec) can't queue up unbounded work.
+  """
+
+  def __init__(self, num_threads, max_pending=None):
+    assert num_threads >= 1, num_threads
+    self.num_threads = num_threads
+    self.queue = Queue.Queue(max_pending or num_threads * 4)
+    self.errors = []  # exc_info tuples, in completion order
+    self.lock = threading.Lock()
+
+    self.threads = []
+    for _ in xrange(num_threads):
+      t = threading.Thread(target=self._Loop)
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def _Loop(self):
+    while True:
+      job = self.queue.get()
+      if job is None:  # sentinel from Join()
+        return
+      job.Run()
+      if job.exc_info:
+        with self.lock:
+          self.errors.append(job.exc_info)
+
+  def Submit(self, func, *args):
+    job = Job(func, args)
+    self.queue.put(job)
+    return job
+
+  def Join(self, raise_errors=True):
+    """Wait for all submitted jobs and stop the threads.
+
+    Args:
+      raise_errors: False if the caller checks each job with Wait().
+
+    Raises:
+      The exception of the first job that failed, if any.
+    """
+    for _ in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+    self.threads = []
+
+    if raise_errors and self.errors:
+      exc_info = self.errors[0]
+      raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,34 @@
+#!/usr/bin/env python2
+"""
+worker_pool_test.py: Tests for worker_pool.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import unittest
+
+import worker_pool  # module under test
+
+
+def _Fail(x):
+  raise ValueError(x)
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+  def testResults(self):
+    pool = worker_pool.WorkerPool(3, max_pending=2)
+    jobs = [pool.Submit(pow, i, 2) for i in xrange(10)]
+    self.assertEqual([i * i for i in xrange(10)], [j.Wait() for j in jobs])
+    pool.Join()
+
+  def testError(self):
+    pool = worker_pool.WorkerPool(2)
+    job = pool.Submit(_Fail, 'oops')
+    self.assertRaises(ValueError, job.Wait)
+    self.assertRaises(ValueError, pool.Join)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -9,4 +9,10 @@ all-unit-tests() {
   find . -name \*_test.py | sh -o xtrace -o errexit
 }
 
+# Benchmark multi and ftree.  Pass --out and --baseline to track regressions,
+# e.g. ./run.sh bench --out _tmp/bench.json
+bench() {
+  bin/multi_bench.py "$@"
+}
+
 "$@"